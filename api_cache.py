@@ -0,0 +1,92 @@
+# api_cache.py
+"""
+API 応答のディスクキャッシュ (SQLite 1ファイル)。
+
+namespace ごとに key -> JSON 値を保存し、
+  - ttl 秒を過ぎたものは期限切れとして扱う (読み出し時に削除)
+  - max_entries を超えたら最後に使われた時刻が古いものから消す (LRU)
+  - enabled=False にすると読み書きせず素通しする (バイパス)
+hits / misses を数えているので stats() で効き具合を確認できる。
+ワーカースレッドから呼ばれるので、接続はロックで守る。
+"""
+import json, time, hashlib, sqlite3, threading
+
+
+def cache_key(*parts):
+    """文字列の組からキャッシュキー (SHA-256) を作る。None は空文字として扱う。"""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update((part or "").encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class DiskCache:
+    def __init__(self, db_path, namespace, ttl=None, max_entries=1000, enabled=True):
+        self.db_path = db_path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+                " created_at REAL NOT NULL, accessed_at REAL NOT NULL,"
+                " PRIMARY KEY (namespace, key))")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS cache_lru ON cache (namespace, accessed_at)")
+
+    def get(self, key, default=None):
+        if not self.enabled:
+            return default
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT value, created_at FROM cache WHERE namespace = ? AND key = ?",
+                                     (self.namespace, key)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key))
+                row = None
+            if row is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._conn.execute("UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                               (now, self.namespace, key))
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO cache (namespace, key, value, created_at, accessed_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(namespace, key) DO UPDATE SET value = excluded.value, "
+                "created_at = excluded.created_at, accessed_at = excluded.accessed_at",
+                (self.namespace, key, json.dumps(value, ensure_ascii=False), now, now))
+            self._evict()
+
+    def _evict(self):
+        if self.ttl is not None:
+            self._conn.execute("DELETE FROM cache WHERE namespace = ? AND created_at < ?",
+                               (self.namespace, time.time() - self.ttl))
+        count = self._conn.execute("SELECT COUNT(*) FROM cache WHERE namespace = ?", (self.namespace,)).fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM cache WHERE namespace = ? AND key IN ("
+                " SELECT key FROM cache WHERE namespace = ? ORDER BY accessed_at LIMIT ?)",
+                (self.namespace, self.namespace, count - self.max_entries))
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM cache WHERE namespace = ?", (self.namespace,))
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"namespace": self.namespace, "hits": self.hits, "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0}
@@ -0,0 +1,161 @@
+# api_clients.py
+"""
+Gemini / Vision のクライアントをまとめたもの (画面には依存しない)。
+キャッシュ・レート制限・再試行の設定はアプリ全体で1つを共有する。
+"""
+import os
+
+import google.generativeai as genai
+from google.cloud import vision
+
+from config import (GEMINI_API_KEY, MODEL_NAME, SERVICE_ACCOUNT_KEY_PATH,
+                    GEMINI_CACHE_TTL, GEMINI_CACHE_MAX, GEMINI_CACHE_BYPASS,
+                    GEMINI_RPM, GEMINI_BURST, VISION_RPM, VISION_BURST,
+                    GEMINI_INTERACTIVE_RESERVE, VISION_INTERACTIVE_RESERVE,
+                    API_MAX_RETRIES, API_BACKOFF_BASE, API_BACKOFF_MAX, API_RETRY_BUDGET,
+                    API_CACHE_FILE, VISION_LABEL_CACHE_TTL, VISION_LABEL_CACHE_MAX, LOCAL_LABELER_TIMEOUT)
+from api_cache import DiskCache, cache_key
+from image_store import image_digest
+from rate_limit import TokenBucket, RetryPolicy, is_retryable, server_retry_delay
+from worker_pool import BACKGROUND, current_priority
+
+
+def configure_clients():
+    """認証情報を設定する。Gemini のキーがなければ ValueError。"""
+    if os.path.exists(SERVICE_ACCOUNT_KEY_PATH):
+        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = SERVICE_ACCOUNT_KEY_PATH
+        print("Vision API Service Account Loaded.")
+    else:
+        print(f"Warning: Vision API key '{SERVICE_ACCOUNT_KEY_PATH}' not found. Vision API will fail.")
+    if not GEMINI_API_KEY:
+        raise ValueError("GEMINI_API_KEY is not set.")
+    genai.configure(api_key=GEMINI_API_KEY)
+
+
+class APIClients:
+    def __init__(self, gemini_model=None, vision_client=None, local_labeler=None):
+        # Gemini model (create once)。負荷試験では fake_backend の偽クライアントを渡す
+        self.gemini_model = gemini_model or genai.GenerativeModel(MODEL_NAME)
+        # Vision client (create once)
+        self.vision_client = vision_client or vision.ImageAnnotatorClient()
+        # ネットワークを使わないラベラー (local_labeler.LabelerPool)。なければ None
+        self.local_labeler = local_labeler
+        # Vision ラベルのキャッシュ (画像の SHA-256 がキー)
+        self.label_cache = DiskCache(API_CACHE_FILE, "vision_labels",
+                                     ttl=VISION_LABEL_CACHE_TTL, max_entries=VISION_LABEL_CACHE_MAX)
+        # 履歴を持たない Gemini 呼び出しの応答キャッシュ (モデル名 + プロンプト + 画像ハッシュがキー)
+        self.response_cache = DiskCache(API_CACHE_FILE, "gemini_responses",
+                                        ttl=GEMINI_CACHE_TTL, max_entries=GEMINI_CACHE_MAX,
+                                        enabled=not GEMINI_CACHE_BYPASS)
+        # クライアント側のレート制限 (全スレッドで共有)。上限を超えた呼び出しは待ってから送る
+        self.gemini_bucket = TokenBucket(GEMINI_RPM, burst=GEMINI_BURST, reserve=GEMINI_INTERACTIVE_RESERVE)
+        self.vision_bucket = TokenBucket(VISION_RPM, burst=VISION_BURST, reserve=VISION_INTERACTIVE_RESERVE)
+        self.retry_policy = RetryPolicy(max_retries=API_MAX_RETRIES, base_delay=API_BACKOFF_BASE,
+                                        max_delay=API_BACKOFF_MAX, budget_per_min=API_RETRY_BUDGET)
+
+    def start_chat(self, history=None):
+        return self.gemini_model.start_chat(history=history or [])
+
+    def _rate_limited(self, bucket, func, *args):
+        # BACKGROUND の仕事は予約分のトークンを残して待つ (生徒のターンがその後ろで待たないように)
+        waited = bucket.acquire(background=current_priority() == BACKGROUND)
+        if waited > 0:
+            print(f"[DEBUG] Rate limiter: waited {waited:.1f}s")
+        try:
+            return func(*args)
+        except Exception as e:
+            # サーバーに待ち時間を指定されたら、ほかのスレッドの呼び出しもその間止める
+            delay = server_retry_delay(e)
+            if delay is not None and is_retryable(e):
+                bucket.pause(delay)
+            raise
+
+    def send(self, chat, prompt_parts, on_chunk=None):
+        """Gemini への送信はすべてここを通す。on_chunk を渡すとストリーミングで受け取り、途中経過を渡す。
+        失敗したらチャットの履歴を送信前に戻す (同じチャットで再試行しても user ターンが重ならない)。"""
+        before = list(chat.history)
+        try:
+            if on_chunk is None:
+                return self._rate_limited(self.gemini_bucket, chat.send_message, prompt_parts)
+            resp = self._rate_limited(self.gemini_bucket, lambda: chat.send_message(prompt_parts, stream=True))
+            return self.read_stream(resp, on_chunk)
+        except Exception:
+            chat.history = before  # 途中まで受け取った応答も捨てる
+            raise
+
+    def send_now(self, chat, prompt_parts, on_chunk=None):
+        """レート制限を通さずに送る (制限は呼び出し側 = AsyncAPIClients がかけている場合)。"""
+        before = list(chat.history)
+        try:
+            if on_chunk is None:
+                return chat.send_message(prompt_parts)
+            return self.read_stream(chat.send_message(prompt_parts, stream=True), on_chunk)
+        except Exception:
+            chat.history = before
+            raise
+
+    def read_stream(self, resp, on_chunk):
+        text = ""
+        for chunk in resp:
+            try:
+                piece = chunk.text
+            except ValueError:
+                continue  # テキストを含まないチャンク (終了理由だけなど)
+            if piece:
+                text += piece
+                on_chunk(text)
+        resp.resolve()  # 履歴 (chat.history) に応答を確定させる
+        return resp
+
+    def response_key(self, prompt_parts, image_hash=None):
+        if isinstance(prompt_parts, str):
+            prompt_parts = [prompt_parts]
+        # 画像 (PIL.Image) はキーに含めず、代わりに image_hash を使う
+        texts = [p for p in prompt_parts if isinstance(p, str)]
+        return cache_key(MODEL_NAME, "\n".join(texts), image_hash)
+
+    def generate_text(self, prompt_parts, image_hash=None):
+        """履歴なしの1回きりの呼び出し。同じプロンプトならキャッシュから返す。"""
+        key = self.response_key(prompt_parts, image_hash)
+        text = self.response_cache.get(key)
+        if text is not None:
+            print(f"[DEBUG] Gemini response from cache: {key[:12]}")
+            return text
+        text = self.send(self.start_chat(history=[]), prompt_parts).text
+        self.response_cache.put(key, text)
+        return text
+
+    def start_chat_cached(self, prompt_parts, image_hash=None, on_chunk=None):
+        """会話の1ターン目。キャッシュにあれば、その応答を履歴に入れたチャットを作って返す。"""
+        key = self.response_key(prompt_parts, image_hash)
+        text = self.response_cache.get(key)
+        if text is not None:
+            print(f"[DEBUG] Gemini first turn from cache: {key[:12]}")
+            history = [{"role": "user", "parts": prompt_parts if isinstance(prompt_parts, list) else [prompt_parts]},
+                       {"role": "model", "parts": [text]}]
+            return self.start_chat(history=history), text
+        chat = self.start_chat(history=[])
+        text = self.send(chat, prompt_parts, on_chunk=on_chunk).text
+        self.response_cache.put(key, text)
+        return chat, text
+
+    def local_labels(self, image_bytes: bytes):
+        return self.local_labeler.labels(image_bytes, timeout=LOCAL_LABELER_TIMEOUT)
+
+    def cached_labels(self, image_bytes: bytes):
+        return self.label_cache.get(image_digest(image_bytes))
+
+    def label_detection(self, image_bytes: bytes):
+        digest = image_digest(image_bytes)
+        labels = self.label_cache.get(digest)
+        if labels is not None:
+            print(f"[DEBUG] Vision labels from cache: {digest[:12]}")
+            return labels
+
+        image = vision.Image(content=image_bytes)
+        response = self._rate_limited(self.vision_bucket, lambda: self.vision_client.label_detection(image=image))
+        if response.error.message:
+            raise Exception(response.error.message)
+        labels = [l.description for l in response.label_annotations]
+        self.label_cache.put(digest, labels)
+        return labels
@@ -0,0 +1,246 @@
+# async_api_clients.py
+"""
+APIClients の asyncio 版。呼び出し1件ごとにスレッドを使わず、1本のイベントループで多数の呼び出しを待つ。
+
+  - AsyncAPIClients : start_chat / send_message / label_detection などをコルーチンで提供する。
+      キャッシュ・レート制限・再試行の設定は元の APIClients と共有する (同期版と混ぜて使ってよい)。
+      同時に出す数はセマフォで制限し、1回ごとに timeout 秒で打ち切る (打ち切りは再試行の対象)。
+      再試行の前にはチャットの履歴を送信前に戻す。スレッドで送った呼び出しの打ち切りは再試行しない。
+      Gemini は send_message_async、Vision は非同期クライアントを使う。持っていないクライアント
+      (偽のクライアントなど) の場合だけ asyncio.to_thread に逃がす。
+  - AsyncLoopThread : 専用スレッドでイベントループを回す。Tk など別スレッドから submit() で投げ、
+      scope ごとに cancel() で取り消せる (待機中・送信中のどちらでも CancelledError で止まる)。
+"""
+import asyncio, threading
+
+from google.cloud import vision
+
+from config import API_MAX_CONCURRENCY, VISION_MAX_CONCURRENCY, API_TIMEOUT, LOCAL_LABELER_TIMEOUT
+from image_store import image_digest
+from rate_limit import is_retryable, server_retry_delay
+
+
+class AsyncAPIClients:
+    def __init__(self, api, max_concurrency=API_MAX_CONCURRENCY, vision_concurrency=VISION_MAX_CONCURRENCY,
+                 timeout=API_TIMEOUT, vision_async_client=None):
+        self.api = api  # APIClients (モデル・キャッシュ・バケツ・再試行の設定を共有する)
+        self.timeout = timeout
+        self.gemini_slots = asyncio.Semaphore(max_concurrency)
+        self.vision_slots = asyncio.Semaphore(vision_concurrency)
+        # 本物の Vision クライアントなら、非同期クライアントをループの中で初めて使うときに作る
+        self.vision_async_client = vision_async_client
+        self._native_vision = vision_async_client is None and isinstance(api.vision_client, vision.ImageAnnotatorClient)
+        self._label_tasks = {}  # 画像の digest -> 実行中のラベル取得 (同じ写真の同時リクエストは1回にまとめる)
+        self._first_turns = {}  # キャッシュのキー -> 実行中の1ターン目 (同じプロンプトは1回だけ送る)
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.calls = 0
+        self.timeouts = 0
+        self.retries = 0
+
+    def stats(self):
+        return {"calls": self.calls, "in_flight": self.in_flight, "peak_in_flight": self.peak_in_flight,
+                "timeouts": self.timeouts, "retries": self.retries}
+
+    async def _call(self, bucket, slots, make_coro, timeout=None, what="API", retry_timeouts=True):
+        """レート制限 → 同時実行数の制限 → タイムアウト付きで実行し、一時的なエラーは再試行する。
+        retry_timeouts=False なら打ち切りは再試行しない (スレッドで動いている呼び出しは止められないため)。"""
+        timeout = self.timeout if timeout is None else timeout
+        policy = self.api.retry_policy
+        attempt = 0
+        while True:
+            try:
+                waited = await bucket.acquire_async()
+                if waited > 0:
+                    print(f"[DEBUG] Rate limiter: waited {waited:.1f}s")
+                async with slots:
+                    self.calls += 1
+                    self.in_flight += 1
+                    self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+                    try:
+                        return await asyncio.wait_for(make_coro(), timeout)
+                    except asyncio.TimeoutError:
+                        self.timeouts += 1
+                        raise TimeoutError(f"{what} call timed out after {timeout:g}s") from None
+                    finally:
+                        self.in_flight -= 1
+            except Exception as e:
+                if isinstance(e, TimeoutError) and not retry_timeouts:
+                    raise
+                # サーバーに待ち時間を指定されたら、ほかの呼び出しもその間止める
+                delay = server_retry_delay(e)
+                if delay is not None and is_retryable(e):
+                    bucket.pause(delay)
+                wait_s = policy.next_delay(e, attempt)
+                if wait_s is None:
+                    raise
+                attempt += 1
+                self.retries += 1
+                print(f"[DEBUG] {what} error, retry {attempt}/{policy.max_retries} in {wait_s:.1f}s: {e}")
+                await asyncio.sleep(wait_s)
+
+    # --- Gemini ---
+    async def start_chat(self, history=None):
+        return self.api.start_chat(history=history)
+
+    async def _send_once(self, chat, prompt_parts, on_chunk):
+        send_async = getattr(chat, "send_message_async", None)
+        if send_async is None:
+            # 非同期の送信を持たないクライアント。スレッドで実行する (取り消しても送信自体は最後まで進む)
+            return await asyncio.to_thread(self.api.send_now, chat, prompt_parts, on_chunk)
+        if on_chunk is None:
+            return await send_async(prompt_parts)
+        resp = await send_async(prompt_parts, stream=True)
+        text = ""
+        async for chunk in resp:
+            try:
+                piece = chunk.text
+            except ValueError:
+                continue  # テキストを含まないチャンク (終了理由だけなど)
+            if piece:
+                text += piece
+                on_chunk(text)
+        await resp.resolve()  # 履歴 (chat.history) に応答を確定させる
+        return resp
+
+    async def send_message(self, chat, prompt_parts, on_chunk=None, timeout=None):
+        """APIClients.send のコルーチン版。on_chunk はイベントループのスレッドで呼ばれる。"""
+        before = list(chat.history)
+        attempts = 0
+
+        def attempt():
+            nonlocal attempts
+            if attempts:
+                # 前の試行の途中までの応答 (と同じ user ターン) を履歴から外してから送り直す
+                chat.history = list(before)
+            attempts += 1
+            return self._send_once(chat, prompt_parts, on_chunk)
+
+        # スレッドで送る場合、打ち切っても送信は続くので、同じチャットに重ねて送らない
+        threaded = getattr(chat, "send_message_async", None) is None
+        return await self._call(self.api.gemini_bucket, self.gemini_slots, attempt, timeout, "Gemini",
+                                retry_timeouts=not threaded)
+
+    async def generate_text(self, prompt_parts, image_hash=None):
+        key = self.api.response_key(prompt_parts, image_hash)
+        text = self.api.response_cache.get(key)
+        if text is not None:
+            print(f"[DEBUG] Gemini response from cache: {key[:12]}")
+            return text
+        text = (await self.send_message(self.api.start_chat(history=[]), prompt_parts)).text
+        self.api.response_cache.put(key, text)
+        return text
+
+    def _chat_with_reply(self, prompt_parts, text):
+        history = [{"role": "user", "parts": prompt_parts if isinstance(prompt_parts, list) else [prompt_parts]},
+                   {"role": "model", "parts": [text]}]
+        return self.api.start_chat(history=history)
+
+    async def _first_turn(self, key, chat, prompt_parts, on_chunk):
+        text = (await self.send_message(chat, prompt_parts, on_chunk=on_chunk)).text
+        self.api.response_cache.put(key, text)
+        return text
+
+    async def start_chat_cached(self, prompt_parts, image_hash=None, on_chunk=None):
+        key = self.api.response_key(prompt_parts, image_hash)
+        text = self.api.response_cache.get(key)
+        if text is not None:
+            print(f"[DEBUG] Gemini first turn from cache: {key[:12]}")
+            return self._chat_with_reply(prompt_parts, text), text
+        task = self._first_turns.get(key)
+        if task is not None:
+            # 同じ1ターン目を送っている最中なら、その応答を待って自分の履歴に入れる
+            text = await asyncio.shield(task)
+            print(f"[DEBUG] Gemini first turn shared with an in-flight request: {key[:12]}")
+            return self._chat_with_reply(prompt_parts, text), text
+        chat = self.api.start_chat(history=[])
+        task = asyncio.ensure_future(self._first_turn(key, chat, prompt_parts, on_chunk))
+        self._first_turns[key] = task
+        task.add_done_callback(lambda _: self._first_turns.pop(key, None))
+        return chat, await asyncio.shield(task)
+
+    # --- Vision ---
+    async def _detect_once(self, image_bytes):
+        if self.vision_async_client is None and self._native_vision:
+            self.vision_async_client = vision.ImageAnnotatorAsyncClient()
+        if self.vision_async_client is None:
+            image = vision.Image(content=image_bytes)
+            return await asyncio.to_thread(self.api.vision_client.label_detection, image=image)
+        request = vision.AnnotateImageRequest(image=vision.Image(content=image_bytes),
+                                              features=[vision.Feature(type_=vision.Feature.Type.LABEL_DETECTION)])
+        batch = await self.vision_async_client.batch_annotate_images(requests=[request])
+        return batch.responses[0]
+
+    async def _detect_labels(self, digest, image_bytes):
+        response = await self._call(self.api.vision_bucket, self.vision_slots,
+                                    lambda: self._detect_once(image_bytes), what="Vision")
+        if response.error.message:
+            raise Exception(response.error.message)
+        labels = [l.description for l in response.label_annotations]
+        self.api.label_cache.put(digest, labels)
+        return labels
+
+    async def local_labels(self, image_bytes: bytes):
+        # プロセスプールの Future を待つだけなので、ループもスレッドも止めない (待つ時間は同期版と同じ)
+        return await asyncio.wait_for(self.api.local_labeler.labels_async(image_bytes), LOCAL_LABELER_TIMEOUT)
+
+    async def label_detection(self, image_bytes: bytes):
+        digest = image_digest(image_bytes)
+        labels = self.api.label_cache.get(digest)
+        if labels is not None:
+            print(f"[DEBUG] Vision labels from cache: {digest[:12]}")
+            return labels
+        task = self._label_tasks.get(digest)
+        if task is None:
+            task = asyncio.ensure_future(self._detect_labels(digest, image_bytes))
+            self._label_tasks[digest] = task
+            task.add_done_callback(lambda _: self._label_tasks.pop(digest, None))
+        # 1人が取り消しても、同じ写真を待っているほかの呼び出しには結果を届ける
+        return await asyncio.shield(task)
+
+
+class AsyncLoopThread:
+    """イベントループを回す専用スレッド。submit() はどのスレッドからでも呼べる。"""
+
+    def __init__(self, name="api-loop"):
+        self.loop = asyncio.new_event_loop()
+        self._futures = {}  # scope -> 実行中の concurrent.futures.Future
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro, scope=None):
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        if scope is not None:
+            with self._lock:
+                self._futures.setdefault(scope, set()).add(future)
+            future.add_done_callback(lambda f: self._forget(scope, f))
+        return future
+
+    def _forget(self, scope, future):
+        with self._lock:
+            futures = self._futures.get(scope)
+            if futures is not None:
+                futures.discard(future)
+                if not futures:
+                    del self._futures[scope]
+
+    def cancel(self, scope):
+        """scope の呼び出しをすべて取り消す。取り消した数を返す。"""
+        with self._lock:
+            futures = self._futures.pop(scope, set())
+        for future in futures:
+            future.cancel()
+        return len(futures)
+
+    def stop(self, timeout=2.0):
+        with self._lock:
+            scopes = list(self._futures)
+        for scope in scopes:
+            self.cancel(scope)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
@@ -0,0 +1,105 @@
+# bench_history.py
+"""
+会話履歴の窓 (conversation_history.HistoryManager) の効果を見るベンチマーク。
+
+20ターンの会話を合成し、各ターンで Gemini に送るリクエストの大きさを
+  full     : 従来どおり全履歴 (1ターン目の写真とマスタープロンプトを含む) を送る
+  windowed : マスタープロンプト (固定の前置き) + 直近 K ターン + 古いターンの要約、写真は文字で参照
+で比べる。トークン数は estimate_tokens() の目安、バイト数は画像を Base64 で送る場合の概算。
+
+  python bench_history.py [turns] [keep_turns] [token_budget] [image_kb]
+"""
+import os, sys, time
+
+from conversation_history import HistoryManager, IMAGE_TOKENS, compact_inquiry_turn
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def master_prompt_text():
+    # 1ターン目のマスタープロンプト (prompt_master.txt があればそれを使う)
+    path = os.path.join(BASE_DIR, "prompt_master.txt")
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            return f.read()
+    return "You are an AI guide for inquiry-based English learning. " * 40
+
+
+def continue_prompt(user_reply):
+    # api_continue_conversation() と同じくらいの長さの指示文
+    return f"""
+The user's last reply was: "{user_reply}"
+The student's level is: CEFR A1.
+
+Continue the inquiry-based conversation.
+1. Briefly acknowledge their reply.
+2. Ask **one new, open-ended, inquiry-based question** to deepen their thinking (about **environment, social studies, or trivia**).
+3. Keep the conversation flowing and use **simple English, appropriate for CEFR A1**.
+- **Example (Social):** User: "Cars are fast." AI: "That's true! But what happens to a town when many cars are used?"
+- **Example (Env):** User: "I like trees." AI: "Trees are great! How do trees help keep the air clean?"
+
+Do not provide choices.
+
+CRITICAL: After your English response, you MUST provide a Japanese translation.
+Format it EXACTLY like this (with the [TRANSLATION] tag):
+
+(Your English response...)
+Do not provide choices.
+
+[TRANSLATION]
+(ここに日本語訳...)
+"""
+
+
+def model_reply(n):
+    return (f"That is a great idea! Dogs like to run in the park. Question {n}: "
+            "How do parks help animals and people in a city?\n\n[TRANSLATION]\n"
+            "いい考えだね！犬は公園で走るのが好きです。公園は街の動物や人をどのように助けているかな？")
+
+
+def request_bytes(history, prompt, image_kb):
+    size = len(prompt.encode("utf-8"))
+    for content in history:
+        for part in content["parts"]:
+            if isinstance(part, str):
+                size += len(part.encode("utf-8"))
+            else:
+                size += image_kb * 1024 * 4 // 3  # Base64
+    return size
+
+
+def main():
+    turns = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    keep_turns = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    token_budget = int(sys.argv[3]) if len(sys.argv) > 3 else 3000
+    image_kb = int(sys.argv[4]) if len(sys.argv) > 4 else 300
+
+    image = object()  # 画像パートの代わり (文字列以外なら何でもよい)
+    history = [{"role": "user", "parts": [master_prompt_text(), image]},
+               {"role": "model", "parts": [model_reply(0)]}]
+    manager = HistoryManager(keep_turns=keep_turns, token_budget=token_budget, compact=compact_inquiry_turn,
+                             pin_first_turn=True)
+    manager.context = "Topic keyword: dog. Photo labels: Dog, Grass, Park."
+
+    print(f"turns={turns} keep_turns={keep_turns} token_budget={token_budget} image={image_kb} KB "
+          f"(image = {IMAGE_TOKENS} tokens)")
+    print(f"{'turn':>4} | {'full tokens':>11} {'full bytes':>11} | {'win tokens':>10} {'win bytes':>10} | {'window ms':>9}")
+    total_full = total_win = 0
+    for n in range(1, turns):
+        prompt = continue_prompt(f"I think reply number {n} is about dogs and parks.")
+        full_tokens = HistoryManager.request_tokens(history, prompt)
+        t0 = time.perf_counter()
+        window = manager.window(history)
+        window_ms = (time.perf_counter() - t0) * 1000
+        win_tokens = HistoryManager.request_tokens(window, prompt)
+        total_full += full_tokens; total_win += win_tokens
+        print(f"{n + 1:>4} | {full_tokens:>11,} {request_bytes(history, prompt, image_kb):>11,} | "
+              f"{win_tokens:>10,} {request_bytes(window, prompt, image_kb):>10,} | {window_ms:>9.2f}")
+        history.append({"role": "user", "parts": [prompt]})
+        history.append({"role": "model", "parts": [model_reply(n)]})
+    print(f"\nTotal input tokens over {turns} turns: full {total_full:,} -> windowed {total_win:,} "
+          f"({total_win / max(1, total_full):.0%})")
+
+
+if __name__ == "__main__":
+    main()
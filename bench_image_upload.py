@@ -0,0 +1,84 @@
+# bench_image_upload.py
+"""
+画像の前処理 (image_preprocess) の前後で、API に送るバイト数と時間を比べるベンチマーク。
+
+  python bench_image_upload.py [photo.jpg ...] [--mbps 20] [--live]
+
+- 写真を指定しない場合は 4032x3024 の合成写真 (スマホ相当) を作って使う
+- 時間 = 前処理時間 + アップロード時間 (--mbps の回線速度で換算)
+- --live を付けると実際に Vision label_detection と Gemini の1ターン目を呼んで計測する
+  (GEMINI_API_KEY と GOOGLE_APPLICATION_CREDENTIALS が必要)
+"""
+import io, os, sys, time, random
+
+from config import IMAGE_MAX_EDGE, IMAGE_UPLOAD_FORMAT, IMAGE_UPLOAD_QUALITY, GEMINI_API_KEY, MODEL_NAME
+from image_preprocess import prepare_upload_image
+
+
+def make_synthetic_photo(width=4032, height=3024, quality=95):
+    from PIL import Image, ImageFilter
+    rnd = random.Random(0)
+    small = Image.new("RGB", (width // 16, height // 16))
+    small.putdata([(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256))
+                   for _ in range(small.width * small.height)])
+    img = small.resize((width, height), Image.BICUBIC).filter(ImageFilter.DETAIL)
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=quality)
+    return out.getvalue()
+
+
+def live_call(image_bytes):
+    import PIL.Image
+    import google.generativeai as genai
+    from google.cloud import vision
+
+    t0 = time.perf_counter()
+    client = vision.ImageAnnotatorClient()
+    client.label_detection(image=vision.Image(content=image_bytes))
+    t1 = time.perf_counter()
+
+    genai.configure(api_key=GEMINI_API_KEY)
+    model = genai.GenerativeModel(MODEL_NAME)
+    img = PIL.Image.open(io.BytesIO(image_bytes))
+    model.start_chat(history=[]).send_message(["Ask one simple question about this photo.", img])
+    t2 = time.perf_counter()
+    return t1 - t0, t2 - t1
+
+
+def main():
+    args = sys.argv[1:]
+    live = "--live" in args
+    mbps = 20.0
+    if "--mbps" in args:
+        mbps = float(args[args.index("--mbps") + 1])
+    paths = [a for i, a in enumerate(args) if not a.startswith("--") and (i == 0 or args[i - 1] != "--mbps")]
+
+    photos = [(os.path.basename(p), open(p, "rb").read()) for p in paths]
+    if not photos:
+        photos = [("synthetic 4032x3024", make_synthetic_photo())]
+
+    print(f"max_edge={IMAGE_MAX_EDGE} format={IMAGE_UPLOAD_FORMAT} quality={IMAGE_UPLOAD_QUALITY} uplink={mbps} Mbps")
+    for name, raw in photos:
+        t0 = time.perf_counter()
+        normalized = prepare_upload_image(raw, max_edge=IMAGE_MAX_EDGE, fmt=IMAGE_UPLOAD_FORMAT,
+                                          quality=IMAGE_UPLOAD_QUALITY)
+        prep_s = time.perf_counter() - t0
+
+        # Vision と Gemini の両方に送るのでアップロードは2回分
+        upload_before = 2 * len(raw) * 8 / (mbps * 1_000_000)
+        upload_after = 2 * len(normalized) * 8 / (mbps * 1_000_000)
+        print(f"\n[{name}]")
+        print(f"  bytes sent (x2 APIs): before {2 * len(raw):>10,}  after {2 * len(normalized):>10,}"
+              f"  ({len(normalized) / len(raw):.1%})")
+        print(f"  estimated time      : before {upload_before:8.2f}s  after {prep_s + upload_after:8.2f}s"
+              f"  (preprocess {prep_s * 1000:.0f} ms)")
+
+        if live:
+            v_before, g_before = live_call(raw)
+            v_after, g_after = live_call(normalized)
+            print(f"  live Vision         : before {v_before:8.2f}s  after {v_after:8.2f}s")
+            print(f"  live Gemini turn    : before {g_before:8.2f}s  after {g_after:8.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+# bench_labels.py
+"""
+ローカルのラベラー (local_labeler.py) を、記録済みの Cloud Vision のラベルと比べるベンチマーク。
+
+  python bench_labels.py [--dir photos --labels labels.json] [--limit 50] [--workers 1] [--live]
+
+- 写真と Vision のラベルの組:
+    --dir / --labels を付けた場合 : labels.json は {"ファイル名": ["Dog", "Grass", ...]} (Vision の出力を保存したもの)
+    付けない場合                  : プロファイルの保存済みテーマの写真。ラベルは Vision のキャッシュ (API_CACHE_FILE)
+                                    にあればそれを、なければテーマの all_labels を使う
+- 時間: プロセスプールの起動 + モデル読み込み (初回) と、1枚ごとの推論 (p50 / p95 / 最大)
+- 一致: 単語選択画面と同じ正規化 (小文字・カンマより前) をしてから
+    top1   : ローカルの1位が Vision の上位 k に入っている割合
+    overlap: ローカルの上位 k と Vision の上位 k の重なり (Vision 側の語数で割る)
+    picker : 単語選択画面の1つ目の語が同じになる割合
+- --live を付けると同じ写真で Cloud Vision も実際に呼び、レイテンシを並べる (GOOGLE_APPLICATION_CREDENTIALS が必要)
+"""
+import os, sys, json, time
+
+from config import (LOCAL_LABELER, LOCAL_LABELER_WORKERS, PROFILE_FILE, API_CACHE_FILE, VISION_LABEL_CACHE_TTL,
+                    VISION_LABEL_CACHE_MAX)
+from local_labeler import LabelerPool, labeler_options
+
+TOP_K = 5
+
+
+def normalize(labels, k=TOP_K):
+    words = []
+    for lab in labels or []:
+        w = str(lab).replace("_", " ").split(",")[0].strip().lower()
+        if w and w not in words:
+            words.append(w)
+    return words[:k]
+
+
+def samples_from_dir(folder, labels_path):
+    with open(labels_path, "r", encoding="utf-8") as f:
+        recorded = json.load(f)
+    samples = []
+    for name, labels in sorted(recorded.items()):
+        path = os.path.join(folder, name)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                samples.append((name, f.read(), labels))
+    return samples
+
+
+def samples_from_profile():
+    from api_cache import DiskCache
+    from user_profile import UserProfile
+    profile = UserProfile(PROFILE_FILE)
+    cache = DiskCache(API_CACHE_FILE, "vision_labels", ttl=VISION_LABEL_CACHE_TTL, max_entries=VISION_LABEL_CACHE_MAX)
+    samples = []
+    try:
+        for theme in profile.get("theme_history") or []:
+            image = profile.images.get(theme.image_hash) if theme.image_hash else None
+            labels = cache.get(theme.image_hash) or theme.all_labels
+            if image and labels:
+                samples.append((theme.title or theme.image_hash[:12], image, labels))
+    finally:
+        profile.close()
+    return samples
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def live_vision(image_bytes):
+    from google.cloud import vision
+    t0 = time.perf_counter()
+    vision.ImageAnnotatorClient().label_detection(image=vision.Image(content=image_bytes))
+    return time.perf_counter() - t0
+
+
+def main():
+    args = sys.argv[1:]
+
+    def option(name, default):
+        return args[args.index(name) + 1] if name in args else default
+
+    live = "--live" in args
+    limit = int(option("--limit", "50"))
+    workers = int(option("--workers", str(LOCAL_LABELER_WORKERS)))
+    if "--dir" in args:
+        samples = samples_from_dir(option("--dir", "."), option("--labels", "labels.json"))
+    else:
+        samples = samples_from_profile()
+    samples = samples[:limit]
+    if not samples:
+        print("No photos with recorded Vision labels. Use --dir/--labels or save some themes first.")
+        return
+    if not LOCAL_LABELER:
+        print("Set LOCAL_LABELER (e.g. opencv-dnn) and LOCAL_LABELER_MODEL / LOCAL_LABELER_CLASSES.")
+        return
+
+    pool = LabelerPool(LOCAL_LABELER, labeler_options(), workers=workers)
+    try:
+        t0 = time.perf_counter()
+        for future in pool.warm_up():
+            future.result()
+        startup = time.perf_counter() - t0
+
+        times, top1, overlap, picker, vision_times = [], [], [], [], []
+        for name, image, recorded in samples:
+            t0 = time.perf_counter()
+            local = pool.labels(image)
+            times.append(time.perf_counter() - t0)
+            ours, theirs = normalize(local), normalize(recorded)
+            top1.append(bool(ours) and ours[0] in theirs)
+            overlap.append(len(set(ours) & set(theirs)) / max(1, len(theirs)))
+            picker.append(bool(ours) and bool(theirs) and ours[0] == theirs[0])
+            if live:
+                vision_times.append(live_vision(image))
+            print(f"[{name}] {times[-1] * 1000:6.0f} ms  local={ours}  vision={theirs}")
+
+        # 並列に投げたときの1枚あたり
+        t0 = time.perf_counter()
+        for future in [pool.submit(image) for _, image, _ in samples]:
+            future.result()
+        batch = (time.perf_counter() - t0) / len(samples)
+    finally:
+        pool.shutdown()
+
+    n = len(samples)
+    print(f"\nlabeler={LOCAL_LABELER} workers={workers} photos={n} top_k={TOP_K}")
+    print(f"startup (spawn + model load): {startup:.2f}s")
+    print(f"local latency  : p50 {percentile(times, 50) * 1000:.0f} ms  p95 {percentile(times, 95) * 1000:.0f} ms"
+          f"  max {max(times) * 1000:.0f} ms  (batched {batch * 1000:.0f} ms/photo)")
+    if vision_times:
+        print(f"vision latency : p50 {percentile(vision_times, 50) * 1000:.0f} ms"
+              f"  p95 {percentile(vision_times, 95) * 1000:.0f} ms  max {max(vision_times) * 1000:.0f} ms")
+    print(f"agreement      : top1 {sum(top1) / n:.1%}  overlap@{TOP_K} {sum(overlap) / n:.1%}"
+          f"  same first word {sum(picker) / n:.1%}")
+
+
+if __name__ == "__main__":
+    main()
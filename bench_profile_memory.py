@@ -0,0 +1,126 @@
+# bench_profile_memory.py
+"""
+プロファイル読み込み時のメモリ使用量 (peak RSS) を比較するベンチマーク。
+
+合成した 1,000 テーマの旧形式 profile.json (Base64 画像入り) を作り、
+それぞれ別プロセスで読み込んで peak RSS (VmHWM または ru_maxrss) を表示する。
+
+  legacy       : v21.1 の UserProfile.load() と同じ読み方 (Base64 と bytes を両方保持)
+  migrate      : 初回起動時の画像ストアへの移行 + SQLite への取り込み (一回だけ)
+  lean-json    : 移行後の profile.json を UserProfile (JSON) で読み込み
+  lean-sqlite  : 移行後の profile.db を UserProfile (SQLite) で読み込み
+
+使い方:
+  python bench_profile_memory.py [themes] [image_kb]
+"""
+import os, sys, json, base64, random, resource, shutil, subprocess, tempfile
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def peak_rss_mb():
+    # Linux では ru_maxrss が exec 前の親プロセスの値を引き継ぐことがあるので VmHWM を優先する
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)  # macOS は bytes
+    return peak / 1024  # Linux は KB
+
+
+def make_legacy_profile(path, themes, image_kb):
+    rnd = random.Random(0)
+    history = []
+    for i in range(themes):
+        image_bytes = rnd.randbytes(image_kb * 1024)
+        sessions = {}
+        for word in ("dog", f"word{i}"):
+            sessions[word] = {
+                "story": f"The <{word}> runs in the park. " * 5,
+                "story_translation": "犬が公園を走ります。" * 5,
+                "quizzes": [{"q": f"Question {n} about {word}?", "c": ["True", "False"], "a": "True", "type": "True/False"}
+                            for n in range(6)],
+                "user_answers": ["True"] * 6,
+            }
+        history.append({
+            "title": f"theme {i}",
+            "image_data_b64": base64.b64encode(image_bytes).decode("utf-8"),
+            "all_labels": ["Dog", "Grass", "Park", "Tree"],
+            "word_sessions": sessions,
+        })
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"grade": "3-4年生", "current_level": "CEFR A1", "coins": 0, "theme_history": history}, f)
+
+
+def legacy_load(path):
+    # v21.1 の UserProfile.load() と同じ (image_data_b64 を消さずに残す)
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    for theme in data["theme_history"]:
+        if "image_data_b64" in theme:
+            theme["image_data"] = base64.b64decode(theme["image_data_b64"])
+    return data
+
+
+def child(mode, work_dir, themes=0, image_kb=0):
+    if mode == "make":
+        make_legacy_profile(os.path.join(work_dir, "profile.json"), themes, image_kb)
+        return
+
+    sys.path.insert(0, BASE_DIR)
+    from user_profile import UserProfile
+
+    profile_json = os.path.join(work_dir, "profile.json")
+    profile_db = os.path.join(work_dir, "profile.db")
+    image_dir = os.path.join(work_dir, "image_store")
+    if mode == "baseline":
+        data = {"theme_history": []}
+    elif mode == "legacy":
+        data = legacy_load(profile_json)
+    elif mode == "migrate":
+        data = UserProfile(profile_json, image_store_dir=image_dir, backend="sqlite", db_path=profile_db).data
+    elif mode == "lean-json":
+        data = UserProfile(profile_json, image_store_dir=image_dir, backend="json").data
+    elif mode == "lean-sqlite":
+        data = UserProfile(profile_json, image_store_dir=image_dir, backend="sqlite", db_path=profile_db).data
+    else:
+        raise ValueError(mode)
+    print(json.dumps({"themes": len(data["theme_history"]), "peak_rss_mb": round(peak_rss_mb(), 1)}))
+
+
+def run_child(mode, work_dir, *extra):
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", mode, work_dir, *map(str, extra)],
+                         capture_output=True, text=True, check=True).stdout
+    lines = out.strip().splitlines()
+    return json.loads(lines[-1]) if lines else None
+
+
+def main():
+    themes = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    image_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+
+    work_dir = tempfile.mkdtemp(prefix="bench_profile_")
+    try:
+        profile_json = os.path.join(work_dir, "profile.json")
+        run_child("make", work_dir, themes, image_kb)  # 親プロセスのメモリを増やさないよう別プロセスで作る
+        size_mb = os.path.getsize(profile_json) / (1024 * 1024)
+        print(f"Synthetic profile: {themes} themes, {image_kb} KB/image, profile.json = {size_mb:.1f} MB")
+
+        # legacy は移行前のファイルを読むので最初に実行する
+        for mode in ("baseline", "legacy", "migrate", "lean-json", "lean-sqlite"):
+            result = run_child(mode, work_dir)
+            print(f"  {mode:<12} themes={result['themes']:<5} peak RSS = {result['peak_rss_mb']:8.1f} MB")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        child(sys.argv[2], sys.argv[3], *map(int, sys.argv[4:]))
+    else:
+        main()
@@ -0,0 +1,192 @@
+# bench_server.py
+"""
+inquiry_server.py の負荷試験。偽の Gemini / Vision (fake_backend) でサーバーを同じプロセス内に立て、
+生徒 N 人が同時に 写真 → 会話開始 → 返答 x T → ストーリー → クイズ → 回答 → テーマ保存 を進める。
+
+  python bench_server.py [--students 30] [--turns 3] [--photos 5] [--latency 0.8] [--workers 16]
+                         [--think 0] [--url http://host:port] [--async-api]
+
+  - --photos 枚の写真を生徒で使い回すので、同じ写真 + キーワードの1ターン目と Vision ラベルは共有キャッシュに当たる
+  - --url を付けると、別に起動したサーバー (python inquiry_server.py --fake など) に対して負荷をかける
+  - エンドポイントごとの p50 / p95 / 最大レイテンシ、1セッションの所要時間、スレッド数、キャッシュの効きを表示する
+  - --async-api で API 呼び出しを AsyncAPIClients (スレッドなし) に切り替え、API 用スレッド数を比べられる
+レート制限は偽バックエンドでは意味がないので、GEMINI_RPM などは環境変数がなければ大きな値にしておく。
+"""
+import io, os, json, time, base64, random, asyncio, argparse, tempfile, threading
+
+_TMP = tempfile.mkdtemp(prefix="bench_server_")
+os.environ.setdefault("GEMINI_RPM", "100000")
+os.environ.setdefault("GEMINI_BURST", "1000")
+os.environ.setdefault("VISION_RPM", "100000")
+os.environ.setdefault("VISION_BURST", "1000")
+os.environ.setdefault("API_CACHE_FILE", os.path.join(_TMP, "api_cache.db"))
+
+from inquiry_server import InquiryService, percentile  # noqa: E402 (環境変数を設定してから読み込む)
+
+
+def make_photos(count, size=(640, 480)):
+    from PIL import Image
+    photos = []
+    for n in range(count):
+        rnd = random.Random(n)
+        img = Image.new("RGB", size, (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)))
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=85)
+        photos.append(base64.b64encode(out.getvalue()).decode("ascii"))
+    return photos
+
+
+class Client:
+    """keep-alive で1本の接続を使い回す、最小限の JSON HTTP クライアント。"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+
+    async def request(self, method, path, payload=None):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+        self.writer.write((f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+                           f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n").encode("latin-1")
+                          + body)
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value)
+        data = await self.reader.readexactly(length) if length else b"{}"
+        return status, json.loads(data)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+
+
+async def run_student(n, host, port, photos, args, timings, errors):
+    client = Client(host, port)
+    base = f"/students/student{n:03d}"
+
+    async def step(name, method, path, payload=None):
+        t0 = time.perf_counter()
+        status, body = await client.request(method, path, payload)
+        timings.setdefault(name, []).append(time.perf_counter() - t0)
+        if status != 200:
+            errors.append(f"{name}: {status} {body.get('error')}")
+            raise RuntimeError(body.get("error"))
+        if args.think:
+            await asyncio.sleep(random.uniform(0, args.think))
+        return body
+
+    t0 = time.perf_counter()
+    try:
+        photo = await step("photo", "POST", f"{base}/photo", {"image": photos[n % len(photos)]})
+        await step("inquiry", "POST", f"{base}/inquiry", {"keyword": photo["words"][0]})
+        for turn in range(args.turns):
+            await step("reply", "POST", f"{base}/reply", {"text": f"I think it is about parks ({turn})."})
+        await step("story", "POST", f"{base}/story", {})
+        quizzes = (await step("quizzes", "POST", f"{base}/quizzes", {}))["quizzes"]
+        for quiz in quizzes:
+            await step("answer", "POST", f"{base}/answer", {"answer": quiz["choices"][0]})
+        await step("theme", "POST", f"{base}/theme", {})
+        timings.setdefault("session (total)", []).append(time.perf_counter() - t0)
+    except Exception:
+        pass
+    finally:
+        await client.close()
+
+
+async def main_async(args):
+    photos = make_photos(args.photos)
+    service = server = None
+    if args.url:
+        host, _, port = args.url.split("://", 1)[-1].rstrip("/").partition(":")
+        port = int(port or 80)
+    else:
+        from fake_backend import FakeGenerativeModel, FakeVisionClient, FakeVisionAsyncClient
+        from api_clients import APIClients
+        model = FakeGenerativeModel(latency=args.latency, seed=0)
+        vision = FakeVisionClient(latency=args.latency / 2)
+        api = APIClients(gemini_model=model, vision_client=vision)
+        aapi = None
+        if args.async_api:
+            from async_api_clients import AsyncAPIClients
+            vision = FakeVisionAsyncClient(latency=args.latency / 2)
+            # 同時に出せる数はスレッド版の --workers とそろえる
+            aapi = AsyncAPIClients(api, max_concurrency=args.workers, vision_concurrency=args.workers,
+                                   vision_async_client=vision)
+        service = InquiryService(api, data_dir=os.path.join(_TMP, "students"), workers=args.workers, aapi=aapi)
+        server = await service.start("127.0.0.1", 0)
+        host, port = "127.0.0.1", server.sockets[0].getsockname()[1]
+
+    timings, errors = {}, []
+    peak_threads = threading.active_count()
+    peak_executor_threads = 0
+
+    async def watch_threads():
+        nonlocal peak_threads, peak_executor_threads
+        while True:
+            peak_threads = max(peak_threads, threading.active_count())
+            executor_threads = sum(1 for t in threading.enumerate() if t.name.startswith(("inquiry-api", "asyncio_")))
+            peak_executor_threads = max(peak_executor_threads, executor_threads)
+            await asyncio.sleep(0.05)
+
+    watcher = asyncio.ensure_future(watch_threads())
+    t0 = time.perf_counter()
+    await asyncio.gather(*(run_student(n, host, port, photos, args, timings, errors) for n in range(args.students)))
+    wall = time.perf_counter() - t0
+    watcher.cancel()
+
+    metrics_client = Client(host, port)
+    _, metrics = await metrics_client.request("GET", "/metrics")
+    await metrics_client.close()
+
+    print(f"students={args.students} turns={args.turns} photos={args.photos} fake latency={args.latency}s "
+          f"workers={args.workers}{' async-api' if args.async_api else ''}{' url=' + args.url if args.url else ''}")
+    print(f"{'endpoint':<16} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}")
+    for name, values in sorted(timings.items()):
+        print(f"{name:<16} {len(values):>6} {percentile(values, 50) * 1000:>8.0f} "
+              f"{percentile(values, 95) * 1000:>8.0f} {max(values) * 1000:>8.0f}")
+    completed = len(timings.get("session (total)", []))
+    requests = sum(len(v) for k, v in timings.items() if k != "session (total)")
+    print(f"\ncompleted sessions: {completed}/{args.students} in {wall:.1f}s "
+          f"({requests / wall:.1f} req/s, {completed / wall * 60:.1f} sessions/min)")
+    print(f"errors: {len(errors)}" + (f" (first: {errors[0]})" if errors else ""))
+    print(f"peak threads in this process: {peak_threads} (executor threads: {peak_executor_threads})")
+    print(f"gemini cache: {metrics['gemini_cache']}")
+    print(f"vision cache: {metrics['vision_cache']}")
+    if metrics.get("async_api"):
+        print(f"async api: {metrics['async_api']}")
+    if service is not None:
+        print(f"fake model calls: {model.calls}, fake vision calls: {vision.calls}")
+        server.close()
+        await server.wait_closed()
+        await service.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for inquiry_server.py with a fake model backend")
+    parser.add_argument("--students", type=int, default=30)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--photos", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.8, help="fake Gemini latency (s)")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--think", type=float, default=0.0, help="max think time between steps (s)")
+    parser.add_argument("--url", default="", help="run against an already running server")
+    parser.add_argument("--async-api", action="store_true", help="use AsyncAPIClients instead of worker threads")
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
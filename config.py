@@ -11,3 +11,95 @@ SERVICE_ACCOUNT_KEY_PATH = os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "service_
 
 # その他
 PROFILE_FILE = os.getenv("PROFILE_FILE", "profile.json")
+
+# 画像ストア (SHA-256 をキーにした画像ファイルの保存先)
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "image_store")
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", "16"))  # メモリに残す画像の最大件数 (LRU)
+# テーマ一覧の1ページの件数 (0 = ページ分けしない。仮想化したリストだけで表示する)
+THEME_PAGE_SIZE = int(os.getenv("THEME_PAGE_SIZE", "0"))
+
+# プロファイルの保存形式: "sqlite" (変更行のみ書き込み) / "journal" (profile.json + 追記ジャーナル)
+#                         / "json" (従来の profile.json)
+PROFILE_BACKEND = os.getenv("PROFILE_BACKEND", "sqlite")
+PROFILE_DB_FILE = os.getenv("PROFILE_DB_FILE", "profile.db")
+PROFILE_WRITE_DELAY = float(os.getenv("PROFILE_WRITE_DELAY", "0.5"))  # 保存要求をまとめる待ち時間 (秒)
+PROFILE_JOURNAL_MAX_BYTES = int(os.getenv("PROFILE_JOURNAL_MAX_BYTES", str(256 * 1024)))  # これを超えたら圧縮
+
+# アップロード前の画像の正規化 (長辺の最大ピクセル数 / "JPEG" or "WEBP" / 品質)
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1600"))
+IMAGE_UPLOAD_FORMAT = os.getenv("IMAGE_UPLOAD_FORMAT", "JPEG")
+IMAGE_UPLOAD_QUALITY = int(os.getenv("IMAGE_UPLOAD_QUALITY", "85"))
+
+# API 応答キャッシュ (Vision ラベルなど)
+API_CACHE_FILE = os.getenv("API_CACHE_FILE", "api_cache.db")
+VISION_LABEL_CACHE_TTL = int(os.getenv("VISION_LABEL_CACHE_TTL", str(30 * 24 * 3600)))  # 秒
+VISION_LABEL_CACHE_MAX = int(os.getenv("VISION_LABEL_CACHE_MAX", "2000"))  # 件数
+GEMINI_CACHE_TTL = int(os.getenv("GEMINI_CACHE_TTL", str(7 * 24 * 3600)))  # 秒
+GEMINI_CACHE_MAX = int(os.getenv("GEMINI_CACHE_MAX", "1000"))  # 件数
+GEMINI_CACHE_BYPASS = os.getenv("GEMINI_CACHE_BYPASS", "0") == "1"  # 1 にするとキャッシュを使わない
+
+# API のレート制限 (1分あたりの呼び出し数 / 同時に送れる数) とリトライ
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "15"))
+GEMINI_BURST = int(os.getenv("GEMINI_BURST", "3"))
+VISION_RPM = int(os.getenv("VISION_RPM", "600"))
+VISION_BURST = int(os.getenv("VISION_BURST", "5"))
+# BACKGROUND の仕事が使わずに残しておくトークン数 (生徒が待つ呼び出しがバックグラウンド生成の後ろで待たないように)
+GEMINI_INTERACTIVE_RESERVE = int(os.getenv("GEMINI_INTERACTIVE_RESERVE", "1"))
+VISION_INTERACTIVE_RESERVE = int(os.getenv("VISION_INTERACTIVE_RESERVE", "1"))
+API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "4"))
+API_BACKOFF_BASE = float(os.getenv("API_BACKOFF_BASE", "1.0"))  # 秒
+API_BACKOFF_MAX = float(os.getenv("API_BACKOFF_MAX", "30"))  # 秒
+API_RETRY_BUDGET = int(os.getenv("API_RETRY_BUDGET", "10"))  # 1分あたりの再試行回数 (アプリ全体)
+
+# API 呼び出し用ワーカースレッド数 (2以上。BACKGROUND の仕事が同時に使える数は API_BACKGROUND_WORKERS まで)
+API_WORKERS = int(os.getenv("API_WORKERS", "4"))
+API_BACKGROUND_WORKERS = int(os.getenv("API_BACKGROUND_WORKERS", "2"))
+
+# Gemini の応答を届いた分から画面に表示する (0 で従来どおり全文を待ってから表示)
+GEMINI_STREAMING = os.getenv("GEMINI_STREAMING", "1") == "1"
+
+# ローカルのラベラー (local_labeler.py): Cloud Vision を待たずにオフラインで写真のラベルを作る
+#   LOCAL_LABELER: "" で使わない / "opencv-dnn" (cv2.dnn の画像分類モデル) / "module:Class" (独自のラベラー)
+LOCAL_LABELER = os.getenv("LOCAL_LABELER", "")
+LOCAL_LABELER_MODEL = os.getenv("LOCAL_LABELER_MODEL", os.path.join("models", "labeler.onnx"))
+LOCAL_LABELER_CONFIG = os.getenv("LOCAL_LABELER_CONFIG", "")  # Caffe の .prototxt など (ONNX なら不要)
+LOCAL_LABELER_CLASSES = os.getenv("LOCAL_LABELER_CLASSES", os.path.join("models", "labeler_classes.txt"))
+LOCAL_LABELER_INPUT_SIZE = int(os.getenv("LOCAL_LABELER_INPUT_SIZE", "224"))
+LOCAL_LABELER_MEAN = os.getenv("LOCAL_LABELER_MEAN", "0.485,0.456,0.406")  # 0-1 の RGB に対する値
+LOCAL_LABELER_STD = os.getenv("LOCAL_LABELER_STD", "0.229,0.224,0.225")
+LOCAL_LABELER_TOP_K = int(os.getenv("LOCAL_LABELER_TOP_K", "10"))
+LOCAL_LABELER_MIN_SCORE = float(os.getenv("LOCAL_LABELER_MIN_SCORE", "0.02"))
+LOCAL_LABELER_WORKERS = int(os.getenv("LOCAL_LABELER_WORKERS", "1"))  # プロセス数 (それぞれがモデルを読み込む)
+LOCAL_LABELER_TIMEOUT = float(os.getenv("LOCAL_LABELER_TIMEOUT", "20"))  # 秒 (初回はモデルの読み込みを含む)
+# ローカルのラベルで始めたあと、裏で Cloud Vision のラベルも取り、届いたら差し替える (0 で Vision を呼ばない)
+VISION_REFINE = os.getenv("VISION_REFINE", "1") == "1"
+
+# API 呼び出しを専用スレッドのイベントループ (async_api_clients.py) で実行する (0 で従来どおりワーカースレッド)
+ASYNC_API = os.getenv("ASYNC_API", "0") == "1"
+API_MAX_CONCURRENCY = int(os.getenv("API_MAX_CONCURRENCY", "8"))  # Gemini に同時に出す呼び出しの上限
+VISION_MAX_CONCURRENCY = int(os.getenv("VISION_MAX_CONCURRENCY", "8"))  # Vision に同時に出す呼び出しの上限
+API_TIMEOUT = float(os.getenv("API_TIMEOUT", "60"))  # 1回の呼び出しのタイムアウト (秒)。超えたら再試行する
+
+# ストーリー・訳・クイズを1回の呼び出し (JSON) でまとめて作る (0 で従来の2回呼び出し)
+COMBINED_STORY_QUIZ = os.getenv("COMBINED_STORY_QUIZ", "1") == "1"
+
+# パイプライン開始: Vision のラベルと Gemini のキーワード候補を同時に取り、いちばん選ばれそうな
+# キーワードの1ターン目を先に作っておく (選ばれなかった分は応答キャッシュに残るだけ)。1 で有効
+PIPELINED_START = os.getenv("PIPELINED_START", "0") == "1"
+PIPELINED_SHORTLIST = int(os.getenv("PIPELINED_SHORTLIST", "5"))  # Gemini に出してもらうキーワード候補の数
+
+# タグの選択肢と次のミッションを1回の呼び出し (JSON) でまとめて作る (0 で従来の2回呼び出し)
+COMBINED_NEXT_STEPS = os.getenv("COMBINED_NEXT_STEPS", "1") == "1"
+
+# 会話履歴の窓: 直近のターン数はそのまま送り、古いターンは要約にまとめる (トークン数は目安)
+HISTORY_KEEP_TURNS = int(os.getenv("HISTORY_KEEP_TURNS", "4"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+HISTORY_SUMMARY_MAX_CHARS = int(os.getenv("HISTORY_SUMMARY_MAX_CHARS", "1500"))
+
+# サーバーモード (inquiry_server.py): 1つのプロセスでクラス全員のセッションを受け持つ
+SERVER_HOST = os.getenv("SERVER_HOST", "127.0.0.1")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "8080"))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "16"))  # API 呼び出しを実行するスレッド数 (全生徒で共有)
+SERVER_DATA_DIR = os.getenv("SERVER_DATA_DIR", "students")  # 生徒ごとのプロファイルの保存先
+SERVER_SESSION_TTL = int(os.getenv("SERVER_SESSION_TTL", "1800"))  # 使われていないセッションを閉じるまでの秒数
+SERVER_MAX_BODY = int(os.getenv("SERVER_MAX_BODY", str(10 * 1024 * 1024)))  # リクエスト本文の上限 (バイト)
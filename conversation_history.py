@@ -0,0 +1,176 @@
+# conversation_history.py
+"""
+Gemini に送る会話履歴の窓 (window) を作る。
+
+毎ターン全履歴 (1ターン目の写真とマスタープロンプトを含む) を送ると、
+ターンが進むごとに入力トークンと待ち時間が増える。そこで
+  - 直近 keep_turns ターン (user + model の組) はそのまま送る
+  - それより古いターンは1行ずつに縮めて「これまでの要約」にまとめる (rolling summary)
+  - 画像は1ターン目にだけ送り、以降は文字での参照 (キーワード・ラベル・画像ハッシュ) に置き換える
+  - 全体が token_budget を超えたら、古いターンから要約へ回し、要約も古い行から削る
+  - pin_first_turn=True なら1ターン目の user (マスタープロンプト = 進め方・形式の指示) は
+    固定の前置きとして毎回そのまま送る。token_budget はこの前置きを除いた部分に対する上限
+
+履歴は genai の Content (role / parts) でも {"role": ..., "parts": [...]} の dict でもよい。
+返す窓は dict のリストなので、そのまま start_chat(history=...) に渡せる。
+"""
+import re
+
+IMAGE_TOKENS = 258  # Gemini が画像1枚に数えるトークン数 (目安)
+IMAGE_REFERENCE = "[The photo was shown in the first turn.]"
+
+
+def estimate_tokens(text):
+    """おおよそのトークン数。英数字は4文字で1、日本語などは1文字で1と数える。"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+
+def _parts_of(content):
+    if isinstance(content, dict):
+        return content.get("role", "user"), list(content.get("parts") or [])
+    parts = []
+    for part in content.parts:
+        text = getattr(part, "text", "")
+        parts.append(text if text else part)  # テキスト以外 (inline_data の画像など) はそのまま
+    return content.role, parts
+
+
+def strip_translation(text):
+    """[TRANSLATION] 以降と CHOICES: 行を落とした英文だけを返す。"""
+    text = text.split("[TRANSLATION]", 1)[0]
+    text = re.sub(r"CHOICES:.*", "", text, flags=re.IGNORECASE)
+    return text.strip()
+
+
+def compact_text(role, text, max_chars=160):
+    """要約に入れるための1行。空白をまとめて max_chars で切る。"""
+    if role == "model":
+        text = strip_translation(text)
+    text = " ".join(text.split())
+    if len(text) > max_chars:
+        text = text[:max_chars - 3].rstrip() + "..."
+    return text
+
+
+def compact_inquiry_turn(role, text):
+    """api_continue_conversation() の履歴用。user のターンは生徒の返答だけを残し、指示文は入れない。"""
+    if role == "user":
+        m = re.search(r'The user\'s last reply was: "(.*?)"\n', text, re.S)
+        return compact_text(role, m.group(1)) if m else ""
+    return compact_text(role, text)
+
+
+class HistoryManager:
+    def __init__(self, keep_turns=4, token_budget=3000, summary_max_chars=1500, compact=None, pin_first_turn=False):
+        self.keep_turns = max(1, keep_turns)
+        self.token_budget = token_budget
+        self.summary_max_chars = summary_max_chars
+        self.compact = compact or compact_text  # (role, text) -> 1行 (空文字なら要約に入れない)
+        self.pin_first_turn = pin_first_turn
+        self.context = ""  # 写真の代わりに要約の先頭に置く情報 (キーワード・ラベルなど)
+        self.image_hash = None  # 1ターン目の写真のハッシュ (参照の文に入れる)
+
+    def _turns(self, history):
+        """履歴を (user, model) の組に分ける。最後に model のない user があればそれも1組にする。"""
+        turns, current = [], []
+        for content in history or []:
+            role, parts = _parts_of(content)
+            if role == "user" and current:
+                turns.append(current)
+                current = []
+            current.append((role, parts))
+        if current:
+            turns.append(current)
+        return turns
+
+    def _image_reference(self):
+        if self.image_hash:
+            return f"[The photo (id {self.image_hash[:12]}) was shown in the first turn.]"
+        return IMAGE_REFERENCE
+
+    def _drop_images(self, parts):
+        out, had_image = [], False
+        for part in parts:
+            if isinstance(part, str):
+                out.append(part)
+            elif not had_image:
+                out.append(self._image_reference())
+                had_image = True
+        return out
+
+    def _turn_tokens(self, turn):
+        return sum(estimate_tokens(p) if isinstance(p, str) else IMAGE_TOKENS
+                   for _, parts in turn for p in parts)
+
+    def _summary_lines(self, turns):
+        lines = []
+        for turn in turns:
+            for role, parts in turn:
+                text = " ".join(p for p in parts if isinstance(p, str))
+                line = self.compact(role, text)
+                if line:
+                    lines.append(f"{'Student' if role == 'user' else 'AI'}: {line}")
+        return lines
+
+    def _summary_text(self, lines):
+        header = "Summary of our conversation so far (older turns are shortened):"
+        if self.context:
+            header = f"{self.context}\n{header}"
+        return header + "\n" + "\n".join(lines)
+
+    def window(self, history):
+        """送る履歴 (dict のリスト) を返す。"""
+        turns = self._turns(history)
+        turns = [[(role, self._drop_images(parts)) for role, parts in turn] for turn in turns]
+
+        # 1ターン目の指示文は予算で削らない前置きにする (残りは model の返答だけのターンとして扱う)
+        preamble = []
+        if self.pin_first_turn and turns and turns[0][0][0] == "user":
+            preamble = turns[0][0][1]
+            turns[0] = turns[0][1:]
+            if not turns[0]:
+                turns.pop(0)
+
+        recent = turns[-self.keep_turns:]
+        older = turns[:-self.keep_turns] if len(turns) > self.keep_turns else []
+        lines = self._summary_lines(older)
+
+        def total():
+            summary_tokens = estimate_tokens(self._summary_text(lines)) if (lines or self.context) else 0
+            return summary_tokens + sum(self._turn_tokens(t) for t in recent)
+
+        # 予算を超えたら、直近のターンを古いものから要約に回す (最後の1ターンは残す)
+        while self.token_budget and total() > self.token_budget and len(recent) > 1:
+            lines.extend(self._summary_lines([recent.pop(0)]))
+        # 要約の長さの上限と予算に収まるよう、要約の古い行から削る
+        while lines and (len("\n".join(lines)) > self.summary_max_chars
+                         or (self.token_budget and total() > self.token_budget)):
+            lines.pop(0)
+
+        window = []
+        has_summary = bool(lines or (self.context and older))
+        first_is_reply = bool(recent) and recent[0][0][0] == "model"
+        if preamble and first_is_reply:
+            # 1ターン目がまだ窓の中 (このときは要約もまだない): 前置き + その返答をそのまま送る
+            recent[0] = [("user", preamble)] + recent[0]
+        elif preamble or has_summary:
+            parts = list(preamble)
+            if has_summary:
+                parts.append(self._summary_text(lines))
+            window.append({"role": "user", "parts": parts})
+            window.append({"role": "model", "parts": ["OK. I will follow these instructions and continue from this summary."
+                                                      if preamble else "OK. I will continue from this summary."]})
+        for turn in recent:
+            for role, parts in turn:
+                window.append({"role": role, "parts": parts})
+        return window
+
+    @staticmethod
+    def request_tokens(history, prompt=""):
+        """history と次のプロンプトを送るときのおおよその入力トークン数 (ベンチマーク・ログ用)。"""
+        tokens = estimate_tokens(prompt) if prompt else 0
+        for content in history or []:
+            _, parts = _parts_of(content)
+            tokens += sum(estimate_tokens(p) if isinstance(p, str) else IMAGE_TOKENS for p in parts)
+        return tokens
@@ -0,0 +1,205 @@
+# fake_backend.py
+"""
+負荷試験用の偽の Gemini / Vision クライアント (ネットワークにも課金にも触れない)。
+
+APIClients(gemini_model=FakeGenerativeModel(), vision_client=FakeVisionClient()) のように差し込むと、
+キャッシュ・レート制限・再試行は本物の APIClients の処理をそのまま通る。
+  - 応答はプロンプトの種類 (会話 / ストーリー+クイズ JSON / クイズ JSON / 次のステップ JSON) に合わせた固定文
+  - latency 秒 (± jitter) 待ってから返す。error_rate の割合で 503 を投げる (再試行の確認用)
+  - stream=True なら数文字ずつのチャンクで返し、resolve() で履歴に確定する
+  - send_message_async / FakeVisionAsyncClient は待ち時間を asyncio.sleep にした非同期版 (AsyncAPIClients 用)
+"""
+import json, time, random, asyncio, hashlib, threading
+
+FAKE_LABELS = ["Dog", "Cat", "Tree", "Grass", "Car", "Book", "Flower", "House", "Sky", "Water",
+               "Bicycle", "Bird", "Food", "Park", "Street", "Plant"]
+
+
+class _Part:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeResponse:
+    def __init__(self, text, chunk_chars=24, chunk_delay=0.0, on_resolve=None):
+        self.text = text
+        self.parts = [_Part(text)]
+        self._chunk_chars = chunk_chars
+        self._chunk_delay = chunk_delay
+        self._on_resolve = on_resolve
+
+    def __iter__(self):
+        for i in range(0, len(self.text), self._chunk_chars):
+            if self._chunk_delay:
+                time.sleep(self._chunk_delay)
+            yield _Part(self.text[i:i + self._chunk_chars])
+
+    def resolve(self):
+        if self._on_resolve:
+            self._on_resolve()
+            self._on_resolve = None
+
+
+class FakeAsyncResponse(FakeResponse):
+    async def __aiter__(self):
+        for i in range(0, len(self.text), self._chunk_chars):
+            if self._chunk_delay:
+                await asyncio.sleep(self._chunk_delay)
+            yield _Part(self.text[i:i + self._chunk_chars])
+
+    async def resolve(self):
+        FakeResponse.resolve(self)
+
+
+class FakeChatSession:
+    def __init__(self, model, history):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, content, stream=False):
+        parts = content if isinstance(content, list) else [content]
+        text = self.model.respond(parts)
+        turn = [{"role": "user", "parts": parts}, {"role": "model", "parts": [text]}]
+        if stream:
+            delay = self.model.latency / 10
+            return FakeResponse(text, chunk_delay=delay, on_resolve=lambda: self.history.extend(turn))
+        self.history.extend(turn)
+        return FakeResponse(text)
+
+    async def send_message_async(self, content, stream=False):
+        parts = content if isinstance(content, list) else [content]
+        text = await self.model.respond_async(parts)
+        turn = [{"role": "user", "parts": parts}, {"role": "model", "parts": [text]}]
+        if stream:
+            delay = self.model.latency / 10
+            return FakeAsyncResponse(text, chunk_delay=delay, on_resolve=lambda: self.history.extend(turn))
+        self.history.extend(turn)
+        return FakeAsyncResponse(text)
+
+
+class FakeGenerativeModel:
+    def __init__(self, latency=0.8, jitter=0.3, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def start_chat(self, history=None):
+        return FakeChatSession(self, history)
+
+    def _draw(self):
+        with self._lock:
+            self.calls += 1
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            fail = self._random.random() < self.error_rate
+        return delay, fail
+
+    def respond(self, parts):
+        delay, fail = self._draw()
+        time.sleep(delay)
+        if fail:
+            raise RuntimeError("503 Service Unavailable (fake backend)")
+        return self.reply(parts)
+
+    async def respond_async(self, parts):
+        delay, fail = self._draw()
+        await asyncio.sleep(delay)
+        if fail:
+            raise RuntimeError("503 Service Unavailable (fake backend)")
+        return self.reply(parts)
+
+    def reply(self, parts):
+        prompt = "\n".join(p for p in parts if isinstance(p, str))
+        if '"story"' in prompt and '"quizzes"' in prompt:
+            return json.dumps({"story": fake_story(prompt), "translation": "犬は公園で走ります。",
+                               "quizzes": fake_quizzes(prompt)}, ensure_ascii=False)
+        if '"quizzes"' in prompt:
+            return json.dumps({"quizzes": fake_quizzes(prompt)})
+        if '"keywords"' in prompt:
+            return json.dumps({"keywords": ["dog", "park", "grass", "ball", "bench"]})
+        if 'TASK "tag"' in prompt:
+            return json.dumps({"tag": {"question": "Which word do you want to explore?", "choices": ["park", "grass", "ball"]},
+                               "mission": {"question": "What will you photograph next?", "choices": ["tree", "bird", "ホームに戻る"]}},
+                              ensure_ascii=False)
+        if "[TRANSLATION]" in prompt and "story" in prompt.lower():
+            return f"{fake_story(prompt)}\n\n[TRANSLATION]\n犬は公園で走ります。"
+        if "QUESTION:" in prompt:
+            return "QUESTION: Which word do you want to explore?\nCHOICES: [park],[grass],[ball]"
+        return ("That is interesting! How do parks help animals and people in a city?\n\n"
+                "[TRANSLATION]\nおもしろいね！公園は街の動物や人をどのように助けているかな？")
+
+
+def fake_story(prompt):
+    return "A <dog> runs in the <park>. The <grass> is green. Trees give clean air. People and animals share the park."
+
+
+def _total_quizzes(prompt):
+    for token in ("exactly ", "contain exactly "):
+        i = prompt.find(token)
+        if i != -1:
+            digits = "".join(ch for ch in prompt[i + len(token):i + len(token) + 3] if ch.isdigit())
+            if digits:
+                return int(digits)
+    return 6
+
+
+def fake_quizzes(prompt):
+    quizzes = []
+    for n in range(_total_quizzes(prompt)):
+        if n % 2 == 0:
+            quizzes.append({"type": "True/False", "question": f"The dog runs in the park. ({n + 1})",
+                            "choices": ["True", "False"], "answer": "True"})
+        else:
+            quizzes.append({"type": "Fill-in-the-blank", "question": f"The ___ is green. ({n + 1})",
+                            "choices": ["grass", "sky", "car"], "answer": "grass"})
+    return quizzes
+
+
+class _Label:
+    def __init__(self, description):
+        self.description = description
+
+
+class _Error:
+    message = ""
+
+
+class _LabelResponse:
+    def __init__(self, labels):
+        self.error = _Error()
+        self.label_annotations = [_Label(l) for l in labels]
+
+
+class FakeVisionClient:
+    def __init__(self, latency=0.3, labels=5):
+        self.latency = latency
+        self.labels = labels
+        self.calls = 0
+
+    def _labels(self, image):
+        content = getattr(image, "content", b"") or b""
+        # 同じ画像には同じラベルを返す
+        seed = int(hashlib.sha256(content).hexdigest()[:8], 16)
+        rnd = random.Random(seed)
+        return _LabelResponse(rnd.sample(FAKE_LABELS, self.labels))
+
+    def label_detection(self, image=None):
+        self.calls += 1
+        time.sleep(self.latency)
+        return self._labels(image)
+
+
+class _BatchResponse:
+    def __init__(self, responses):
+        self.responses = responses
+
+
+class FakeVisionAsyncClient(FakeVisionClient):
+    """ImageAnnotatorAsyncClient.batch_annotate_images の偽物 (AnnotateImageRequest の image だけを見る)。"""
+
+    async def batch_annotate_images(self, requests=()):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return _BatchResponse([self._labels(getattr(r, "image", None)) for r in requests])
@@ -0,0 +1,59 @@
+# image_preprocess.py
+"""
+Vision / Gemini に送る前の画像の前処理。
+
+スマホの写真 (5〜12MB) をそのまま送るとアップロード時間とトークンが増えるので、
+  1. EXIF の向き情報どおりに回転
+  2. 長辺を max_edge 以下に縮小
+  3. JPEG / WebP に指定品質で再エンコード
+してから送る。テーマにもこの正規化後の画像を保存する。
+"""
+import io
+from PIL import Image, ImageOps
+
+
+def normalize_image(image_bytes: bytes, max_edge=1600, fmt="JPEG", quality=85) -> bytes:
+    img = Image.open(io.BytesIO(image_bytes))
+    original_format = img.format
+    original_size = img.size
+    orientation = img.getexif().get(0x0112, 1)  # EXIF Orientation
+    img.draft("RGB", (max_edge, max_edge))  # JPEG は縮小デコードで速く読む (他の形式では何もしない)
+
+    changed = orientation != 1 or img.size != original_size
+    img = ImageOps.exif_transpose(img)
+
+    if max(img.size) > max_edge:
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        changed = True
+
+    if fmt.upper() == "JPEG" and img.mode != "RGB":
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+        else:
+            img = img.convert("RGB")
+
+    out = io.BytesIO()
+    if fmt.upper() == "WEBP":
+        img.save(out, format="WEBP", quality=quality, method=4)
+    else:
+        img.save(out, format="JPEG", quality=quality, optimize=True)
+    result = out.getvalue()
+
+    # もともと小さい画像は、再エンコードで大きくなるなら元のまま送る
+    if not changed and original_format == fmt.upper() and len(result) >= len(image_bytes):
+        return image_bytes
+    return result
+
+
+def prepare_upload_image(image_bytes: bytes, max_edge=1600, fmt="JPEG", quality=85) -> bytes:
+    """normalize_image の失敗時は元のバイト列を返す (読めない形式でも API 側に任せる)。"""
+    try:
+        normalized = normalize_image(image_bytes, max_edge=max_edge, fmt=fmt, quality=quality)
+        print(f"[DEBUG] Image normalized: {len(image_bytes)} -> {len(normalized)} bytes")
+        return normalized
+    except Exception as e:
+        print(f"Image preprocessing failed, sending original: {e}")
+        return image_bytes
@@ -0,0 +1,113 @@
+# image_store.py
+"""
+Content-addressed image store.
+
+画像バイトは SHA-256 をキーにして一度だけディスクへ書き込む。
+テーマ (profile.json) にはハッシュ文字列だけを保存し、
+サムネイル表示や Gemini 呼び出しで必要になった時にだけ読み込む。
+読み込んだ画像は件数上限つきの LRU に少しだけ残す。
+テーマ一覧用のサムネイル (PNG) は thumbs/<size>/ に一度だけ作って保存する。
+"""
+import io, os, hashlib, tempfile, threading
+from collections import OrderedDict
+
+THUMBNAIL_SIZE = 100
+
+
+def image_digest(image_bytes: bytes) -> str:
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+class ImageStore:
+    def __init__(self, root_dir, cache_size=16):
+        self.root_dir = root_dir
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # digest -> bytes (新しいものが末尾)
+        self._lock = threading.Lock()
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    def _remember(self, digest, image_bytes):
+        if self.cache_size <= 0:
+            return
+        with self._lock:
+            self._cache[digest] = image_bytes
+            self._cache.move_to_end(digest)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _path(self, digest):
+        # 1ディレクトリに大量のファイルが並ばないよう先頭2文字で分ける
+        return os.path.join(self.root_dir, digest[:2], digest)
+
+    def _thumbnail_path(self, digest, size):
+        return os.path.join(self.root_dir, "thumbs", str(size), digest[:2], digest + ".png")
+
+    def _write_file(self, path, data):
+        dir_path = os.path.dirname(path)
+        os.makedirs(dir_path, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def has(self, digest):
+        return bool(digest) and os.path.exists(self._path(digest))
+
+    def put(self, image_bytes: bytes) -> str:
+        digest = image_digest(image_bytes)
+        path = self._path(digest)
+        if os.path.exists(path):
+            return digest  # 同じ画像は二度書かない
+        self._write_file(path, image_bytes)
+        return digest
+
+    def get(self, digest):
+        if not digest:
+            return None
+        with self._lock:
+            if digest in self._cache:
+                self._cache.move_to_end(digest)
+                return self._cache[digest]
+        try:
+            with open(self._path(digest), "rb") as f:
+                image_bytes = f.read()
+        except FileNotFoundError:
+            print(f"Image not found in store: {digest}")
+            return None
+        self._remember(digest, image_bytes)
+        return image_bytes
+
+    # --- サムネイル ---
+    def ensure_thumbnail(self, digest, image_bytes=None, size=THUMBNAIL_SIZE):
+        """サムネイルがなければ元画像から作って保存する。PNG のバイト列を返す。"""
+        path = self._thumbnail_path(digest, size)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                return f.read()
+
+        if image_bytes is None:
+            image_bytes = self.get(digest)
+        if image_bytes is None:
+            return None
+
+        from PIL import Image  # 画像ストア自体は PIL なしでも使えるようにしておく
+        img = Image.open(io.BytesIO(image_bytes))
+        img.draft("RGB", (size, size))  # JPEG は縮小デコードで速く読む
+        img.thumbnail((size, size))
+        if img.mode not in ("RGB", "RGBA", "L"):
+            img = img.convert("RGBA")
+        out = io.BytesIO()
+        img.save(out, format="PNG")
+        thumb_bytes = out.getvalue()
+        self._write_file(path, thumb_bytes)
+        return thumb_bytes
+
+    def get_thumbnail(self, digest, size=THUMBNAIL_SIZE):
+        if not digest:
+            return None
+        return self.ensure_thumbnail(digest, size=size)
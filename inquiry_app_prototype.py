@@ -12,289 +12,76 @@ Inquiry-Based English Learning App (v21.1 - Bug Fix & Theme Save)
               R5: (Note) Chat history (conversation_history) is NOT saved
                   in themes to keep profile.json file size manageable.
 """
-import os, re, io, sys, base64, tempfile, threading, random, json,time
+import os, io, sys, tempfile, random, asyncio
+from collections import OrderedDict
 import tkinter as tk
 from tkinter import messagebox, filedialog, Toplevel, scrolledtext
 import PIL.Image
 from PIL import Image, ImageTk
 import cv2
-import google.generativeai as genai
-from google.cloud import vision
+from config import (PROFILE_FILE, API_WORKERS, API_BACKGROUND_WORKERS, GEMINI_STREAMING, COMBINED_STORY_QUIZ,
+                    COMBINED_NEXT_STEPS, IMAGE_MAX_EDGE, IMAGE_UPLOAD_FORMAT, IMAGE_UPLOAD_QUALITY, ASYNC_API,
+                    PIPELINED_START, PIPELINED_SHORTLIST, VISION_REFINE, THEME_PAGE_SIZE)
+from api_clients import APIClients, configure_clients
+from async_api_clients import AsyncAPIClients, AsyncLoopThread
+from image_preprocess import prepare_upload_image
+from local_labeler import create_labeler_pool
+from prompts import visible_stream_text, parse_choices, parse_translation, words_from_labels
+from session_engine import SessionEngine
+from worker_pool import PriorityWorkerPool, INTERACTIVE, BACKGROUND
+from user_profile import UserProfile
 
 # --- v10.4 (Monolithic) Setup ---
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # --- Config (from environment variables) ---
 # Vision: set GOOGLE_APPLICATION_CREDENTIALS to your service account json path
 # Gemini: set GEMINI_API_KEY to your API key
-SERVICE_ACCOUNT_KEY_PATH = os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "service_account_key.json")
-
-# IMPORTANT: No hard-coded keys in source code
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
-
-# Optional: allow model override via env
-MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "models/gemini-2.5-flash")
-
-PROFILE_FILE = "profile.json"  # v21.0
-
-
-class APIClients:
-    def __init__(self):
-        # Gemini model (create once)
-        self.gemini_model = genai.GenerativeModel(MODEL_NAME)
-        # Vision client (create once)
-        self.vision_client = vision.ImageAnnotatorClient()
-
-    def start_chat(self, history=None):
-        return self.gemini_model.start_chat(history=history or [])
-
-    def label_detection(self, image_bytes: bytes):
-        image = vision.Image(content=image_bytes)
-        response = self.vision_client.label_detection(image=image)
-        if response.error.message:
-            raise Exception(response.error.message)
-        return [l.description for l in response.label_annotations]
-
-def read_txt(filename: str) -> str:
-    path = os.path.join(BASE_DIR, filename)
-    if not os.path.exists(path):
-        return ""
-    for enc in ("utf-8", "utf-8-sig", "cp932"):
-        try:
-            with open(path, "r", encoding=enc) as f:
-                return f.read()
-        except UnicodeDecodeError:
-            continue
-    with open(path, "r", encoding="utf-8", errors="replace") as f:
-        return f.read()
-
-class _SafeDict(dict):
-    def __missing__(self, key):
-        return "{" + key + "}"
-
-def render_prompt(filename: str, **kwargs) -> str:
-    template = read_txt(filename)
-    if not template:
-        return ""
-    return template.format_map(_SafeDict(kwargs))
-
-def build_prompt_from_file(filename: str, fallback_text: str, **kwargs) -> str:
-    template = render_prompt(filename, **kwargs)
-    if template:
-        return f"{template}\n\n{fallback_text}"
-    return fallback_text
-def parse_question_choices(text: str):
-    if not text:
-        return "", []
-    m = re.search(r"QUESTION:\s*(.+?)\s*CHOICES:\s*(.+)", text, re.S | re.I)
-    if not m:
-        return "", []
-    question = m.group(1).strip()
-    choices_raw = m.group(2).strip()
-    m2 = re.search(r"\bANSWER\s*:", choices_raw, re.I)
-    if m2:
-        choices_raw = choices_raw[:m2.start()].strip()
-    choices = [c.strip() for c in re.findall(r"\[(.*?)\]", choices_raw)]
-    return question, choices
-
-
-
-try:
-    if os.path.exists(SERVICE_ACCOUNT_KEY_PATH):
-        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = SERVICE_ACCOUNT_KEY_PATH
-        print("Vision API Service Account Loaded.")
-    else:
-        print(f"Warning: Vision API key '{SERVICE_ACCOUNT_KEY_PATH}' not found. Vision API will fail.")
-except Exception as e:
-    print(f"Error loading service account: {e}")
-
+# (読み込みとクライアントは api_clients.py、学習の流れは session_engine.py)
 try:
-    if not GEMINI_API_KEY:
-        raise ValueError("GEMINI_API_KEY is not set.")
-    genai.configure(api_key=GEMINI_API_KEY)
+    configure_clients()
 except Exception as e:
     print(f"Gemini initialization failed: {e}")
     sys.exit(1)
 # --- End of v10.4 Setup ---
 
 
-# [MOD] v21.1 (R2, R3)
-# ユーザープロファイルを管理するクラス
-class UserProfile:
-    def __init__(self, file_path):
-        self.file_path = file_path
-        self.data = self.load()
-
-    def get_default_profile(self):
-        return {
-            "grade": "3-4年生",
-            "current_level": "CEFR A1", 
-            "coins": 0,
-            "theme_history": [] # v21.1: テーマ履歴を保存
-        }
-
-    def load(self):
-        if os.path.exists(self.file_path):
-            try:
-                with open(self.file_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    print(f"Profile loaded from {self.file_path}")
-                    
-                    defaults = self.get_default_profile()
-                    for key, value in defaults.items():
-                        if key not in data:
-                            data[key] = value
-                            
-                    # [NEW] v21.1 (R3): Base64画像をバイナリに戻す
-                    if "theme_history" in data:
-                        for theme in data["theme_history"]:
-                            if "image_data_b64" in theme:
-                                theme["image_data"] = base64.b64decode(theme["image_data_b64"])
-                                # del theme["image_data_b64"] # ロード後は不要
-                    
-                    return data
-            except Exception as e:
-                print(f"Error loading profile: {e}. Loading defaults.")
-                return self.get_default_profile()
-        else:
-            print("No profile found. Creating new one.")
-            return self.get_default_profile()
-
-    def save(self):
-        try:
-            # [NEW] v21.1 (R3): 画像データをBase64に変換
-            # theme_historyは巨大になる可能性があるため、コピーして操作する
-            data_to_save = self.data.copy()
-            if "theme_history" in data_to_save:
-                # 既存のテーマ履歴を（念のため）ディープコピー
-                saved_themes = []
-                for theme in data_to_save["theme_history"]:
-                    new_theme = theme.copy()
-                    if "image_data" in new_theme and isinstance(new_theme["image_data"], bytes):
-                        new_theme["image_data_b64"] = base64.b64encode(new_theme["image_data"]).decode('utf-8')
-                        del new_theme["image_data"] # バイナリデータは削除
-                    
-                    # word_sessions内のバイナリデータも処理（もしあれば）
-                    if "word_sessions" in new_theme:
-                        for word, session in new_theme["word_sessions"].items():
-                            if "history" in session:
-                                del session["history"] # 会話履歴は保存しない
-                    
-                    saved_themes.append(new_theme)
-                
-                data_to_save["theme_history"] = saved_themes
-
-            with open(self.file_path, 'w', encoding='utf-8') as f:
-                json.dump(data_to_save, f, indent=4, ensure_ascii=False)
-                print(f"Profile saved to {self.file_path}")
-        except Exception as e:
-            print(f"Error saving profile: {e}")
-            
-    def get(self, key):
-        return self.data.get(key)
-        
-    def set(self, key, value):
-        self.data[key] = value
-
-    def add_coins(self, amount):
-        if "coins" not in self.data:
-            self.data["coins"] = 0
-        self.data["coins"] += amount
-        return self.data["coins"]
-
-
-# v21.0から変更なし
-def get_master_prompt(grade, student_level, context_image=None, context_keyword=None, vision_labels=None):
-    
-    if grade in ["小学生以下", "1-2年生"]:
-        choice_prompt = "You MUST provide 3 choices, like this: CHOICES: [[Choice 1],[Choice 2],[Choice 3]]"
-    else:
-        choice_prompt = "Do not provide choices."
-
-    if context_keyword:
-        master_prompt_text = f"""
-You are an AI guide for inquiry-based English learning.
-The student's grade is: {grade}.
-The student's estimated English level is: {student_level}.
-
-Your task is to ask **one single, open-ended question** to start a conversation based on the keyword: '{context_keyword}'.
-The question MUST be appropriate for the student's level ({student_level}).
-
-**CRITICAL RULES:**
-- **Use simple English**, appropriate for the student's level.
-- The question MUST connect the keyword to a wider topic, such as **environmental problems, social studies (how society works), or interesting trivia**.
-- **Example 1 (Keyword 'grass'):** Ask "How do plants like grass help our planet?" (Environmental)
-- **Example 2 (Keyword 'car'):** Ask "How do cars change the way people live in a city?" (Social Studies)
-
-{choice_prompt}
-
-After your English response, you MUST provide a Japanese translation.
-Format it EXACTLY like this (with the [TRANSLATION] tag):
-
-(Your English question...)
-{choice_prompt}
-
-[TRANSLATION]
-(ここに日本語訳...)
-"""
-    else:
-         master_prompt_text = f"You are a helpful assistant. Please talk in simple English. (Grade: {grade}) (Level: {student_level}) (No keyword provided)"
-    initial_context = f"Keyword: {context_keyword}" if context_keyword else "Keyword: (none)"
-    if vision_labels:
-        vision_context = f"Vision labels: {', '.join(vision_labels)}"
-    else:
-        vision_context = "Vision labels: (none)"
-
-    master_prompt_text = build_prompt_from_file(
-        "prompt_master.txt",
-        master_prompt_text,
-        grade=grade,
-        guide_level=student_level,
-        initial_context=initial_context,
-        vision_context=vision_context
-    )
-
-
-    if context_image is not None:
-        return [master_prompt_text, context_image]
-    return [master_prompt_text]
-
 class InquiryApp:
     def __init__(self, master: tk.Tk):
         self.master = master
         
         self.profile = UserProfile(PROFILE_FILE)
-        self.api = APIClients()
+        # LOCAL_LABELER を設定していれば、写真のラベルを PC の中で作れる (モデルは別プロセスで先に読み込む)
+        local_labeler = create_labeler_pool()
+        if local_labeler is not None:
+            local_labeler.warm_up()
+        self.api = APIClients(local_labeler=local_labeler)
+        # ASYNC_API=1 なら会話・ストーリー・クイズの呼び出しは専用スレッドのイベントループで待つ
+        self.api_loop = AsyncLoopThread() if ASYNC_API else None
+        self.aapi = AsyncAPIClients(self.api) if ASYNC_API else None
+        # 学習の状態 (会話・ストーリー・クイズ・テーマ) はエンジンが持ち、この画面は表示だけを受け持つ
+        self.engine = SessionEngine(self.api, self.profile, total_quizzes=6, aapi=self.aapi)
+        self.engine.on("coins_changed", lambda coins: self.update_status_bar())
+        self.engine.on("settings_changed", self.update_status_bar)
+        self.engine.on("level_changed", self.on_level_changed)
+        self.engine.on("theme_saved", lambda theme, word: self._get_next_daily_mission())
+        # API 呼び出しは決まった数のワーカーで実行する (生徒が待つ仕事を優先)
+        self.api_pool = PriorityWorkerPool(API_WORKERS, max_background=API_BACKGROUND_WORKERS)
+        # 実行中の API 呼び出し (request_id -> scope)。ここから消えた呼び出しの結果は捨てる
+        self.pending_requests = {}
+        self.silent_requests = set()  # 先読みなど、画面に何も出さない呼び出し
+        self.promoted_requests = set()  # BACKGROUND で投げたが、生徒が待つことになった呼び出し
+        self.next_request_id = 0
         
         master.title(f"Inquiry English App (v21.1 — Profile: {self.profile.get('current_level')})")
         master.geometry("800x900")
         
-        self.grade = self.profile.get("grade")
-        self.student_level = self.profile.get("current_level") 
-        self.coins = self.profile.get("coins")
-
-        self.image_data = None; self.initial_image_data = None; self.initial_image_path = ""
-        self.initial_image_labels = []; self.current_vision_labels = []
-        self.conversation_phase = "conversation"
-        self.conversation_history = []
-        self.chat_session = None
-        
-        self.current_english_text = ""
-        self.current_story_text = ""
-        self.current_story_translation = ""
-        
-        self.current_theme_title = "" 
-        # [MOD] v21.1 (R2) プロファイルからテーマ履歴をロード
-        self.theme_history = self.profile.get("theme_history")
-        self.theme_photo_references = []
-        
-        self.quiz_data = [] 
-        self.current_quiz_index = 0
-        self.total_quizzes_to_generate = 6 
-        self.correct_answer = "" 
-        self.current_quiz_results = [] 
-        
-        self.selected_word = None
-        self.used_words_in_current_theme = set() 
+        self.quiz_prefetch = None  # ストーリーを読んでいる間に先に作り始めたクイズ (セッションごとに1つ)
+        self.start_prefetch = None  # パイプライン開始で先に作り始めた1ターン目 (写真ごとに1つ)
+        self.theme_photo_cache = OrderedDict()  # image_hash -> PhotoImage (テーマ一覧のサムネイル LRU)
+        self.theme_photo_cache_size = 200
+        self.theme_row_height = 230  # テーマ一覧の1行の高さ (仮想化リストは固定の高さで並べる)
+        self.theme_page_size = THEME_PAGE_SIZE  # 0 = ページ分けしない (仮想化だけで表示する)
+        self.theme_page = 0
+        self.theme_rows = []; self.theme_list_themes = []; self.theme_canvas = None
         
         self.word_select_frame = None; self.word_select_buttons = []
         self.temp_files = []; self.temp_mission_data = None
@@ -308,7 +95,7 @@ class InquiryApp:
         # [MOD] v21.1 (R4) 
         # もしプロファイルにテーマ履歴が1つ以上あれば、
         # 設定画面ではなくテーマタブから開始する（デバッグ用）
-        if self.theme_history:
+        if self.engine.theme_history:
             self.switch_frame(self.theme_frame)
             self.show_theme_history_page() # UIを再描画
         else:
@@ -327,11 +114,11 @@ class InquiryApp:
         self.status_bar_frame = tk.Frame(self.master, relief=tk.SUNKEN, borderwidth=2, bg="#F0F0F0")
         self.status_bar_frame.pack(fill=tk.X, side=tk.TOP, ipady=5)
         
-        self.level_label = tk.Label(self.status_bar_frame, text=f"Level: {self.student_level}", 
+        self.level_label = tk.Label(self.status_bar_frame, text=f"Level: {self.engine.student_level}", 
                                     font=("", 12, "bold"), bg="#F0F0F0")
         self.level_label.pack(side=tk.LEFT, padx=20)
         
-        self.coins_label = tk.Label(self.status_bar_frame, text=f"Coins: {self.coins} 🪙", 
+        self.coins_label = tk.Label(self.status_bar_frame, text=f"Coins: {self.engine.coins} 🪙", 
                                     font=("", 12, "bold"), bg="#F0F0F0")
         self.coins_label.pack(side=tk.RIGHT, padx=20)
         
@@ -389,8 +176,8 @@ class InquiryApp:
         tk.Button(self.settings_frame, text="Start - Select Photo",
                   command=self.go_to_photo_selection, font=("", 12, "bold")).pack(pady=20)
         
-        self.select_setting("grade", self.grade)
-        self.select_setting("level", self.student_level)
+        self.select_setting("grade", self.engine.grade)
+        self.select_setting("level", self.engine.student_level)
         
         # (Photo Frame setup) - v11.9から変更なし
         self.photo_frame_title = tk.Label(self.photo_frame, text="", font=("", 20, "bold"),
@@ -477,15 +264,13 @@ class InquiryApp:
     # v21.0から変更なし
     def update_status_bar(self):
         if hasattr(self, 'level_label'):
-            self.level_label.config(text=f"Level: {self.student_level}")
+            self.level_label.config(text=f"Level: {self.engine.student_level}")
         if hasattr(self, 'coins_label'):
-            self.coins_label.config(text=f"Coins: {self.coins} 🪙")
+            self.coins_label.config(text=f"Coins: {self.engine.coins} 🪙")
             
-    # v21.0から変更なし
-    def add_coins(self, amount):
-        self.coins = self.profile.add_coins(amount)
-        print(f"Added {amount} coins. Total: {self.coins}")
-        self.update_status_bar() 
+    def on_level_changed(self, old_level, new_level):
+        self.master.title(f"Inquiry English App (v21.1 — Profile: {new_level})")
+        self.update_status_bar()
 
 
     def set_display_photo(self, image_data):
@@ -510,18 +295,15 @@ class InquiryApp:
     # v21.0から変更なし
     def select_setting(self, setting_type, value):
         if setting_type == "grade":
-            self.grade = value
-            self.profile.set("grade", value) 
+            self.engine.set_grade(value)
             for _, btn in self.grade_vars.items(): btn.config(relief=tk.RAISED)
             if value in self.grade_vars: self.grade_vars[value].config(relief=tk.SUNKEN)
         elif setting_type == "level":
-            self.student_level = value
-            self.profile.set("current_level", value) 
+            self.engine.set_level(value)
             for _, btn in self.level_vars.items(): btn.config(relief=tk.RAISED)
             if value in self.level_vars: self.level_vars[value].config(relief=tk.SUNKEN)
             
         self.update_settings_label()
-        self.update_status_bar() 
 
     # v21.0から変更なし
     def update_settings_label(self):
@@ -536,19 +318,9 @@ class InquiryApp:
 
     # v21.0から変更なし
     def go_to_photo_selection(self):
+        self.cancel_requests("session")
         self.switch_frame(self.photo_frame)
-        self.conversation_phase = "conversation"
-        self.image_data = None; self.initial_image_data = None; self.initial_image_path = ""
-        self.initial_image_labels = []; self.current_vision_labels = []
-        self.conversation_history = [] 
-        self.chat_session = None
-        self.used_words_in_current_theme = set()
-        self.quiz_data = []
-        self.current_quiz_index = 0
-        self.current_theme_title = "" 
-        
-        self.current_story_text = ""
-        self.current_story_translation = ""
+        self.engine.clear_photo()
         
         self.chat_history_text.config(state=tk.NORMAL)
         self.chat_history_text.delete('1.0', tk.END)
@@ -562,9 +334,10 @@ class InquiryApp:
         if self.word_select_frame is not None:
             self.word_select_frame.pack_forget()
 
-    # v21.0から変更なし
     def get_image_bytes(self, path):
-        with open(path, "rb") as f: return f.read()
+        # Vision / Gemini に送る画像は向き補正・縮小・再エンコードしたものを使う (テーマにもこれを保存)
+        with open(path, "rb") as f: raw = f.read()
+        return prepare_upload_image(raw, max_edge=IMAGE_MAX_EDGE, fmt=IMAGE_UPLOAD_FORMAT, quality=IMAGE_UPLOAD_QUALITY)
 
     # v21.0から変更なし
     def display_image(self, path):
@@ -579,8 +352,8 @@ class InquiryApp:
     def load_image_from_file(self):
         path = filedialog.askopenfilename(filetypes=[("Image Files","*.png;*.jpg;*.jpeg;*.gif;*.bmp")])
         if not path: return
-        self.display_image(path); self.image_data = self.get_image_bytes(path)
-        self.initial_image_data = self.image_data; self.initial_image_path = path
+        self.cancel_requests("session")
+        self.display_image(path); self.engine.set_photo(self.get_image_bytes(path), path)
         self.start_conv_vision_btn.config(state=tk.NORMAL); self.start_conv_no_vision_btn.config(state=tk.NORMAL)
 
     # v21.0から変更なし
@@ -603,8 +376,8 @@ class InquiryApp:
                 tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".jpg"); p = tmp.name; tmp.close()
                 cv2.imwrite(p, frame); self.temp_files.append(p)
                 cap.release(); win.destroy()
-                self.display_image(p); self.image_data = self.get_image_bytes(p)
-                self.initial_image_data = self.image_data; self.initial_image_path = p
+                self.cancel_requests("session")
+                self.display_image(p); self.engine.set_photo(self.get_image_bytes(p), p)
                 self.start_conv_vision_btn.config(state=tk.NORMAL); self.start_conv_no_vision_btn.config(state=tk.NORMAL)
             else:
                 cap.release(); win.destroy()
@@ -634,13 +407,13 @@ class InquiryApp:
         self.thinking_label.place_forget()
         self.view_themes_button.config(state=tk.NORMAL)
         self.home_button.config(state=tk.NORMAL) 
-        if self.conversation_phase == "conversation":
+        if self.engine.conversation_phase == "conversation":
             self.send_button.config(state=tk.NORMAL)
             self.go_to_story_button.config(state=tk.NORMAL) 
             self.user_input_entry.config(state=tk.NORMAL)
-        elif self.conversation_phase == "select_photo" and self.image_data:
+        elif self.engine.conversation_phase == "select_photo" and self.engine.image_data:
             self.start_conv_vision_btn.config(state=tk.NORMAL); self.start_conv_no_vision_btn.config(state=tk.NORMAL)
-        elif self.conversation_phase == "quiz":
+        elif self.engine.conversation_phase == "quiz":
             if hasattr(self, 'start_quiz_button'):
                 self.start_quiz_button.config(state=tk.NORMAL)
             if self.next_step_button.winfo_ismapped() == False:
@@ -650,36 +423,79 @@ class InquiryApp:
             pass 
 
     # v21.0から変更なし
-        # v21.1: Threaded API runner with simple 429 retry handling
-        # v21.1: Threaded API runner with simple 429 retry handling
-    def run_api_in_thread(self, api_func, on_complete_callback, args=(), kwargs=None, message="AI is thinking..."):
+    # [MOD] レート制限は APIClients 側、再試行は RetryPolicy (指数バックオフ + ジッター) で行う
+    # [MOD] スレッドを毎回作らず、優先度つきワーカープールで実行する
+    # [MOD] scope ごとに cancel_requests() で取り消せる。取り消された呼び出しは実行せず、結果も捨てる
+    # [MOD] stream="chat" / "story" を指定すると、届いた分からその画面に表示する
+    # [MOD] silent=True は先読み用: "thinking" 表示もエラーダイアログも出さない
+    def engine_call(self, name):
+        """エンジンの API メソッド。イベントループを使うときはコルーチン版 (*_async) を返す。"""
+        if self.api_loop is not None:
+            return getattr(self.engine, f"{name}_async")
+        return getattr(self.engine, name)
+
+    def run_api_in_thread(self, api_func, on_complete_callback, args=(), kwargs=None, message="AI is thinking...",
+                          priority=INTERACTIVE, scope="session", stream=None, silent=False):
         if kwargs is None:
             kwargs = {}
-        self.show_thinking(message)
-
-        def worker():
-            max_retries = 1  # set to 0 to disable retries
-            for attempt in range(max_retries + 1):
-                try:
-                    result = api_func(*args, **kwargs)
-                    self.master.after(0, self.on_api_complete, result, on_complete_callback)
-                    return
-                except Exception as e:
-                    err = str(e)
-
-                    # 429 の場合のみリトライ
-                    if "429" in err and ("retry_delay" in err or "quota" in err or "rate" in err) and attempt < max_retries:
-                        m = re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)", err)
-                        wait_s = int(m.group(1)) if m else 5
-                        self.master.after(0, lambda s=wait_s, a=attempt + 1: self.show_thinking(f"Rate limited. Waiting {s}s... (retry {a}/{max_retries})"))
-                        time.sleep(wait_s)
-                        continue
-
-                    # 429以外、またはリトライ上限に達したら即エラーを返す
-                    self.master.after(0, self.on_api_complete, e, on_complete_callback)
+        if not silent:
+            self.show_thinking(message)
+        policy = self.api.retry_policy
+        self.next_request_id += 1
+        request_id = self.next_request_id
+        self.pending_requests[request_id] = scope
+        if silent:
+            self.silent_requests.add(request_id)
+        complete = lambda result: self.master.after(0, self.on_api_complete, result, on_complete_callback,
+                                                    request_id, stream)
+        call_kwargs = kwargs
+        if stream and GEMINI_STREAMING:
+            call_kwargs = dict(kwargs, on_chunk=lambda text: self.master.after(
+                0, self.show_stream_text, stream, visible_stream_text(text), request_id))
+
+        if asyncio.iscoroutinefunction(api_func):
+            # 再試行・タイムアウトは AsyncAPIClients が受け持つ。取り消しは cancel_requests() から
+            def done(future):
+                if not future.cancelled():
+                    complete(future.exception() or future.result())
+            self.api_loop.submit(api_func(*args, **call_kwargs), scope=scope).add_done_callback(done)
+            return request_id
+
+        def worker(attempt=0):
+            if request_id not in self.pending_requests:
+                print(f"[DEBUG] Skipped cancelled request {request_id} ({api_func.__name__})")
+                return
+            try:
+                complete(api_func(*args, **call_kwargs))
+                return
+            except Exception as e:
+                wait_s = policy.next_delay(e, attempt)
+                if wait_s is None or request_id not in self.pending_requests:
+                    # 一時的なエラーでない、回数上限、再試行予算切れ、または取り消し済み
+                    complete(e)
                     return
+                attempt += 1
+                print(f"[DEBUG] API error, retry {attempt}/{policy.max_retries} in {wait_s:.1f}s: {e}")
+                if not silent:
+                    self.master.after(0, lambda s=wait_s, a=attempt: self.show_thinking(
+                        f"Rate limited. Waiting {s:.0f}s... (retry {a}/{policy.max_retries})"))
+            # 待っている間はワーカーを空けておき、時間が来たらプールがキューに入れ直す
+            next_priority = INTERACTIVE if request_id in self.promoted_requests else priority
+            try:
+                self.api_pool.submit_later(lambda: worker(attempt), wait_s, next_priority, key=request_id)
+            except RuntimeError:
+                print(f"[DEBUG] Dropped retry of request {request_id}: worker pool is shut down")
+
+        self.api_pool.submit(worker, priority, key=request_id)
+        return request_id
 
-        threading.Thread(target=worker, daemon=True).start()
+    def promote_request(self, request_id):
+        """待機中の呼び出しを INTERACTIVE に上げる (再試行で入れ直すときも INTERACTIVE で入れる)。"""
+        if request_id not in self.pending_requests:
+            return
+        self.promoted_requests.add(request_id)
+        if self.api_loop is None and self.api_pool.reprioritize(request_id, INTERACTIVE):
+            print(f"[DEBUG] Promoted request {request_id} to INTERACTIVE")
 
   
 
@@ -687,253 +503,77 @@ class InquiryApp:
 
 
 
-    # v21.0から変更なし
-    def on_api_complete(self, result, callback_func):
-        self.hide_thinking()
+    def show_stream_text(self, target, text, request_id):
+        """ストリーミング途中の英文を表示する。完了時に end_stream_text() で消し、通常の処理で表示し直す。"""
+        if request_id not in self.pending_requests or not text:
+            return
+        self.thinking_label.place_forget()  # ボタンは無効のまま、オーバーレイだけ消す
+        if target == "story":
+            self.story_text_widget.config(state=tk.NORMAL)
+            self.story_text_widget.delete('1.0', tk.END)
+            self.story_text_widget.insert(tk.END, text)
+            self.story_text_widget.config(state=tk.DISABLED)
+            return
+        widget = self.chat_history_text
+        widget.config(state=tk.NORMAL)
+        if "stream_start" not in widget.mark_names():
+            widget.mark_set("stream_start", tk.END + "-1c")
+            widget.mark_gravity("stream_start", tk.LEFT)
+        widget.delete("stream_start", tk.END)
+        widget.insert(tk.END, f"[AI]: {text}\n\n")
+        widget.see(tk.END); widget.config(state=tk.DISABLED)
+
+    def end_stream_text(self):
+        widget = self.chat_history_text
+        if "stream_start" in widget.mark_names():
+            widget.config(state=tk.NORMAL)
+            widget.delete("stream_start", tk.END)
+            widget.mark_unset("stream_start")
+            widget.config(state=tk.DISABLED)
+
+    def cancel_requests(self, scope="session"):
+        """scope の実行中・待機中の呼び出しを取り消す (画面が変わったので結果はもう使わない)。"""
+        if scope == "session":
+            self.quiz_prefetch = None  # 先読みしたクイズも前のセッションのもの
+            if self.start_prefetch is not None:
+                self.start_prefetch = None
+                self.cancel_requests("prefetch")
+        cancelled = [rid for rid, s in self.pending_requests.items() if s == scope]
+        if self.api_loop is not None:
+            self.api_loop.cancel(scope)  # 送信中・待機中のコルーチンも止める
+        for rid in cancelled:
+            del self.pending_requests[rid]
+            self.silent_requests.discard(rid)
+            self.promoted_requests.discard(rid)
+        if cancelled:
+            print(f"[DEBUG] Cancelled {len(cancelled)} '{scope}' request(s)")
+            self.end_stream_text()
+            if all(rid in self.silent_requests for rid in self.pending_requests):
+                self.hide_thinking()
+
+    # [MOD] 取り消された呼び出しの結果はコールバックに渡さない
+    def on_api_complete(self, result, callback_func, request_id=None, stream=None):
+        silent = False
+        if request_id is not None:
+            if request_id not in self.pending_requests:
+                print(f"[DEBUG] Dropped stale result of request {request_id}")
+                return
+            del self.pending_requests[request_id]
+            silent = request_id in self.silent_requests
+            self.silent_requests.discard(request_id)
+            self.promoted_requests.discard(request_id)
+        if stream:
+            self.end_stream_text()
+        if not silent:
+            self.hide_thinking()
         if isinstance(result, Exception):
-            print(f"API Thrwead Error: {result}"); messagebox.showerror("API Error", f"{result}"); callback_func(None)
+            print(f"API Thrwead Error: {result}")
+            if not silent:
+                messagebox.showerror("API Error", f"{result}")
+            callback_func(None)
         else:
             callback_func(result)
 
-    # --- v21.0 API functions (変更なし) ---
-    def api_get_image_labels(self, image_data):
-        try:
-           labels = self.api.label_detection(image_data)
-           print(f"[DEBUG] Vision API Labels: {labels}")
-           return labels
-        except Exception as e:
-            print(f"Vision API Error: {e}")
-            return []
-
-
-    def api_start_inquiry(self, image_data=None, keyword=None, vision_labels=None):
-        
-        if image_data:
-            img = PIL.Image.open(io.BytesIO(image_data))
-            prompt_parts = get_master_prompt(self.grade, self.student_level, context_image=img, context_keyword=keyword, vision_labels=vision_labels)
-        elif keyword:
-            prompt_parts = get_master_prompt(self.grade, self.student_level, context_keyword=keyword, vision_labels=vision_labels)
-        else:
-            raise ValueError("image_data or keyword is required.")
-        self.chat_session = self.api.start_chat(history=[])
-        resp = self.chat_session.send_message(prompt_parts)
-        self.conversation_history = self.chat_session.history
-        return resp.text
-        
-        
-
-    def api_continue_conversation(self, user_reply):
-        
-        if self.chat_session is None:
-            self.chat_session = self.api.start_chat(history=self.conversation_history or [])
-        
-        if self.grade in ["小学生以下", "1-2年生"]:
-            choice_prompt = "You MUST provide 3 new choices for this question, like this: CHOICES: [[Choice 1],[Choice 2],[Choice 3]]"
-        else:
-            choice_prompt = "Do not provide choices."
-        
-        inquiry_prompt = f"""
-The user's last reply was: "{user_reply}"
-The student's level is: {self.student_level}.
-
-Continue the inquiry-based conversation.
-1. Briefly acknowledge their reply.
-2. Ask **one new, open-ended, inquiry-based question** to deepen their thinking (about **environment, social studies, or trivia**).
-3. Keep the conversation flowing and use **simple English, appropriate for {self.student_level}**.
-- **Example (Social):** User: "Cars are fast." AI: "That's true! But what happens to a town when many cars are used?"
-- **Example (Env):** User: "I like trees." AI: "Trees are great! How do trees help keep the air clean?"
-
-{choice_prompt}
-
-CRITICAL: After your English response, you MUST provide a Japanese translation.
-Format it EXACTLY like this (with the [TRANSLATION] tag):
-
-(Your English response...)
-{choice_prompt}
-
-[TRANSLATION]
-(ここに日本語訳...)
-
-"""
-        resp = self.chat_session.send_message(inquiry_prompt)
-        self.conversation_history = self.chat_session.history
-        return resp.text
-    def api_generate_quizzes_bulk(self, story_chat_history, total_quizzes, previous_quiz_questions):
-        chat = self.api.start_chat(history=story_chat_history)
-        prompt = f"""
-You are creating exactly {total_quizzes} short quizzes about the story in our chat history.
-Rules:
-- Allowed types: "True/False" or "Fill-in-the-blank".
-- Avoid duplicate or near-duplicate questions. Do NOT repeat these questions: {previous_quiz_questions}
-- Difficulty must match a {self.student_level} student.
-- True/False: choices must be ["True","False"], answer is "True" or "False".
-- Fill-in-the-blank: include a blank like "___" and 3-4 concise choices; answer must exactly match one choice.
-- Return JSON ONLY (no prose/markdown/code fences).
-- JSON schema (exact keys):
-{{"quizzes":[{{"type":"True/False","question":"...","choices":["True","False"],"answer":"True"}},{{"type":"Fill-in-the-blank","question":"... ___ ...","choices":["choice1","choice2","choice3"],"answer":"choice1"}}]}}
-- quizzes list length must be exactly {total_quizzes}.
-"""
-        prompt = build_prompt_from_file(
-            "prompt_quiz.txt",
-            prompt,
-            grade=self.grade,
-            english_for_prompt=self.current_story_text or "(no story)"
-        )
-
-        resp = chat.send_message(prompt)
-        raw = resp.text.strip()
-        parsed = None
-        try:
-            parsed = json.loads(raw)
-        except Exception:
-            try:
-                start = raw.find("{"); end = raw.rfind("}")
-                if start != -1 and end != -1:
-                    parsed = json.loads(raw[start:end+1])
-            except Exception:
-                parsed = None
-
-        if not parsed or "quizzes" not in parsed:
-            raise ValueError("Failed to parse quiz JSON from Gemini response.")
-
-        quizzes_out = []
-        for item in parsed.get("quizzes", []):
-            q_type = (item.get("type") or "").strip()
-            question = (item.get("question") or "").strip()
-            choices = item.get("choices") or []
-            answer = (item.get("answer") or "").strip()
-            if q_type and question and choices and answer:
-                quizzes_out.append({"q": question, "c": choices, "a": answer, "type": q_type})
-
-        if len(quizzes_out) != total_quizzes:
-            raise ValueError(f"Expected {total_quizzes} quizzes but got {len(quizzes_out)}.")
-
-        print(f"[DEBUG] Bulk quiz generation: received {len(quizzes_out)} quizzes in one call.")
-        return quizzes_out
-    def api_generate_tag_choices(self):
-        fallback_prompt = f"""
-Based on the story below, create a single question and 3-5 keyword choices.
-QUESTION: ...
-CHOICES: [Choice1],[Choice2],[Choice3]
-
-STORY:
-{self.current_story_text}
-"""
-        prompt = build_prompt_from_file(
-            "prompt_tag.txt",
-            fallback_prompt,
-            english_for_prompt=self.current_story_text,
-            grade=self.grade,
-            guide_level=self.student_level
-        )
-        chat = self.api.start_chat(history=[])
-        resp = chat.send_message(prompt)
-        return resp.text
-
-    def api_generate_mission_choices(self):
-        fallback_prompt = f"""
-Based on the story below, ask which keyword the student wants to photograph next.
-Use keywords from the story and include [ホームに戻る].
-QUESTION: ...
-CHOICES: [Choice1],[Choice2],[ホームに戻る]
-
-STORY:
-{self.current_story_text}
-"""
-        prompt = build_prompt_from_file(
-            "prompt_mission.txt",
-            fallback_prompt,
-            english_for_prompt=self.current_story_text,
-            grade=self.grade,
-            guide_level=self.student_level
-        )
-        chat = self.api.start_chat(history=[])
-        resp = chat.send_message(prompt)
-        return resp.text
-
-
-
-    def api_generate_story(self):
-        
-    
-
-        # >>> INSERT: CEFR-based story control (ここから)
-        level_rules = {
-            "CEFR Pre-A1": "Write 3–4 sentences, 4–7 words each. Use only very simple words (dog, tree, book, happy, play). No conjunctions. One idea per sentence.",
-            "CEFR A1":     "Write 5–6 sentences, 6–10 words each. Use simple present/past and allow 'and' or 'but'. Keep vocabulary at A1.",
-            "CEFR A2":     "Write 6–8 sentences, 8–12 words each. Include at least one sentence with 'because' or 'so', and one comparative adjective (bigger/stronger/healthier). A2-level vocabulary only."
-        }
-        level_rule = level_rules.get(self.student_level, "")
-        # >>> INSERT: CEFR-based story control (ここまで)
-
-        story_prompt = f"""
-[CEFR rule] {level_rule}
-
-Based on the **ideas and themes** from our conversation (e.g., environment, social studies), create an educational **5 to 6 sentence** English story.
-The story must be written at a {self.student_level} level.
-The story should be creative but **provide a learning point**.
-
-**CRITICAL RULE:** After the English story, you MUST provide a Japanese translation.
-Format it EXACTLY like this (with the [TRANSLATION] tag):
-
-(English Story...)
-
-[TRANSLATION]
-(ここに日本語訳...)
-"""
-        story_prompt = build_prompt_from_file(
-            "prompt_content.txt",
-            story_prompt,
-            english_for_prompt="(use chat history)",
-            grade=self.grade,
-            guide_level=self.student_level
-        )
-
-         
-        
-
-        chat = self.api.start_chat(history=self.conversation_history)
-        resp = chat.send_message(story_prompt)
-        self.conversation_history = chat.history
-        return resp.text, self.conversation_history
-        
-    
-
-    def api_generate_summary_guidance(self, session_data):
-        
-        story = session_data.get("story", "No story.")
-        quiz_summary = []
-        for q in session_data.get("quizzes", []):
-            quiz_summary.append(f"- {q['q']} (Answer: {q['a']})")
-        quiz_text = "\n".join(quiz_summary)
-
-        guidance_prompt = f"""
-You are an AI assistant helping a student fill out their summary card.
-The student's grade is {self.grade}.
-Your task is to write a short, friendly message (in **simple Japanese**) to the student.
-Guide them by asking **one thinking question for each of the first 3 fields**.
-
-Here is the data from their learning session:
----
-**STORY:**
-{story}
-
-**QUIZZES THEY TOOK:**
-{quiz_text}
----
-
-**Example Output (Must be in Japanese):**
-"このトピックの学習、おつかれさま！
-カードを埋めるために、こんなことを考えてみよう：
-
-1.  **事実:** どんな「こと」（事実）を学んだかな？（ストーリーやクイズに出てきたことなど）
-2.  **気持ち/解決策:** この話でどんな「きもち」になったかな？ 私たちにできる小さな「かいけつさく」はあるかな？
-3.  **新しい視点:** この勉強で、なにか「あたらしいかんがえ」は生まれた？
-4.  **参考:** ばっちりだね！ ほかにも、どこでこれについて学べるかな？（としょかん、はくぶつかんなど）"
-"""
-        chat = self.api.start_chat(history=[]); resp = chat.send_message(guidance_prompt)
-        return resp.text
-    # --- End of API functions ---
 
     # v21.0から変更なし
     def append_chat(self, speaker, message):
@@ -948,46 +588,131 @@ Here is the data from their learning session:
 
     # v21.0から変更なし
     def start_inquiry(self):
-        if not self.image_data:
+        if not self.engine.image_data:
             messagebox.showwarning("No Photo", "Please select or capture a photo to start."); return
-        self.switch_frame(self.conversation_frame); self.set_display_photo(self.image_data)
-        self.conversation_phase = "conversation" 
-        self.run_api_in_thread(self.api_get_image_labels, self.handle_vision_response,
-                               args=(self.image_data,), message="Analyzing image tags (Vision API)...")
+        self.switch_frame(self.conversation_frame); self.set_display_photo(self.engine.image_data)
+        self.engine.conversation_phase = "conversation" 
 
-    # v21.0から変更なし
+        # 保存済みテーマ、または以前に解析した写真ならラベルをそのまま使う (Vision API は呼ばない)
+        labels = self.engine.known_labels()
+        if PIPELINED_START:
+            self.start_pipelined(labels)
+            return
+        if labels:
+            self.handle_vision_response(labels)
+            return
+
+        self.run_api_in_thread(self.engine_call("get_image_labels"), self.handle_vision_response,
+                               args=(self.engine.image_data,), message="Analyzing image tags (Vision API)...")
+
+    # [MOD] ラベルがまだなければ、Vision API を待たずにローカルのラベラーで作る
     def start_inquiry_no_vision(self):
-        if not self.image_data:
+        if not self.engine.image_data:
             messagebox.showwarning("No Photo", "Please select or capture a photo to start."); return
-        self.switch_frame(self.conversation_frame); self.set_display_photo(self.image_data)
-        self.conversation_phase = "conversation"
-        if self.initial_image_labels:
-            self.show_word_picker(self.initial_image_labels)
+        self.switch_frame(self.conversation_frame); self.set_display_photo(self.engine.image_data)
+        self.engine.conversation_phase = "conversation"
+        if self.engine.initial_image_labels and PIPELINED_START:
+            self.start_pipelined(self.engine.initial_image_labels)
+        elif self.engine.initial_image_labels:
+            self.show_word_picker(self.engine.initial_image_labels)
+        elif self.api.local_labeler is not None:
+            self.run_api_in_thread(self.engine_call("get_local_labels"), self.handle_local_labels,
+                                   args=(self.engine.image_data,), message="Analyzing image tags (on this PC)...")
         else:
             messagebox.showwarning("Analyze First","No labels yet. Click 'Start with Vision API' to analyze.")
 
+    def handle_local_labels(self, labels):
+        if not labels:
+            # モデルが読めない・画像が読めないなど。従来どおり Vision API で解析する
+            self.run_api_in_thread(self.engine_call("get_image_labels"), self.handle_vision_response,
+                                   args=(self.engine.image_data,), message="Analyzing image tags (Vision API)...")
+            return
+        self.append_chat("System", f"[Local labels: {labels}]")
+        if PIPELINED_START:
+            self.start_pipelined(labels)
+        else:
+            self.engine.set_labels(labels)
+            self.show_word_picker(labels)
+        if VISION_REFINE:
+            # Cloud Vision のラベルは裏で取り、届いたら差し替える (テーマにはこちらが保存される)
+            image_hash = self.engine.initial_image_hash
+            self.run_api_in_thread(self.engine_call("get_image_labels"),
+                                   lambda refined: self.handle_refined_labels(image_hash, refined),
+                                   args=(self.engine.image_data,), priority=BACKGROUND, scope="refine", silent=True)
+
+    def handle_refined_labels(self, image_hash, labels):
+        if not labels or image_hash != self.engine.initial_image_hash:
+            return  # Vision が失敗した、または写真が変わった
+        print(f"[DEBUG] Vision labels refined the local labels: {labels}")
+        if self.engine.selected_word:
+            self.engine.set_labels(labels)  # 会話はもう始まっている。保存するテーマのラベルだけ差し替える
+        elif PIPELINED_START:
+            self.start_pipelined(labels)
+        else:
+            self.handle_vision_response(labels)
+
     # v21.0から変更なし
     def handle_vision_response(self, labels):
         if labels is None:
             labels = []
-        self.initial_image_labels = labels; self.current_vision_labels = labels
+        self.engine.set_labels(labels)
         self.append_chat("System", f"[Vision API analysis complete. Labels: {labels}]")
         self.show_word_picker(labels)
 
-    # v21.0から変更なし
-    def _build_words_from_labels(self, labels, limit=10):
-        seen = set(); words = []
-        for lab in labels or []:
-            w = str(lab).replace("_"," ").split(",")[0].strip().lower()
-            if 2 <= len(w) <= 30 and w not in seen:
-                seen.add(w); words.append(w)
-            if len(words) >= limit: break
-        if len(words) < 3:
-            for w in ["animal","object","place","person","food","plant","color","shape","material","action"]:
-                if w not in seen:
-                    words.append(w); seen.add(w)
-                if len(words) >= limit: break
-        return words
+    # [MOD] パイプライン開始: Vision のラベルと Gemini のキーワード候補を同時に頼み、
+    # ラベルが届いたらいちばん選ばれそうなキーワードの1ターン目を裏で作り始める
+    def start_pipelined(self, labels=None):
+        slot = {"image_hash": self.engine.initial_image_hash, "labels": labels or None, "shortlist": None,
+                "word": None, "done": False, "joined": False}
+        self.cancel_requests("prefetch")
+        self.start_prefetch = slot
+        self.run_api_in_thread(self.engine_call("generate_keyword_shortlist"),
+                               lambda shortlist: self.handle_shortlist_response(slot, shortlist),
+                               args=(self.engine.image_data, PIPELINED_SHORTLIST), priority=BACKGROUND,
+                               scope="prefetch", silent=True)
+        if labels:
+            self.handle_pipelined_labels(slot, labels)
+            return
+        self.run_api_in_thread(self.engine_call("get_image_labels"),
+                               lambda labels: self.handle_pipelined_labels(slot, labels),
+                               args=(self.engine.image_data,), message="Analyzing image tags (Vision API)...")
+
+    def handle_pipelined_labels(self, slot, labels):
+        if slot is not self.start_prefetch:
+            return  # 写真が変わった、またはキーワードを選び終わった
+        slot["labels"] = labels or []
+        self.engine.set_labels(slot["labels"])
+        self.append_chat("System", f"[Vision API analysis complete. Labels: {slot['labels']}]")
+        self.show_word_picker(slot["labels"], slot["shortlist"])
+        word = self.engine.likeliest_word(slot["labels"], slot["shortlist"])
+        if word and self.api.response_cache.enabled:
+            slot["word"] = word
+            print(f"[DEBUG] Pipelined start: prefetching the first turn for '{word}'")
+            slot["request_id"] = self.run_api_in_thread(
+                self.engine_call("prefetch_first_turn"), lambda text: self.handle_first_turn_prefetch(slot, text),
+                args=(word, slot["labels"]), priority=BACKGROUND, scope="prefetch", silent=True)
+
+    def handle_shortlist_response(self, slot, shortlist):
+        if slot is not self.start_prefetch or not shortlist:
+            return
+        slot["shortlist"] = shortlist
+        print(f"[DEBUG] Pipelined start: Gemini keyword shortlist {shortlist}")
+        if slot["labels"] is not None and not self.engine.selected_word:
+            self.show_word_picker(slot["labels"], shortlist)  # Vision にない候補を足して表示し直す
+
+    def handle_first_turn_prefetch(self, slot, text):
+        if slot is not self.start_prefetch:
+            return
+        slot["done"] = True
+        if slot["joined"]:
+            # 先読み中のキーワードが選ばれて、この結果を待っていた (キャッシュに入ったので次はすぐ返る)
+            self.start_prefetch = None
+            self.hide_thinking()
+            self.request_first_turn("Starting conversation (Gemini)...")
+
+    def request_first_turn(self, message):
+        self.run_api_in_thread(self.engine_call("start_inquiry"), self.handle_initial_ai_response,
+                               args=self.engine.inquiry_args(), message=message, stream="chat")
 
     # v21.0から変更なし
     def _ensure_word_select_frame(self):
@@ -996,15 +721,13 @@ Here is the data from their learning session:
         for w in self.word_select_frame.winfo_children(): w.destroy()
         self.word_select_buttons = []
 
-    # v21.0から変更なし
-    def show_word_picker(self, labels):
+    # [MOD] shortlist (Gemini のキーワード候補) があれば Vision にない語も選択肢に足す
+    def show_word_picker(self, labels, shortlist=None):
         self._ensure_word_select_frame()
         tk.Label(self.word_select_frame, text="Choose a keyword to start the conversation",
                  font=("",12,"bold")).pack(pady=6)
         btns = tk.Frame(self.word_select_frame); btns.pack(pady=4)
-        words = self._build_words_from_labels(labels, limit=10)
-        
-        words = [w for w in words if w not in self.used_words_in_current_theme][:10]
+        words = self.engine.pipelined_word_choices(labels, shortlist, limit=10)
         
         if not words:
             tk.Label(self.word_select_frame, text="No new labels found. Try another photo.", fg="red").pack()
@@ -1014,54 +737,45 @@ Here is the data from their learning session:
                 b.pack(side=tk.LEFT, padx=4, pady=4); self.word_select_buttons.append(b)
         self.word_select_frame.pack(pady=8)
 
-    # v21.0から変更なし
+    # [MOD] パイプライン開始で先読みしていたキーワードなら、その結果を使う (ほかの先読みは捨てる)
     def on_word_selected(self, word):
-        self.selected_word = word
-        self.used_words_in_current_theme.add(word) 
+        slot = self.start_prefetch
+        self.start_prefetch = None  # 先読みは cancel_requests("session") で消さずに、ここで判断する
+        self.cancel_requests("session")
+        self.engine.select_word(word)
         self.append_chat("System", f"[Start from '{word}']")
         
-        if not self.current_theme_title:
-            self.current_theme_title = word
         if self.word_select_frame:
             self.word_select_frame.pack_forget()
-        
-        self.run_api_in_thread(self.api_start_inquiry, self.handle_initial_ai_response,
-                             args=(self.initial_image_data, word, self.initial_image_labels), 
-                               message="Starting conversation (Gemini)...")
+
+        if (slot is not None and slot["word"] == word and not slot["done"]
+                and slot["image_hash"] == self.engine.initial_image_hash):
+            # 先読みがまだ終わっていなければ、新しく呼ばずにその結果を待つ (生徒が待つので優先度を上げる)
+            slot["joined"] = True
+            self.start_prefetch = slot
+            self.promote_request(slot["request_id"])
+            self.show_thinking("Starting conversation (Gemini)...")
+            return
+        # 選ばれなかった先読みは捨てる (終わっていれば応答キャッシュに残っているだけ)
+        self.cancel_requests("prefetch")
+        self.request_first_turn("Starting conversation (Gemini)...")
 
     # v21.0から変更なし
     def _parse_and_display_choices(self, ai_response):
         for w in self.conversation_choice_frame.winfo_children():
             w.destroy()
             
-        choices_match = re.search(r"CHOICES: \[(.+?)\](?:\n|$)", ai_response, re.DOTALL | re.IGNORECASE)
-        if choices_match:
-            choices_str = choices_match.group(1).strip()
-            choices = []
-            if re.search(r"\[.+?\]", choices_str):
-                choices = [c.strip() for c in re.findall(r"\[([^\]]+)\]", choices_str)]
-            else:
-                choices = [c.strip() for c in choices_str.split(',')]
-            
-            if choices:
-                choice_label = tk.Label(self.conversation_choice_frame, 
-                                        text=f"Hint (Choices): {', '.join(choices)}", 
-                                        font=("", 10, "italic"), fg="gray")
-                choice_label.pack()
-                ai_response = re.sub(r"CHOICES: \[(.+?)\](?:\n|$)", "", ai_response, flags=re.DOTALL | re.IGNORECASE)
-        
-        return ai_response.strip()
+        choices, ai_response = parse_choices(ai_response)
+        if choices:
+            choice_label = tk.Label(self.conversation_choice_frame, 
+                                    text=f"Hint (Choices): {', '.join(choices)}", 
+                                    font=("", 10, "italic"), fg="gray")
+            choice_label.pack()
+        return ai_response
 
     # v21.0から変更なし
     def _parse_translation(self, ai_response_cleaned):
-        if "[TRANSLATION]" in ai_response_cleaned:
-            parts = ai_response_cleaned.split("[TRANSLATION]", 1)
-            english_chat = parts[0].strip()
-            japanese_chat = parts[1].strip()
-        else:
-            english_chat = ai_response_cleaned.strip()
-            japanese_chat = None
-        return english_chat, japanese_chat
+        return parse_translation(ai_response_cleaned)
 
     # v21.0から変更なし
     def handle_initial_ai_response(self, ai_response):
@@ -1111,15 +825,15 @@ Here is the data from their learning session:
         for w in self.conversation_choice_frame.winfo_children():
             w.destroy()
             
-        if self.conversation_phase == "conversation":
-            self.run_api_in_thread(self.api_continue_conversation, self.handle_ai_response,
-                                   args=(msg,), message="AI is thinking...")
+        if self.engine.conversation_phase == "conversation":
+            self.run_api_in_thread(self.engine_call("continue_conversation"), self.handle_ai_response,
+                                   args=(msg,), message="AI is thinking...", stream="chat")
         else:
-            print(f"Warning: Text input ignored during '{self.conversation_phase}' phase.")
+            print(f"Warning: Text input ignored during '{self.engine.conversation_phase}' phase.")
 
     # v21.0から変更なし
     def go_to_story_quiz(self):
-        self.conversation_phase = "quiz" 
+        self.engine.start_story()
         self.user_input_entry.config(state=tk.DISABLED)
         self.send_button.config(state=tk.DISABLED)
         self.go_to_story_button.pack_forget() 
@@ -1131,13 +845,10 @@ Here is the data from their learning session:
         self.quiz_story_display_frame.pack(fill=tk.BOTH, expand=True) 
         self.continue_inquiry_frame.pack_forget() 
         
-        self.current_quiz_results = []
-        self.current_story_text = ""
-        self.current_story_translation = ""
-        
         try:
-            self.run_api_in_thread(self.api_generate_story, self.handle_story_response,
-                                   message="Generating English story (Gemini)...")
+            story_func = self.engine_call("generate_story_with_quizzes" if COMBINED_STORY_QUIZ else "generate_story")
+            self.run_api_in_thread(story_func, self.handle_story_response,
+                                   message="Generating English story (Gemini)...", stream="story")
         except Exception as e:
             self.append_chat("System", f"[Error in story generation: {e}]")
 
@@ -1149,8 +860,8 @@ Here is the data from their learning session:
             
         tk.Label(self.theme_frame, text="Saved Themes", font=("", 16, "bold")).pack(pady=10)
 
-        # [MOD] v21.1 (R2) self.theme_history はロード済み
-        if not self.theme_history:
+        # [MOD] v21.1 (R2) self.engine.theme_history はロード済み
+        if not self.engine.theme_history:
             tk.Label(self.theme_frame, text="No themes have been saved yet.").pack(pady=20)
             
             # [NEW] v21.1: もしテーマがなくても、設定画面（レベル選択）に戻らず
@@ -1160,93 +871,161 @@ Here is the data from their learning session:
                       command=self.go_to_photo_selection).pack(pady=20)
             return
 
-        self.theme_photo_references = []
-        
-        canvas = tk.Canvas(self.theme_frame)
-        scrollbar = tk.Scrollbar(self.theme_frame, orient="vertical", command=canvas.yview)
-        scrollable_frame = tk.Frame(canvas)
-        
-        scrollable_frame.bind(
-            "<Configure>",
-            lambda e: canvas.configure(scrollregion=canvas.bbox("all"))
-        )
-        
-        canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
-        canvas.configure(yscrollcommand=scrollbar.set)
-        
-        canvas.pack(side="left", fill="both", expand=True, padx=10)
+        # 表示するテーマ (ページ分けする場合は現在のページ分だけ)
+        themes = self.engine.theme_history
+        if self.theme_page_size > 0:
+            page_count = (len(themes) + self.theme_page_size - 1) // self.theme_page_size
+            self.theme_page = max(0, min(self.theme_page, page_count - 1))
+            start = self.theme_page * self.theme_page_size
+            themes = themes[start:start + self.theme_page_size]
+            if page_count > 1:
+                page_nav = tk.Frame(self.theme_frame); page_nav.pack(pady=(0, 5))
+                tk.Button(page_nav, text="< Prev", state=tk.NORMAL if self.theme_page > 0 else tk.DISABLED,
+                          command=lambda: self.change_theme_page(-1)).pack(side=tk.LEFT, padx=5)
+                tk.Label(page_nav, text=f"Page {self.theme_page + 1} / {page_count}").pack(side=tk.LEFT, padx=5)
+                tk.Button(page_nav, text="Next >", state=tk.NORMAL if self.theme_page < page_count - 1 else tk.DISABLED,
+                          command=lambda: self.change_theme_page(1)).pack(side=tk.LEFT, padx=5)
+        self.theme_list_themes = themes
+
+        # 仮想化リスト: 画面に見えている行の分だけ行フレームを作り、スクロールしたら使い回す
+        self.theme_rows = []
+        self.theme_canvas = tk.Canvas(self.theme_frame, highlightthickness=0)
+        scrollbar = tk.Scrollbar(self.theme_frame, orient="vertical", command=self.on_theme_list_scroll)
+        self.theme_canvas.configure(yscrollcommand=scrollbar.set, yscrollincrement=20,
+                                    scrollregion=(0, 0, 0, len(themes) * self.theme_row_height))
+        self.theme_canvas.bind("<Configure>", lambda e: self.render_visible_theme_rows())
+
+        self.theme_canvas.pack(side="left", fill="both", expand=True, padx=10)
         scrollbar.pack(side="right", fill="y")
+        self.render_visible_theme_rows()
 
-        for i, theme in enumerate(self.theme_history):
-            theme_entry_frame = tk.Frame(scrollable_frame, relief=tk.RAISED, borderwidth=2, pady=10)
-            theme_entry_frame.pack(fill=tk.X, expand=True, pady=5, padx=10)
-            
-            header_frame = tk.Frame(theme_entry_frame)
-            header_frame.pack(fill=tk.X)
-            
-            try:
-                # [MOD] v21.1 (R3) 
-                # theme["image_data"] はロード時にバイナリに戻されている
-                if "image_data" not in theme or not isinstance(theme["image_data"], bytes):
-                    raise ValueError("Image data not found or invalid type")
-                    
-                img = PIL.Image.open(io.BytesIO(theme["image_data"]))
-                img.thumbnail((100, 100))
-                photo = ImageTk.PhotoImage(img)
-                self.theme_photo_references.append(photo) 
-                
-                img_label = tk.Label(header_frame, image=photo, relief="solid")
-                img_label.pack(side=tk.LEFT, padx=10)
-            except Exception as e:
-                print(f"Error loading theme image: {e}")
-                tk.Label(header_frame, text="[Image Error]", relief="solid", width=10, height=5).pack(side=tk.LEFT, padx=10)
-
-            tk.Label(header_frame, text=f"Theme: \"{theme['title']}\"", font=("", 14, "bold")).pack(side=tk.LEFT, anchor=tk.W, padx=10)
+    def change_theme_page(self, delta):
+        self.theme_page += delta
+        self.show_theme_history_page()
 
-            tk.Frame(theme_entry_frame, height=2, bg="gray").pack(fill=tk.X, padx=10, pady=(10, 5)) 
+    def on_theme_list_scroll(self, *args):
+        self.theme_canvas.yview(*args)
+        self.render_visible_theme_rows()
 
-            words_frame = tk.Frame(theme_entry_frame)
-            words_frame.pack(fill=tk.X, padx=10)
-            
-            tk.Label(words_frame, text="Review Studied Words:", font=("", 11, "italic"), fg="gray").pack(anchor=tk.W)
-            word_buttons_studied = tk.Frame(words_frame)
-            word_buttons_studied.pack(fill=tk.X)
-            
-            # [MOD] v21.1: word_sessions が存在しない場合を考慮
-            studied_words = theme.get("word_sessions", {}).keys()
-            if not studied_words:
-                tk.Label(word_buttons_studied, text="No words studied for this theme yet.", fg="gray").pack(anchor=tk.W, pady=2)
+    def render_visible_theme_rows(self):
+        canvas = self.theme_canvas
+        if not canvas.winfo_exists():
+            return
+        themes = self.theme_list_themes
+        row_h = self.theme_row_height
+        width = max(canvas.winfo_width() - 20, 100)
+        top = canvas.canvasy(0)
+        height = max(canvas.winfo_height(), row_h)
+        canvas.configure(scrollregion=(0, 0, width, len(themes) * row_h))
+
+        first = max(0, int(top // row_h))
+        last = min(len(themes) - 1, int((top + height) // row_h))
+        needed = max(0, last - first + 1)
+
+        while len(self.theme_rows) < needed:
+            self.theme_rows.append(self._create_theme_row())
+
+        for j, row in enumerate(self.theme_rows):
+            index = first + j
+            if j < needed:
+                if row["index"] != index or row["theme"] is not themes[index]:
+                    self._bind_theme_row(row, themes[index])
+                    row["index"] = index
+                canvas.coords(row["window"], 10, index * row_h)
+                canvas.itemconfigure(row["window"], width=width, state="normal")
             else:
-                for word in studied_words:
-                    b = tk.Button(word_buttons_studied, text=word, fg="gray",
-                                  command=lambda t=theme, w=word: self.show_review_page(t, w))
-                    b.pack(side=tk.LEFT, padx=4, pady=4)
+                canvas.itemconfigure(row["window"], state="hidden")
+                row["index"] = None
+
+    def _create_theme_row(self):
+        theme_entry_frame = tk.Frame(self.theme_canvas, relief=tk.RAISED, borderwidth=2, pady=10)
+        window = self.theme_canvas.create_window(10, 0, window=theme_entry_frame, anchor="nw",
+                                                 height=self.theme_row_height - 10)
+
+        header_frame = tk.Frame(theme_entry_frame)
+        header_frame.pack(fill=tk.X)
+        img_label = tk.Label(header_frame, relief="solid")
+        img_label.pack(side=tk.LEFT, padx=10)
+        title_label = tk.Label(header_frame, font=("", 14, "bold"))
+        title_label.pack(side=tk.LEFT, anchor=tk.W, padx=10)
+
+        tk.Frame(theme_entry_frame, height=2, bg="gray").pack(fill=tk.X, padx=10, pady=(10, 5))
+
+        words_frame = tk.Frame(theme_entry_frame)
+        words_frame.pack(fill=tk.X, padx=10)
+        tk.Label(words_frame, text="Review Studied Words:", font=("", 11, "italic"), fg="gray").pack(anchor=tk.W)
+        word_buttons_studied = tk.Frame(words_frame)
+        word_buttons_studied.pack(fill=tk.X)
+        tk.Label(words_frame, text="Start New Inquiry:", font=("", 11, "italic"), fg="green").pack(anchor=tk.W, pady=(10,0))
+        word_buttons_new = tk.Frame(words_frame)
+        word_buttons_new.pack(fill=tk.X)
+
+        return {"window": window, "img_label": img_label, "title_label": title_label,
+                "studied": word_buttons_studied, "new": word_buttons_new, "index": None, "theme": None}
+
+    def _bind_theme_row(self, row, theme):
+        row["theme"] = theme
+        img_label = row["img_label"]
+        try:
+            photo = self.get_theme_photo(theme.image_hash)
+            img_label.config(image=photo, text="", width=0, height=0); img_label.image = photo
+        except Exception as e:
+            print(f"Error loading theme image: {e}")
+            img_label.config(image="", text="[Image Error]", width=10, height=5); img_label.image = None
 
-            tk.Label(words_frame, text="Start New Inquiry:", font=("", 11, "italic"), fg="green").pack(anchor=tk.W, pady=(10,0))
-            word_buttons_new = tk.Frame(words_frame)
-            word_buttons_new.pack(fill=tk.X)
+        row["title_label"].config(text=f"Theme: \"{theme.title}\"")
 
-            all_labels = set(self._build_words_from_labels(theme.get('all_labels', []), limit=10))
-            available_words = all_labels - set(studied_words)
-            
-            if not available_words:
-                tk.Label(word_buttons_new, text="No more new keywords available for this theme.", fg="gray").pack(anchor=tk.W, pady=2)
-            else:
-                for word in available_words:
-                    b = tk.Button(word_buttons_new, text=word, fg="green",
-                                  command=lambda t=theme, w=word: self.on_word_selected_from_theme_tab(t, w))
-                    b.pack(side=tk.LEFT, padx=4, pady=4)
+        word_buttons_studied = row["studied"]; word_buttons_new = row["new"]
+        for w in word_buttons_studied.winfo_children() + word_buttons_new.winfo_children():
+            w.destroy()
+
+        studied_words = theme.word_sessions.keys()
+        if not studied_words:
+            tk.Label(word_buttons_studied, text="No words studied for this theme yet.", fg="gray").pack(anchor=tk.W, pady=2)
+        else:
+            for word in studied_words:
+                b = tk.Button(word_buttons_studied, text=word, fg="gray",
+                              command=lambda t=theme, w=word: self.show_review_page(t, w))
+                b.pack(side=tk.LEFT, padx=4, pady=4)
+
+        all_labels = set(words_from_labels(theme.all_labels, limit=10))
+        available_words = all_labels - set(studied_words)
+
+        if not available_words:
+            tk.Label(word_buttons_new, text="No more new keywords available for this theme.", fg="gray").pack(anchor=tk.W, pady=2)
+        else:
+            for word in available_words:
+                b = tk.Button(word_buttons_new, text=word, fg="green",
+                              command=lambda t=theme, w=word: self.on_word_selected_from_theme_tab(t, w))
+                b.pack(side=tk.LEFT, padx=4, pady=4)
+
+    def get_theme_photo(self, image_hash):
+        # 保存済みサムネイル (100px) から PhotoImage を作り、LRU に残して再表示時は使い回す
+        photo = self.theme_photo_cache.get(image_hash)
+        if photo is not None:
+            self.theme_photo_cache.move_to_end(image_hash)
+            return photo
+
+        thumb_bytes = self.profile.images.get_thumbnail(image_hash)
+        if not isinstance(thumb_bytes, bytes):
+            raise ValueError("Image data not found or invalid type")
+        photo = ImageTk.PhotoImage(PIL.Image.open(io.BytesIO(thumb_bytes)))
+
+        self.theme_photo_cache[image_hash] = photo
+        while len(self.theme_photo_cache) > self.theme_photo_cache_size:
+            self.theme_photo_cache.popitem(last=False)
+        return photo
 
     # v21.0から変更なし
     def show_review_page(self, theme, word):
         try:
-            session_data = theme["word_sessions"][word]
+            session_data = theme.word_sessions[word]
         except KeyError:
             messagebox.showerror("Error", "Could not find the session data for this word.")
             return
 
         win = Toplevel(self.master)
-        win.title(f"Review: {theme['title']} - {word}")
+        win.title(f"Review: {theme.title} - {word}")
         win.geometry("700x700") 
         
         main_frame = tk.Frame(win)
@@ -1265,18 +1044,18 @@ Here is the data from their learning session:
         scrollbar.pack(side="right", fill="y")
 
         tk.Label(scrollable_frame, text="Story:", font=("", 14, "bold")).pack(anchor=tk.W, pady=(5,0))
-        story_text = session_data.get("story", "No story recorded.")
+        story_text = session_data.story or "No story recorded."
         tk.Label(scrollable_frame, text=story_text, wraplength=650, justify=tk.LEFT).pack(anchor=tk.W, pady=5)
         
-        story_translation = session_data.get("story_translation", "(No translation recorded.)")
+        story_translation = session_data.story_translation or "(No translation recorded.)"
         tk.Label(scrollable_frame, text="日本語訳:", font=("", 12, "bold"), fg="blue").pack(anchor=tk.W, pady=(10,0))
         tk.Label(scrollable_frame, text=story_translation, wraplength=650, justify=tk.LEFT, fg="blue").pack(anchor=tk.W, pady=5)
         
         tk.Frame(scrollable_frame, height=2, bg="gray").pack(fill=tk.X, pady=10)
 
         tk.Label(scrollable_frame, text="Quizzes:", font=("", 14, "bold")).pack(anchor=tk.W, pady=5)
-        quizzes = session_data.get("quizzes", [])
-        user_answers = session_data.get("user_answers", [])
+        quizzes = session_data.quizzes
+        user_answers = session_data.user_answers
         
         if not quizzes:
             tk.Label(scrollable_frame, text="No quizzes recorded.").pack(anchor=tk.W)
@@ -1300,8 +1079,8 @@ Here is the data from their learning session:
         tk.Frame(scrollable_frame, height=2, bg="gray").pack(fill=tk.X, pady=10)
         tk.Label(scrollable_frame, text="Summary Card:", font=("", 14, "bold")).pack(anchor=tk.W, pady=5)
         
-        if "summary_card" in session_data:
-            summary_data = session_data["summary_card"]
+        if session_data.summary_card is not None:
+            summary_data = session_data.summary_card
             
             def create_summary_field(parent, label_text, content_text, color_fg, color_bg):
                 tk.Label(parent, text=label_text, font=("", 12, "bold"), fg=color_fg).pack(anchor=tk.W, pady=(5,0))
@@ -1335,7 +1114,7 @@ Here is the data from their learning session:
             button_text = "[Create Summary Card]"
 
         summary_button = tk.Button(win, text=button_text, font=("", 12, "bold"),
-                                   command=lambda s=session_data: self.open_summary_creator(s))
+                                   command=lambda t=theme, w=word: self.open_summary_creator(t, w))
         summary_button.pack(pady=10, side=tk.BOTTOM)
 
         win.transient(self.master)
@@ -1357,16 +1136,9 @@ Here is the data from their learning session:
 
     # v21.0から変更なし
     def start_inquiry_from_theme(self, theme, word):
+        self.cancel_requests("session")
         self.switch_frame(self.conversation_frame)
-        
-        self.conversation_phase = "conversation"
-        self.conversation_history = []
-        self.chat_session = None
-        self.quiz_data = []
-        self.current_quiz_index = 0
-        self.current_quiz_results = [] 
-        self.current_story_text = ""
-        self.current_story_translation = ""
+        self.engine.load_theme(theme, word)
 
         self.chat_history_text.config(state=tk.NORMAL)
         self.chat_history_text.delete('1.0', tk.END)
@@ -1375,25 +1147,28 @@ Here is the data from their learning session:
         self.send_button.config(state=tk.NORMAL)
         self.go_to_story_button.pack(pady=10) 
         
-        self.initial_image_data = theme['image_data']
-        self.initial_image_labels = theme.get('all_labels', []) # [MOD] v21.1: .get()
-        self.current_theme_title = theme['title']
-        self.used_words_in_current_theme = set(theme.get("word_sessions", {}).keys()) # [MOD] v21.1
-        
-        self.set_display_photo(self.initial_image_data)
+        self.set_display_photo(self.engine.initial_image_data)
         
-        self.selected_word = word
-        self.used_words_in_current_theme.add(word) 
-        self.append_chat("System", f"[Continuing theme '{self.current_theme_title}' with new keyword: '{word}']")
+        self.append_chat("System", f"[Continuing theme '{self.engine.current_theme_title}' with new keyword: '{word}']")
         
-        self.run_api_in_thread(self.api_start_inquiry, self.handle_initial_ai_response,
-                             args=(self.initial_image_data, word, self.initial_image_labels), 
-                               message="Starting new topic (Gemini)...")
+        self.run_api_in_thread(self.engine_call("start_inquiry"), self.handle_initial_ai_response,
+                             args=self.engine.inquiry_args(), 
+                               message="Starting new topic (Gemini)...", stream="chat")
 
     # v21.0から変更なし
     def on_exit(self):
         print("Saving profile...")
-        self.profile.save() 
+        # テーマ・セッションは保存時に書き込み済みなので、設定項目だけを保存する
+        self.profile.save_fields("grade", "current_level", "coins")
+        self.profile.close()  # 書き込みスレッドに残っている保存要求をすべて書き出す
+        print(f"[DEBUG] Gemini cache: {self.api.response_cache.stats()}")
+        print(f"[DEBUG] API worker pool: {self.api_pool.metrics()}")
+        self.api_pool.shutdown()
+        if self.api.local_labeler is not None:
+            self.api.local_labeler.shutdown()
+        if self.api_loop is not None:
+            print(f"[DEBUG] Async API: {self.aapi.stats()}")
+            self.api_loop.stop()
         
         for p in self.temp_files:
             try:
@@ -1404,35 +1179,42 @@ Here is the data from their learning session:
         
     # v21.0から変更なし
     def handle_story_response(self, ai_response):
-        if not ai_response:
-            ai_story_full = "Error: No story generated."
-            self.story_chat_history = self.conversation_history 
-        else:
-            ai_story_full, story_chat_history = ai_response
-            self.story_chat_history = story_chat_history 
-            
-        try:
-            if "[TRANSLATION]" in ai_story_full:
-                parts = ai_story_full.split("[TRANSLATION]", 1)
-                self.current_story_text = parts[0].strip()
-                self.current_story_translation = parts[1].strip()
-            else:
-                self.current_story_text = ai_story_full.strip()
-                self.current_story_translation = "(No translation provided by AI.)"
-        except Exception as e:
-            print(f"Error parsing story translation: {e}")
-            self.current_story_text = ai_story_full
-            self.current_story_translation = "(Error parsing translation.)"
+        self.engine.apply_story(ai_response)
             
         self.story_text_widget.config(state=tk.NORMAL)
         self.story_text_widget.delete('1.0', tk.END)
-        self.story_text_widget.insert(tk.END, self.current_story_text) 
+        self.story_text_widget.insert(tk.END, self.engine.current_story_text) 
         self.story_text_widget.config(state=tk.DISABLED)
         
-        self.append_chat("AI", f"OK, here is today's English story!\n\n{self.current_story_text}")
+        self.append_chat("AI", f"OK, here is today's English story!\n\n{self.engine.current_story_text}")
         
         self.start_quiz_button.pack(pady=10)
 
+        # 生徒がストーリーを読んでいる間にクイズを作り始めておく
+        if ai_response and not self.engine.story_quizzes:
+            self.prefetch_quizzes()
+
+    def prefetch_quizzes(self):
+        slot = {"done": False, "quizzes": None, "joined": False}
+        self.quiz_prefetch = slot
+        slot["request_id"] = self.run_api_in_thread(
+            self.engine_call("generate_quizzes"), lambda quizzes: self.handle_quiz_prefetch_response(slot, quizzes),
+            kwargs=self.engine.quiz_request_kwargs(), priority=BACKGROUND, silent=True)
+
+    def handle_quiz_prefetch_response(self, slot, quizzes):
+        if slot is not self.quiz_prefetch:
+            return  # セッションが変わった
+        slot["done"] = True
+        slot["quizzes"] = quizzes
+        if slot["joined"]:
+            # Start Quiz が押されて、この結果を待っていた
+            self.quiz_prefetch = None
+            self.hide_thinking()
+            if quizzes:
+                self.handle_quiz_bulk_response(quizzes)
+            else:
+                self.request_quizzes()
+
     # v21.0から変更なし
     def start_quizzes(self):
         self.start_quiz_button.pack_forget() 
@@ -1442,25 +1224,40 @@ Here is the data from their learning session:
         self.quiz_hint_label.pack(pady=5)
         self.quiz_feedback_label.pack(pady=10, padx=20)
         
-        self.quiz_data = [] 
-        self.current_quiz_index = 0
-        
+        self.engine.set_quizzes([])
+
+        if self.engine.story_quizzes:
+            self.handle_quiz_bulk_response(self.engine.take_story_quizzes())
+            return
+
+        slot = self.quiz_prefetch
+        if slot is not None:
+            if not slot["done"]:
+                # 先読みがまだ終わっていなければ、新しく呼ばずにその結果を待つ (生徒が待つので優先度を上げる)
+                slot["joined"] = True
+                self.promote_request(slot["request_id"])
+                self.show_thinking(f"Creating {self.engine.total_quizzes_to_generate} quizzes (bulk)...")
+                return
+            self.quiz_prefetch = None
+            if slot["quizzes"]:
+                self.handle_quiz_bulk_response(slot["quizzes"])
+                return
+
+        self.request_quizzes()
+
+    def request_quizzes(self):
         self.run_api_in_thread(
-            self.api_generate_quizzes_bulk,
+            self.engine_call("generate_quizzes"),
             self.handle_quiz_bulk_response,
-            kwargs={
-                "story_chat_history": self.story_chat_history,
-                "total_quizzes": self.total_quizzes_to_generate,
-                "previous_quiz_questions": []
-            },
-            message=f"Creating {self.total_quizzes_to_generate} quizzes (bulk)..."
+            kwargs=self.engine.quiz_request_kwargs(),
+            message=f"Creating {self.engine.total_quizzes_to_generate} quizzes (bulk)..."
         )
     def handle_quiz_bulk_response(self, quizzes):
             if not quizzes:
                 self.quiz_question_label.config(text="Error: No quiz generated.")
                 return
 
-            self.quiz_data = quizzes
+            self.engine.set_quizzes(quizzes)
             self.append_chat("AI", f"[Bulk quizzes generated: {len(quizzes)} questions]")
             self.show_current_quiz_question()
 
@@ -1468,7 +1265,8 @@ Here is the data from their learning session:
             
     # v21.0から変更なし
     def show_current_quiz_question(self):
-        if self.current_quiz_index >= len(self.quiz_data):
+        quiz = self.engine.current_quiz()
+        if quiz is None:
             print("Error: show_current_quiz_question called but no more quizzes in data.")
             return
             
@@ -1480,17 +1278,14 @@ Here is the data from their learning session:
         self.quiz_answer_entry.delete(0, tk.END)
         self.quiz_submit_button.config(state=tk.NORMAL)
         
-        quiz = self.quiz_data[self.current_quiz_index]
         q_type = (quiz.get("type") or "").strip()
         type_tag = "T/F" if q_type.lower().startswith("true") else ("FIB" if q_type.lower().startswith("fill") else "")
-        prefix = f"Q{self.current_quiz_index + 1}"
+        prefix = f"Q{self.engine.current_quiz_index + 1}"
         if type_tag:
             prefix = f"{prefix} [{type_tag}]"
         self.quiz_question_label.config(text=f"{prefix}: {quiz['q']}")
-
-        self.correct_answer = quiz["a"]
         
-        if self.grade in ["小学生以下", "1-2年生", "3-4年生"]:
+        if self.engine.grade in ["小学生以下", "1-2年生", "3-4年生"]:
             hint_text = f"Choices: {', '.join(quiz['c'])}"
             self.quiz_hint_label.config(text=hint_text)
         else: 
@@ -1498,35 +1293,26 @@ Here is the data from their learning session:
 
     # v21.0から変更なし
     def check_quiz_answer(self):
-        selected_choice = self.quiz_answer_entry.get().strip()
-        normalized = selected_choice.strip().lower()
-        if normalized in ("t", "true"):
-            selected_choice = "True"
-        elif normalized in ("f", "false"):
-            selected_choice = "False"
-
-        if not selected_choice: return 
+        result = self.engine.check_answer(self.quiz_answer_entry.get())
+        if result is None: return 
+        selected_choice, correct, correct_answer = result
 
         self.append_chat("You", selected_choice) 
         
-        self.current_quiz_results.append(selected_choice)
-        
         self.quiz_answer_entry.config(state=tk.DISABLED)
         self.quiz_submit_button.config(state=tk.DISABLED)
 
-        if selected_choice.lower() == self.correct_answer.lower():
+        if correct:
             feedback = "Correct! Great job! (+10 Coins 🪙)"
             feedback_color = "green"
-            self.add_coins(10) 
         else:
-            feedback = f"Sorry, the correct answer was: {self.correct_answer}"
+            feedback = f"Sorry, the correct answer was: {correct_answer}"
             feedback_color = "red"
 
         self.quiz_feedback_label.config(text=feedback, fg=feedback_color)
         
-        self.current_quiz_index += 1
-        if self.current_quiz_index < self.total_quizzes_to_generate:
-            self.next_step_button.config(text=f"Next Question ({self.current_quiz_index + 1}/{self.total_quizzes_to_generate})")
+        if self.engine.current_quiz_index < self.engine.total_quizzes_to_generate:
+            self.next_step_button.config(text=f"Next Question ({self.engine.current_quiz_index + 1}/{self.engine.total_quizzes_to_generate})")
 
         else:
             self.next_step_button.config(text="Finish Quizzes")
@@ -1535,7 +1321,7 @@ Here is the data from their learning session:
         
         # v21.0から変更なし
     def on_next_quiz_step(self):
-         if self.current_quiz_index < self.total_quizzes_to_generate:
+         if not self.engine.quizzes_finished():
             # すでに生成済みのクイズを進めるだけ（API呼び出しなし）
             self.next_step_button.pack_forget()
             self.quiz_feedback_label.config(text="")
@@ -1543,66 +1329,12 @@ Here is the data from their learning session:
             self.quiz_hint_label.config(text="")
             self.show_current_quiz_question()
          else:
-            self.save_or_update_theme()
+            self.engine.save_theme()
             self.show_next_step_options()
 
     
 
 
-    def save_or_update_theme(self):
-        if not self.initial_image_data or not self.current_theme_title:
-            print("Theme save skipped: No image data or title.")
-            return
-        if not self.selected_word:
-            print("Theme save skipped: No word was selected for this session.")
-            return
-
-        existing_theme = None
-        for theme in self.theme_history:
-             # [MOD] v21.1 (R3) 
-             # バイナリデータ（self.initial_image_data）と
-             # 既存のテーマのバイナリデータ（theme["image_data"]）を比較
-            if "image_data" in theme and theme["image_data"] == self.initial_image_data:
-                existing_theme = theme
-                break
-        
-        session_data = {
-            # [MOD] v21.1 (R5) 会話履歴は保存しない
-            # "history": self.conversation_history, 
-            "story": self.current_story_text,
-            "story_translation": self.current_story_translation, 
-            "quizzes": self.quiz_data,
-            "user_answers": self.current_quiz_results
-        }
-        
-        if existing_theme:
-            if self.selected_word in existing_theme["word_sessions"] and "summary_card" in existing_theme["word_sessions"][self.selected_word]:
-                session_data["summary_card"] = existing_theme["word_sessions"][self.selected_word]["summary_card"]
-            
-            # [MOD] v21.1: word_sessions がない場合を考慮
-            if "word_sessions" not in existing_theme:
-                existing_theme["word_sessions"] = {}
-                
-            existing_theme["word_sessions"][self.selected_word] = session_data
-            print(f"Theme '{existing_theme['title']}' updated with session for '{self.selected_word}'.")
-        else:
-            new_theme = {
-                "title": self.current_theme_title, 
-                "image_data": self.initial_image_data, # [MOD] v21.1: バイナリデータ
-                "all_labels": self.initial_image_labels,
-                "word_sessions": {
-                    self.selected_word: session_data 
-                }
-            }
-            self.theme_history.append(new_theme)
-            print(f"New theme '{self.current_theme_title}' saved.")
-        
-        # [NEW] v21.1 (R4) プロファイル全体を保存
-        self.profile.set("theme_history", self.theme_history)
-        self.profile.save()
-        
-        self._get_next_daily_mission()
-
     # v21.0から変更なし
     def show_next_step_options(self):
         self.quiz_story_display_frame.pack_forget()
@@ -1626,38 +1358,42 @@ Here is the data from their learning session:
         self.tag_buttons_frame = tk.Frame(self.content_word_picker_frame); self.tag_buttons_frame.pack(pady=4)
         tk.Label(self.tag_buttons_frame, text="Loading tag suggestions...", fg="gray").pack()
 
-        current_theme_used_words = set()
-        for theme in self.theme_history:
-            if "image_data" in theme and theme["image_data"] == self.initial_image_data:
-                current_theme_used_words = set(theme.get("word_sessions", {}).keys())
-                break
-        self.current_theme_used_words = current_theme_used_words
-
-        self.run_api_in_thread(self.api_generate_tag_choices, self.handle_tag_response,
-                               message="Generating tag choices (Gemini)...")
-        self.run_api_in_thread(self.api_generate_mission_choices, self.handle_mission_response,
-                               message="Generating next mission (Gemini)...")
+        if COMBINED_NEXT_STEPS:
+            self.run_api_in_thread(self.engine.generate_next_steps, self.handle_next_steps_response,
+                                   message="Generating next steps (Gemini)...", priority=BACKGROUND)
+        else:
+            self.request_tag_and_mission_choices()
 
         tk.Frame(self.continue_inquiry_frame, height=2, bg="gray").pack(fill=tk.X, padx=50, pady=20)
         tk.Button(self.continue_inquiry_frame, text="Start a New Photo", font=("", 12, "bold"),
                   command=self.go_to_photo_selection).pack(pady=10)
     
 
+    def request_tag_and_mission_choices(self):
+        self.run_api_in_thread(self.engine.generate_tag_choices, self.handle_tag_response,
+                               message="Generating tag choices (Gemini)...", priority=BACKGROUND)
+        self.run_api_in_thread(self.engine.generate_mission_choices, self.handle_mission_response,
+                               message="Generating next mission (Gemini)...", priority=BACKGROUND)
+
+    def handle_next_steps_response(self, steps):
+        if not steps:
+            # まとめた応答が読めなければ、従来どおり別々に作る
+            print("[DEBUG] Combined next-steps response unusable; falling back to separate calls.")
+            self.request_tag_and_mission_choices()
+            return
+        self.handle_tag_response(steps["tag"])
+        self.handle_mission_response(steps["mission"])
+
     def handle_tag_response(self, ai_text):
         if not getattr(self, "tag_buttons_frame", None):
             return
         for w in self.tag_buttons_frame.winfo_children():
             w.destroy()
 
-        question, choices = parse_question_choices(ai_text or "")
+        question, choices = self.engine.tag_choices(ai_text)
         if question:
             self.tag_question_label.config(text=question)
 
-        if not choices:
-            words = self._build_words_from_labels(self.initial_image_labels, limit=10)
-            words = [w for w in words if w not in self.current_theme_used_words][:10]
-            choices = words
-
         if not choices:
             tk.Label(self.tag_buttons_frame, text="No more keywords available for this photo.", fg="gray").pack()
             return
@@ -1672,22 +1408,12 @@ Here is the data from their learning session:
         for w in self.mission_buttons_frame.winfo_children():
             w.destroy()
 
-        question, choices = parse_question_choices(ai_text or "")
+        question, choices = self.engine.mission_choices(ai_text)
         if question:
             self.mission_question_label.config(text=question)
         else:
             self.mission_question_label.config(text="Which keyword would you like to photograph next?")
 
-        if not choices:
-            choices = re.findall(r"<([^>]+)>", self.current_story_text or "")
-            choices = [c.strip() for c in choices if c.strip()]
-            if not choices:
-                choices = self._build_words_from_labels(self.initial_image_labels, limit=3)
-
-        choices = list(dict.fromkeys(choices))
-        if "ホームに戻る" not in choices:
-            choices.append("ホームに戻る")
-
         for c in choices:
             b = tk.Button(self.mission_buttons_frame, text=c, width=18, command=lambda x=c: self.on_mission_choice(x))
             b.pack(side=tk.LEFT, padx=4, pady=4)
@@ -1705,15 +1431,9 @@ Here is the data from their learning session:
 
     # v21.0から変更なし
     def on_word_selected_from_content(self, word):
+        self.cancel_requests("session")
         self.switch_frame(self.conversation_frame)
-        self.conversation_phase = "conversation"
-        self.conversation_history = []
-        self.chat_session = None
-        self.quiz_data = []
-        self.current_quiz_index = 0
-        self.current_quiz_results = [] 
-        self.current_story_text = ""
-        self.current_story_translation = ""
+        self.engine.continue_with_word(word)
 
         self.chat_history_text.config(state=tk.NORMAL)
         self.chat_history_text.delete('1.0', tk.END)
@@ -1722,20 +1442,11 @@ Here is the data from their learning session:
         self.send_button.config(state=tk.NORMAL)
         self.go_to_story_button.pack(pady=10) 
         
-        self.selected_word = word
-        current_theme_used_words = set()
-        for theme in self.theme_history:
-             if "image_data" in theme and theme["image_data"] == self.initial_image_data:
-                current_theme_used_words = set(theme.get("word_sessions", {}).keys())
-                break
-        self.used_words_in_current_theme = current_theme_used_words
-        self.used_words_in_current_theme.add(word) 
-        
         self.append_chat("System", f"[Continuing with new keyword: '{word}']")
         
-        self.run_api_in_thread(self.api_start_inquiry, self.handle_initial_ai_response,
-                             args=(self.initial_image_data, word, self.initial_image_labels), 
-                               message="Starting new topic (Gemini)...")
+        self.run_api_in_thread(self.engine_call("start_inquiry"), self.handle_initial_ai_response,
+                             args=self.engine.inquiry_args(), 
+                               message="Starting new topic (Gemini)...", stream="chat")
                                
     # v21.0から変更なし
     def clear_content_frame(self):
@@ -1764,17 +1475,18 @@ Here is the data from their learning session:
         self.quiz_story_display_frame.pack(fill=tk.BOTH, expand=True)
 
     # v2t.0から変更なし
-    def open_summary_creator(self, session_data):
+    def open_summary_creator(self, theme, word):
+        session_data = theme.word_sessions[word]
         if self.summary_creator_window and self.summary_creator_window.winfo_exists():
             self.summary_creator_window.lift()
             return
             
         win = Toplevel(self.master)
-        win.title(f"Create Summary Card for: {self.selected_word}")
+        win.title(f"Create Summary Card for: {self.engine.selected_word}")
         win.geometry("900x600")
         
         self.summary_creator_window = win 
-        win.protocol("WM_DELETE_WINDOW", lambda: setattr(self, 'summary_creator_window', None) or win.destroy())
+        win.protocol("WM_DELETE_WINDOW", lambda: self.close_summary_creator(win))
 
         main_pane = tk.PanedWindow(win, orient=tk.HORIZONTAL)
         main_pane.pack(fill=tk.BOTH, expand=True)
@@ -1782,7 +1494,7 @@ Here is the data from their learning session:
         card_frame = tk.Frame(main_pane, relief=tk.RIDGE, borderwidth=2, padx=10, pady=10)
         main_pane.add(card_frame, width=500)
 
-        tk.Label(card_frame, text=f"Theme: {self.current_theme_title} (Topic: {self.selected_word})", font=("", 14, "bold")).pack(anchor=tk.W)
+        tk.Label(card_frame, text=f"Theme: {self.engine.current_theme_title} (Topic: {self.engine.selected_word})", font=("", 14, "bold")).pack(anchor=tk.W)
         
         tk.Label(card_frame, text="1. Facts you learned (学んだ「事実」):", font=("", 12, "bold"), fg="#D2691E").pack(anchor=tk.W, pady=(10,0))
         self.card_field_1_text = tk.Text(card_frame, height=4, width=60, font=("", 10), relief=tk.SOLID, borderwidth=1, bg="#FFF8DC")
@@ -1800,15 +1512,15 @@ Here is the data from their learning session:
         self.card_field_4_text = tk.Text(card_frame, height=4, width=60, font=("", 10), relief=tk.SOLID, borderwidth=1, bg="#FFF5EE")
         self.card_field_4_text.pack(fill=tk.X, expand=True)
 
-        if "summary_card" in session_data:
-            saved_summary = session_data["summary_card"]
+        if session_data.summary_card is not None:
+            saved_summary = session_data.summary_card
             self.card_field_1_text.insert("1.0", saved_summary.get("field1", ""))
             self.card_field_2_text.insert("1.0", saved_summary.get("field2", ""))
             self.card_field_3_text.insert("1.0", saved_summary.get("field3", ""))
             self.card_field_4_text.insert("1.0", saved_summary.get("field4", ""))
 
         tk.Button(card_frame, text="Save & Close", font=("", 12, "bold"), 
-                  command=lambda s=session_data, w=win: self.save_summary_card(s, w)).pack(pady=20) 
+                  command=lambda t=theme, w=word, win=win: self.save_summary_card(t, w, win)).pack(pady=20) 
 
         ai_frame = tk.Frame(main_pane, relief=tk.RIDGE, borderwidth=2, padx=10, pady=10, bg="#F5F5F5")
         main_pane.add(ai_frame, width=400)
@@ -1819,16 +1531,18 @@ Here is the data from their learning session:
         self.summary_guidance_text.pack(fill=tk.BOTH, expand=True)
         
         self.run_api_in_thread(
-            self.api_generate_summary_guidance, 
+            self.engine.generate_summary_guidance, 
             self.handle_summary_guidance_response,
             args=(session_data,), 
-            message="Loading AI assistant..."
+            message="Loading AI assistant...",
+            priority=BACKGROUND,
+            scope="summary"
         )
 
         win.transient(self.master)
         win.grab_set()
 
-    def save_summary_card(self, session_data, window):
+    def save_summary_card(self, theme, word, window):
         try:
             field1 = self.card_field_1_text.get("1.0", tk.END).strip()
             # [FIX] v21.1 (R1) "1.to" -> "1.0"
@@ -1843,18 +1557,13 @@ Here is the data from their learning session:
                 "field4": field4
             }
             
-            session_data["summary_card"] = summary_data
-            
-            self.add_coins(50) 
-            print("Summary card data saved. +50 Coins.")
-            
-            # [NEW] v21.1 (R4) サマリーを保存したら、プロファイル全体も保存
-            self.profile.save()
+            level_change = self.engine.save_summary_card(theme, word, summary_data)
             
             messagebox.showinfo("Saved", "Summary card saved successfully! (+50 Coins 🪙)")
-            self.evaluate_session_and_adjust_level(session_data)
-            window.destroy()
-            self.summary_creator_window = None
+            if level_change:
+                current, new_level = level_change
+                messagebox.showinfo("Level Updated", f"次回のレベルを {current} → {new_level} に更新しました。")
+            self.close_summary_creator(window)
     
             
 
@@ -1862,51 +1571,12 @@ Here is the data from their learning session:
             print(f"Error saving summary card: {e}")
             messagebox.showerror("Error", f"Could not save summary card:\n{e}")
 
-    def evaluate_session_and_adjust_level(self, session_data):
-        try:
-            # --- 1) 指標 ---
-            total = len(self.current_quiz_results)
-            correct = 0
-            for i, ans in enumerate(self.current_quiz_results):
-                if i < len(self.quiz_data):
-                    try:
-                        if isinstance(ans, str) and ans.lower() == self.quiz_data[i]['a'].lower():
-                            correct += 1
-                    except Exception:
-                        pass
-            accuracy = (correct / total) if total > 0 else 0.0
-
-            summary = session_data.get("summary_card", {}) or {}
-            filled_fields = sum(1 for f in ("field1","field2","field3","field4") if (summary.get(f) or "").strip())
-
-            # --- 2) レベル判定 ---
-            levels = ["CEFR Pre-A1", "CEFR A1", "CEFR A2"]
-            current = self.profile.get("current_level") or "CEFR A1"
-            if current not in levels:
-                current = "CEFR A1"
-            idx = levels.index(current)
-            new_level = current
-
-            if accuracy >= 0.8 and filled_fields >= 3 and idx < len(levels) - 1:
-                new_level = levels[idx + 1]
-            elif accuracy < 0.5 and idx > 0:
-                new_level = levels[idx - 1]
-
-            # --- 3) 更新と表示 ---
-            if new_level != current:
-                self.profile.set("current_level", new_level)
-                self.profile.save()
-                self.student_level = new_level
-                self.master.title(f"Inquiry English App (v21.1 — Profile: {new_level})")
-                messagebox.showinfo("Level Updated", f"次回のレベルを {current} → {new_level} に更新しました。")
-                self.update_status_bar()
-
-            else:
-                print("Level unchanged — remains at", current)
+    def close_summary_creator(self, window):
+        # ガイド生成がまだ終わっていなければ、その結果は捨てる
+        self.cancel_requests("summary")
+        self.summary_creator_window = None
+        window.destroy()
 
-        except Exception as e:
-            print(f"Error during level evaluation: {e}")
-    
     # v21.0から変更なし
     def handle_summary_guidance_response(self, ai_text):
         if not self.summary_creator_window or not self.summary_creator_window.winfo_exists():
@@ -0,0 +1,493 @@
+# inquiry_server.py
+"""
+クラス全員の探究セッションを1つのプロセスで受け持つ HTTP サーバー (asyncio、標準ライブラリのみ)。
+
+  python inquiry_server.py [--host 127.0.0.1] [--port 8080] [--workers 16] [--fake] [--async-api]
+
+  - 生徒ごとに SessionEngine を1つ作り、プロファイルは SERVER_DATA_DIR/<student_id>/ に分けて保存する
+  - APIClients (キャッシュ・レート制限・再試行の予算) は全生徒で1つを共有する
+  - ブロックする API 呼び出しは共有のスレッドプール (--workers 本) で実行し、イベントループは止めない
+  - --async-api を付けると Gemini / Vision の呼び出しは AsyncAPIClients でこのループの上で待つ
+    (スレッドを使うのはプロファイルの読み書きと画像の縮小だけになる)
+  - 同じ生徒のリクエストは順番に処理する (生徒ごとのロック)。使われないセッションは TTL で閉じる
+  - --fake を付けると fake_backend の偽クライアントで動く (負荷試験用、bench_server.py を参照)
+
+エンドポイント (本文・応答は JSON、画像は Base64):
+  POST /students/<id>/photo     {"image": "..."}              -> labels, words
+  POST /students/<id>/inquiry   {"keyword": "...", "image"?}  -> english, japanese, choices
+  POST /students/<id>/reply     {"text": "..."}               -> english, japanese, choices
+  POST /students/<id>/story     {}                            -> story, translation
+  POST /students/<id>/quizzes   {}                            -> quizzes (答えは含まない)
+  POST /students/<id>/answer    {"answer": "..."}             -> correct, correct_answer, coins, finished
+  POST /students/<id>/theme     {}                            -> テーマを保存
+  POST /students/<id>/settings  {"grade"?, "level"?}
+  GET  /students/<id>           -> セッションの状態
+  GET  /metrics                 -> エンドポイントごとの件数・レイテンシ、キャッシュの効き
+  GET  /health
+"""
+import os, re, sys, json, time, base64, asyncio, argparse, functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from config import (SERVER_HOST, SERVER_PORT, SERVER_WORKERS, SERVER_DATA_DIR, SERVER_SESSION_TTL,
+                    SERVER_MAX_BODY, PROFILE_BACKEND, COMBINED_STORY_QUIZ, ASYNC_API,
+                    IMAGE_MAX_EDGE, IMAGE_UPLOAD_FORMAT, IMAGE_UPLOAD_QUALITY)
+from api_clients import APIClients, configure_clients
+from image_preprocess import prepare_upload_image
+from prompts import parse_choices, parse_translation
+from session_engine import SessionEngine, LEVELS
+from user_profile import UserProfile
+
+STUDENT_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 409: "Conflict",
+           413: "Payload Too Large", 500: "Internal Server Error", 502: "Bad Gateway"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class StudentSession:
+    def __init__(self, student_id, profile, engine):
+        self.student_id = student_id
+        self.profile = profile
+        self.engine = engine
+        self.lock = asyncio.Lock()  # 同じ生徒のリクエストは1つずつ
+        self.last_used = time.monotonic()
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class EndpointStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=2000)  # 直近の分だけで分位点を出す
+
+    def record(self, seconds, ok):
+        self.count += 1
+        if not ok:
+            self.errors += 1
+        self.latencies.append(seconds)
+
+    def summary(self):
+        values = list(self.latencies)
+        return {"count": self.count, "errors": self.errors,
+                "p50_ms": round(percentile(values, 50) * 1000, 1),
+                "p95_ms": round(percentile(values, 95) * 1000, 1),
+                "max_ms": round(max(values, default=0.0) * 1000, 1)}
+
+
+def reply_payload(text):
+    choices, cleaned = parse_choices(text or "")
+    english, japanese = parse_translation(cleaned)
+    return {"english": english, "japanese": japanese, "choices": choices}
+
+
+class InquiryService:
+    def __init__(self, api, data_dir=SERVER_DATA_DIR, workers=SERVER_WORKERS, session_ttl=SERVER_SESSION_TTL,
+                 profile_backend=PROFILE_BACKEND, max_body=SERVER_MAX_BODY, aapi=None):
+        self.api = api
+        self.aapi = aapi  # AsyncAPIClients。あればエンジンの *_async メソッドで呼ぶ
+        self.data_dir = data_dir
+        self.workers = workers
+        self.session_ttl = session_ttl
+        self.profile_backend = profile_backend
+        self.max_body = max_body
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="inquiry-api")
+        self.sessions = {}  # student_id -> StudentSession
+        self._opening = {}  # student_id -> プロファイルを読み込み中の Future
+        self._closing = {}  # student_id -> 閉じている (書き込みスレッドを flush 中の) Future
+        self.stats = {}
+        self.started_at = time.monotonic()
+        self.routes = {
+            "photo": self.photo,
+            "inquiry": self.inquiry,
+            "reply": self.reply,
+            "story": self.story,
+            "quizzes": self.quizzes,
+            "answer": self.answer,
+            "theme": self.theme,
+            "settings": self.settings,
+        }
+
+    # --- 実行 ---
+    async def run_blocking(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def api_method(self, engine, name):
+        return getattr(engine, f"{name}_async") if self.aapi is not None else getattr(engine, name)
+
+    async def call_api(self, func, *args, **kwargs):
+        """ワーカースレッドで API を呼ぶ。一時的なエラーは RetryPolicy に従って待ってから再試行する。"""
+        if asyncio.iscoroutinefunction(func):
+            # 再試行とタイムアウトは AsyncAPIClients が受け持つ
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                raise HTTPError(502, f"API error: {e}")
+        policy = self.api.retry_policy
+        attempt = 0
+        while True:
+            try:
+                return await self.run_blocking(func, *args, **kwargs)
+            except Exception as e:
+                wait_s = policy.next_delay(e, attempt)
+                if wait_s is None:
+                    raise HTTPError(502, f"API error: {e}")
+                attempt += 1
+                print(f"[DEBUG] API error, retry {attempt}/{policy.max_retries} in {wait_s:.1f}s: {e}")
+                await asyncio.sleep(wait_s)  # 待っている間はスレッドを使わない
+
+    # --- 生徒ごとのセッション ---
+    def _open_profile(self, student_id):
+        folder = os.path.join(self.data_dir, student_id)
+        os.makedirs(folder, exist_ok=True)
+        return UserProfile(os.path.join(folder, "profile.json"), image_store_dir=os.path.join(folder, "images"),
+                           backend=self.profile_backend, db_path=os.path.join(folder, "profile.db"))
+
+    async def session(self, student_id):
+        if not STUDENT_ID.match(student_id):
+            raise HTTPError(400, "student id must be 1-64 characters of [A-Za-z0-9_-].")
+        session = self.sessions.get(student_id)
+        if session is None:
+            closing = self._closing.get(student_id)
+            if closing is not None:
+                # 追い出したばかりのプロファイルが書き終わるまで待ってから開き直す (古い値で上書きしない)
+                await asyncio.shield(closing)
+            opening = self._opening.get(student_id)
+            if opening is None:
+                # 同じ生徒の最初のリクエストが重なっても、プロファイルは1回だけ開く
+                opening = asyncio.ensure_future(self.run_blocking(self._open_profile, student_id))
+                self._opening[student_id] = opening
+            try:
+                profile = await opening
+            finally:
+                self._opening.pop(student_id, None)
+            session = self.sessions.get(student_id)
+            if session is None:
+                session = StudentSession(student_id, profile, SessionEngine(self.api, profile, aapi=self.aapi))
+                self.sessions[student_id] = session
+        session.last_used = time.monotonic()
+        return session
+
+    async def evict_idle_sessions(self):
+        while True:
+            await asyncio.sleep(max(1, min(60, self.session_ttl)))
+            now = time.monotonic()
+            for student_id, session in list(self.sessions.items()):
+                if now - session.last_used > self.session_ttl and not session.lock.locked():
+                    del self.sessions[student_id]
+                    closing = asyncio.ensure_future(self.run_blocking(session.profile.close))
+                    self._closing[student_id] = closing
+                    try:
+                        await closing
+                    finally:
+                        self._closing.pop(student_id, None)
+                    print(f"[DEBUG] Closed idle session '{student_id}'")
+
+    async def close(self):
+        for closing in list(self._closing.values()):
+            await asyncio.shield(closing)
+        for session in list(self.sessions.values()):
+            await self.run_blocking(session.profile.close)
+        self.sessions.clear()
+        self.executor.shutdown(wait=False)
+
+    # --- エンドポイント ---
+    async def photo(self, session, body):
+        engine = session.engine
+        try:
+            raw = base64.b64decode(body.get("image") or "", validate=True)
+        except Exception:
+            raw = b""
+        if not raw:
+            raise HTTPError(400, "'image' (base64) is required.")
+        image = await self.run_blocking(prepare_upload_image, raw, max_edge=IMAGE_MAX_EDGE,
+                                        fmt=IMAGE_UPLOAD_FORMAT, quality=IMAGE_UPLOAD_QUALITY)
+        engine.clear_photo()
+        engine.set_photo(image)
+        labels = await self.run_blocking(engine.known_labels)
+        if not labels:
+            labels = await self.call_api(self.api_method(engine, "get_image_labels"), engine.image_data)
+        engine.set_labels(labels)
+        return {"image_hash": engine.initial_image_hash, "labels": labels, "words": engine.word_choices(labels)}
+
+    async def inquiry(self, session, body):
+        engine = session.engine
+        if body.get("image"):
+            await self.photo(session, body)
+        if not engine.initial_image_data:
+            raise HTTPError(409, "Send a photo first.")
+        keyword = str(body.get("keyword") or "").strip().lower()
+        if not keyword:
+            raise HTTPError(400, "'keyword' is required.")
+        if engine.selected_word:
+            engine.continue_with_word(keyword)  # 同じ写真で次のキーワード
+        else:
+            engine.select_word(keyword)
+        text = await self.call_api(self.api_method(engine, "start_inquiry"), *engine.inquiry_args())
+        return dict(reply_payload(text), keyword=keyword)
+
+    async def reply(self, session, body):
+        engine = session.engine
+        text = str(body.get("text") or "").strip()
+        if not text:
+            raise HTTPError(400, "'text' is required.")
+        if engine.chat_session is None or engine.conversation_phase != "conversation":
+            raise HTTPError(409, "Start an inquiry first.")
+        return reply_payload(await self.call_api(self.api_method(engine, "continue_conversation"), text))
+
+    async def story(self, session, body):
+        engine = session.engine
+        if engine.chat_session is None:
+            raise HTTPError(409, "Start an inquiry first.")
+        engine.start_story()
+        story_func = self.api_method(engine, "generate_story_with_quizzes" if COMBINED_STORY_QUIZ else "generate_story")
+        try:
+            result = await self.call_api(story_func)
+        except HTTPError:
+            engine.apply_story(None)
+            raise
+        engine.apply_story(result)
+        return {"story": engine.current_story_text, "translation": engine.current_story_translation,
+                "quizzes_ready": bool(engine.story_quizzes)}
+
+    async def quizzes(self, session, body):
+        engine = session.engine
+        if engine.conversation_phase != "quiz" or not engine.current_story_text:
+            raise HTTPError(409, "Generate the story first.")
+        quizzes = engine.take_story_quizzes()
+        if not quizzes:
+            quizzes = await self.call_api(self.api_method(engine, "generate_quizzes"), **engine.quiz_request_kwargs())
+        engine.set_quizzes(quizzes)
+        return {"quizzes": [{"type": q.get("type"), "question": q["q"], "choices": q["c"]} for q in quizzes]}
+
+    async def answer(self, session, body):
+        engine = session.engine
+        if engine.current_quiz() is None:
+            raise HTTPError(409, "No quiz is waiting for an answer.")
+        result = engine.check_answer(str(body.get("answer") or ""))
+        if result is None:
+            raise HTTPError(400, "'answer' is required.")
+        selected, correct, correct_answer = result
+        return {"answer": selected, "correct": correct, "correct_answer": correct_answer,
+                "coins": engine.coins, "finished": engine.quizzes_finished()}
+
+    async def theme(self, session, body):
+        engine = session.engine
+        theme = await self.run_blocking(engine.save_theme)
+        if theme is None:
+            raise HTTPError(409, "Nothing to save yet (photo and keyword are required).")
+        return {"title": theme.title, "word": engine.selected_word, "image_hash": theme.image_hash,
+                "coins": engine.coins}
+
+    async def settings(self, session, body):
+        engine = session.engine
+        if body.get("grade"):
+            engine.set_grade(str(body["grade"]))
+        if body.get("level"):
+            if body["level"] not in LEVELS:
+                raise HTTPError(400, f"'level' must be one of {LEVELS}.")
+            engine.set_level(body["level"])
+        await self.run_blocking(session.profile.save_fields, "grade", "current_level")
+        return self.state(session)
+
+    def state(self, session):
+        engine = session.engine
+        return {
+            "student_id": session.student_id,
+            "grade": engine.grade,
+            "level": engine.student_level,
+            "coins": engine.coins,
+            "phase": engine.conversation_phase,
+            "keyword": engine.selected_word,
+            "theme": engine.current_theme_title,
+            "turns": len(engine.conversation_history) // 2,
+            "has_story": bool(engine.current_story_text),
+            "quiz_index": engine.current_quiz_index,
+            "quiz_total": len(engine.quiz_data),
+            "themes": len(engine.theme_history or []),
+        }
+
+    def metrics(self):
+        return {
+            "uptime_s": round(time.monotonic() - self.started_at, 1),
+            "sessions": len(self.sessions),
+            "workers": self.workers,
+            "endpoints": {name: stats.summary() for name, stats in sorted(self.stats.items())},
+            "gemini_cache": self.api.response_cache.stats(),
+            "vision_cache": self.api.label_cache.stats(),
+            "async_api": self.aapi.stats() if self.aapi is not None else None,
+        }
+
+    # --- HTTP ---
+    async def dispatch(self, method, target, body):
+        path = urlsplit(target).path.strip("/").split("/")
+        if path == ["health"]:
+            return 200, {"ok": True}
+        if path == ["metrics"]:
+            return 200, self.metrics()
+        if len(path) not in (2, 3) or path[0] != "students":
+            raise HTTPError(404, f"No route for /{'/'.join(path)}")
+
+        if len(path) == 2:
+            if method != "GET":
+                raise HTTPError(405, "Use GET for the session state.")
+            return 200, self.state(await self.session(path[1]))
+
+        handler = self.routes.get(path[2])
+        if handler is None:
+            raise HTTPError(404, f"Unknown action '{path[2]}'")
+        if method != "POST":
+            raise HTTPError(405, f"Use POST for '{path[2]}'.")
+        try:
+            payload = json.loads(body.decode("utf-8")) if body else {}
+        except ValueError:
+            raise HTTPError(400, "Body must be JSON.")
+        if not isinstance(payload, dict):
+            raise HTTPError(400, "Body must be a JSON object.")
+        session = await self.session(path[1])
+        async with session.lock:
+            result = await handler(session, payload)
+            session.last_used = time.monotonic()
+        return 200, result
+
+    async def _respond(self, method, target, body):
+        path = urlsplit(target).path.strip("/").split("/")
+        if path[0] == "students":
+            action = path[2] if len(path) == 3 else "state"
+        else:
+            action = "/".join(path)
+        if action not in self.routes and action not in ("state", "health", "metrics"):
+            action = "other"  # 知らないパスで統計の項目を増やさない
+        t0 = time.perf_counter()
+        try:
+            status, payload = await self.dispatch(method, target, body)
+        except HTTPError as e:
+            status, payload = e.status, {"error": e.message}
+        except Exception as e:
+            print(f"Server error on {method} {target}: {e}")
+            status, payload = 500, {"error": str(e)}
+        self.stats.setdefault(action, EndpointStats()).record(time.perf_counter() - t0, status < 400)
+        return status, payload
+
+    async def _write(self, writer, status, payload, keep_alive):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        head = (f"HTTP/1.1 {status} {REASONS.get(status, 'Error')}\r\n"
+                f"Content-Type: application/json; charset=utf-8\r\n"
+                f"Content-Length: {len(data)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode("latin-1") + data)
+        await writer.drain()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await self._write(writer, 400, {"error": "Malformed request line."}, keep_alive=False)
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                try:
+                    length = int(headers.get("content-length") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0 or length > self.max_body:
+                    await self._write(writer, 413 if length > 0 else 400,
+                                      {"error": "Invalid or too large Content-Length."}, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                status, payload = await self._respond(method.upper(), target, body)
+                await self._write(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def start(self, host=SERVER_HOST, port=SERVER_PORT):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        self._evict_task = asyncio.ensure_future(self.evict_idle_sessions())
+        return server
+
+
+def create_api(fake=False, latency=0.8):
+    if fake:
+        from fake_backend import FakeGenerativeModel, FakeVisionClient
+        return APIClients(gemini_model=FakeGenerativeModel(latency=latency), vision_client=FakeVisionClient())
+    configure_clients()
+    return APIClients()
+
+
+def create_async_api(api, fake=False):
+    from async_api_clients import AsyncAPIClients
+    if fake:
+        from fake_backend import FakeVisionAsyncClient
+        return AsyncAPIClients(api, vision_async_client=FakeVisionAsyncClient(latency=api.vision_client.latency))
+    return AsyncAPIClients(api)
+
+
+async def serve(args):
+    api = create_api(args.fake, args.fake_latency)
+    aapi = create_async_api(api, args.fake) if args.async_api else None
+    service = InquiryService(api, data_dir=args.data_dir, workers=args.workers, aapi=aapi)
+    server = await service.start(args.host, args.port)
+    print(f"Inquiry server listening on http://{args.host}:{server.sockets[0].getsockname()[1]} "
+          f"(workers={args.workers}, data={args.data_dir}{', fake backend' if args.fake else ''}"
+          f"{', async API' if aapi else ''})")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inquiry app HTTP server (one process, many students)")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS)
+    parser.add_argument("--data-dir", default=SERVER_DATA_DIR)
+    parser.add_argument("--fake", action="store_true", help="use the fake Gemini/Vision backend")
+    parser.add_argument("--fake-latency", type=float, default=0.8)
+    parser.add_argument("--async-api", action="store_true", default=ASYNC_API,
+                        help="await Gemini/Vision on the event loop instead of worker threads")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print(f"Server failed: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
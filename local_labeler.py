@@ -0,0 +1,146 @@
+# local_labeler.py
+"""
+ネットワークを使わずに写真のラベル (all_labels) を作るローカルのラベラー (Cloud Vision の代わりの速い経路)。
+
+  - OpenCVDNNLabeler : cv2.dnn で読み込んだ画像分類モデル (ONNX / Caffe / TensorFlow など) の上位 k クラスを返す。
+      モデルとクラス名のファイル (1行1クラス。"n02099601 golden retriever" のような ImageNet 形式も可) はローカルに置く
+  - LabelerPool : ラベラーをプロセスプールで動かす。モデルはプロセスごとに1回だけ読み込み、
+      推論で GIL を握って Tk の画面や API のワーカーを止めないようにする
+  - LOCAL_LABELER に "module:Class" を書くと独自のラベラーを差し込める
+      (labels(image_bytes) -> list[str] を持ち、コンストラクタは labeler_options() のキーワード引数を受け取るクラス)
+"""
+import os, asyncio, importlib, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from config import (LOCAL_LABELER, LOCAL_LABELER_MODEL, LOCAL_LABELER_CONFIG, LOCAL_LABELER_CLASSES,
+                    LOCAL_LABELER_INPUT_SIZE, LOCAL_LABELER_MEAN, LOCAL_LABELER_STD, LOCAL_LABELER_TOP_K,
+                    LOCAL_LABELER_MIN_SCORE, LOCAL_LABELER_WORKERS)
+
+LABELER_BACKENDS = {"opencv-dnn": "local_labeler:OpenCVDNNLabeler"}
+
+
+def load_class_names(path):
+    names = []
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            name = line.strip()
+            # ImageNet の synset 形式 ("n01440764 tench, Tinca tinca") は先頭の ID を落とす
+            head, _, rest = name.partition(" ")
+            if rest and head[:1] == "n" and head[1:].isdigit():
+                name = rest.strip()
+            names.append(name)
+    return names
+
+
+def _floats(text):
+    return tuple(float(v) for v in str(text).split(",") if v.strip())
+
+
+class OpenCVDNNLabeler:
+    def __init__(self, model_path=LOCAL_LABELER_MODEL, config_path=LOCAL_LABELER_CONFIG,
+                 classes_path=LOCAL_LABELER_CLASSES, input_size=LOCAL_LABELER_INPUT_SIZE,
+                 mean=LOCAL_LABELER_MEAN, std=LOCAL_LABELER_STD, top_k=LOCAL_LABELER_TOP_K,
+                 min_score=LOCAL_LABELER_MIN_SCORE, **_):
+        # cv2 / numpy はラベラーを動かすプロセスでだけ読み込む
+        import cv2, numpy as np
+        self.cv2, self.np = cv2, np
+        self.net = cv2.dnn.readNet(model_path, config_path) if config_path else cv2.dnn.readNet(model_path)
+        self.names = load_class_names(classes_path)
+        self.input_size = int(input_size)
+        # 値は 0-1 に縮めた RGB に対する平均・標準偏差 (既定は ImageNet)
+        self.mean = np.array(_floats(mean) or (0.0, 0.0, 0.0), dtype=np.float32).reshape(1, 3, 1, 1)
+        self.std = np.array(_floats(std) or (1.0, 1.0, 1.0), dtype=np.float32).reshape(1, 3, 1, 1)
+        self.top_k = top_k
+        self.min_score = min_score
+
+    def scores(self, image_bytes):
+        cv2, np = self.cv2, self.np
+        img = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError("Could not decode the image.")
+        size = (self.input_size, self.input_size)
+        blob = cv2.dnn.blobFromImage(img, 1 / 255.0, size, (0, 0, 0), swapRB=True, crop=True)
+        self.net.setInput((blob - self.mean) / self.std)
+        out = self.net.forward().reshape(-1).astype(np.float64)
+        if out.min() < 0 or abs(out.sum() - 1.0) > 1e-3:
+            out = np.exp(out - out.max())  # ロジットなら softmax で確率にする
+            out /= out.sum()
+        return out
+
+    def labels(self, image_bytes):
+        out = self.scores(image_bytes)
+        labels = []
+        for i in out.argsort()[::-1][:self.top_k]:
+            if out[i] < self.min_score and labels:
+                break
+            labels.append(self.names[i] if i < len(self.names) else f"class {i}")
+        return labels
+
+
+def create_labeler(spec, **options):
+    target = LABELER_BACKENDS.get(spec, spec)
+    module_name, _, class_name = target.partition(":")
+    if not module_name or not class_name:
+        raise ValueError(f"Unknown local labeler: {spec}")
+    return getattr(importlib.import_module(module_name), class_name)(**options)
+
+
+def labeler_options():
+    return {"model_path": LOCAL_LABELER_MODEL, "config_path": LOCAL_LABELER_CONFIG,
+            "classes_path": LOCAL_LABELER_CLASSES, "input_size": LOCAL_LABELER_INPUT_SIZE,
+            "mean": LOCAL_LABELER_MEAN, "std": LOCAL_LABELER_STD, "top_k": LOCAL_LABELER_TOP_K,
+            "min_score": LOCAL_LABELER_MIN_SCORE}
+
+
+# --- プロセスプールの子プロセス側 ---
+_labeler = None
+
+
+def _init_worker(spec, options):
+    global _labeler
+    _labeler = create_labeler(spec, **options)
+
+
+def _worker_ready():
+    return os.getpid()
+
+
+def _worker_labels(image_bytes):
+    return _labeler.labels(image_bytes)
+
+
+class LabelerPool:
+    def __init__(self, spec, options=None, workers=LOCAL_LABELER_WORKERS):
+        self.spec = spec
+        self.workers = max(1, workers)
+        # Tk やワーカースレッドを抱えた親プロセスは fork しない
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=_init_worker, initargs=(spec, options or {}))
+
+    def warm_up(self):
+        """子プロセスを起動してモデルを読み込ませておく (最初の写真で待たないように)。"""
+        return [self.executor.submit(_worker_ready) for _ in range(self.workers)]
+
+    def submit(self, image_bytes):
+        return self.executor.submit(_worker_labels, image_bytes)
+
+    def labels(self, image_bytes, timeout=None):
+        return self.submit(image_bytes).result(timeout)
+
+    async def labels_async(self, image_bytes):
+        return await asyncio.wrap_future(self.submit(image_bytes))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def create_labeler_pool(spec=LOCAL_LABELER, workers=LOCAL_LABELER_WORKERS):
+    """設定どおりのプールを作る。LOCAL_LABELER が空、またはモデルのファイルがなければ None。"""
+    if not spec:
+        return None
+    if spec in LABELER_BACKENDS:
+        missing = [p for p in (LOCAL_LABELER_MODEL, LOCAL_LABELER_CLASSES) if not os.path.exists(p)]
+        if missing:
+            print(f"Warning: local labeler files not found {missing}. Local labels are disabled.")
+            return None
+    return LabelerPool(spec, labeler_options(), workers=workers)
@@ -0,0 +1,59 @@
+# profile_model.py
+"""
+テーマ / 単語セッションのデータモデル。
+
+テーマが数百〜数千件になっても常駐メモリが増えないよう、__slots__ を使い
+画像バイトは持たない (image_hash だけを持ち、画像は ImageStore から都度読む)。
+保存形式 (profile.json) との変換は to_dict / from_dict で行う。
+"""
+
+
+class WordSession:
+    __slots__ = ("story", "story_translation", "quizzes", "user_answers", "summary_card")
+
+    def __init__(self, story="", story_translation="", quizzes=None, user_answers=None, summary_card=None):
+        self.story = story
+        self.story_translation = story_translation
+        self.quizzes = quizzes if quizzes is not None else []           # [{"q", "c", "a", "type"}, ...]
+        self.user_answers = user_answers if user_answers is not None else []
+        self.summary_card = summary_card                                 # {"field1".."field4"} or None
+
+    @classmethod
+    def from_dict(cls, d):
+        # 旧形式の "history" (会話履歴) などは読み捨てる
+        return cls(d.get("story", ""), d.get("story_translation", ""),
+                   d.get("quizzes"), d.get("user_answers"), d.get("summary_card"))
+
+    def to_dict(self):
+        d = {
+            "story": self.story,
+            "story_translation": self.story_translation,
+            "quizzes": self.quizzes,
+            "user_answers": self.user_answers,
+        }
+        if self.summary_card is not None:
+            d["summary_card"] = self.summary_card
+        return d
+
+
+class Theme:
+    __slots__ = ("title", "image_hash", "all_labels", "word_sessions")
+
+    def __init__(self, title, image_hash, all_labels=None, word_sessions=None):
+        self.title = title
+        self.image_hash = image_hash
+        self.all_labels = all_labels if all_labels is not None else []
+        self.word_sessions = word_sessions if word_sessions is not None else {}  # word -> WordSession
+
+    @classmethod
+    def from_dict(cls, d):
+        sessions = {word: WordSession.from_dict(s) for word, s in (d.get("word_sessions") or {}).items()}
+        return cls(d.get("title", ""), d.get("image_hash"), d.get("all_labels"), sessions)
+
+    def to_dict(self):
+        return {
+            "title": self.title,
+            "image_hash": self.image_hash,
+            "all_labels": self.all_labels,
+            "word_sessions": {word: s.to_dict() for word, s in self.word_sessions.items()},
+        }
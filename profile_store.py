@@ -0,0 +1,475 @@
+# profile_store.py
+"""
+Profile storage backends.
+
+- JSONProfileStore   : 従来の profile.json (保存のたびに全体を書き直す)
+- SQLiteProfileStore : profile / themes / word_sessions / quizzes / summary_cards の
+                       テーブルに分け、変更のあった行だけを書き込む
+- JournalProfileStore: profile.json をスナップショットとし、変更は JSONL の
+                       ジャーナルへ1行追記するだけ。一定サイズを超えたら圧縮する
+
+どれも同じメソッドを持ち、UserProfile から呼ばれる。
+theme_history の要素は profile_model.Theme (word_sessions の値は WordSession)。
+  load()                             -> dict
+  save_all(data)
+  save_fields(data, keys)            プロファイル項目 (coins, current_level など)
+  save_word_session(data, theme, word)
+  save_summary_card(data, theme, word)
+
+書き込みは ProfileWriter (専用スレッド) がまとめて行うので、Tk のメインループは
+ディスク I/O を待たない。JSON は一時ファイル + fsync + os.replace で置き換える。
+
+使い方 (既存 profile.json の一回限りの取り込み):
+  python profile_store.py profile.json profile.db
+"""
+import os, sys, json, time, base64, sqlite3, tempfile, threading
+from collections import OrderedDict
+from profile_model import Theme, WordSession
+
+
+PROFILE_FIELDS = ("grade", "current_level", "coins")
+
+
+def atomic_write_text(path, text, encoding="utf-8"):
+    """一時ファイルに書いて fsync してから置き換える (書き込み途中で落ちても元のファイルは壊れない)。"""
+    dir_path = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding=encoding) as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class ProfileWriter:
+    """
+    保存要求を専用スレッドでまとめて書き込む。
+    - 最初の要求から delay 秒待ち、その間に来た要求をまとめて実行する (debounce)
+    - 同じ key の要求は最後の1つだけを実行する (coalesce)
+    """
+    def __init__(self, delay=0.5):
+        self.delay = delay
+        self._pending = OrderedDict()  # key -> job
+        self._cond = threading.Condition()
+        self._busy = False
+        self._flush_requested = False
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="ProfileWriter", daemon=True)
+        self._thread.start()
+
+    def submit(self, key, job):
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("ProfileWriter is closed.")
+            self._pending[key] = job
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if not self._pending:
+                    return  # stopped
+
+                deadline = time.monotonic() + self.delay
+                while not (self._stopped or self._flush_requested):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                jobs = list(self._pending.values())
+                self._pending.clear()
+                self._flush_requested = False
+                self._busy = True
+
+            for job in jobs:
+                try:
+                    job()
+                except Exception as e:
+                    print(f"Error writing profile: {e}")
+
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """待っている要求をすぐに書き込み、終わるまで待つ。"""
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: not self._pending and not self._busy, timeout)
+
+    def close(self, timeout=None):
+        self.flush(timeout)
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+
+class JSONProfileStore:
+    incremental = False  # 部分書き込みはできない (常に全体保存)
+
+    def __init__(self, file_path, images):
+        self.file_path = file_path
+        self.images = images
+
+    def load(self):
+        if not os.path.exists(self.file_path):
+            return None
+        with open(self.file_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        print(f"Profile loaded from {self.file_path}")
+
+        # 旧形式 (Base64埋め込み) の画像を画像ストアへ移し、ハッシュだけを残す。
+        # 1件ずつ dict を Theme に置き換えて、Base64 文字列をすぐに手放す
+        migrated = False
+        themes = data.get("theme_history", [])
+        for i, theme in enumerate(themes):
+            if "image_data_b64" in theme:
+                image_bytes = base64.b64decode(theme.pop("image_data_b64"))
+                theme["image_hash"] = self.images.put(image_bytes)
+                del image_bytes
+                migrated = True
+            themes[i] = Theme.from_dict(theme)
+        if migrated:
+            # 一度だけ書き直して profile.json から Base64 画像を取り除く (ジャーナルには触らない)
+            atomic_write_text(self.file_path, self.dumps(data))
+        return data
+
+    def dumps(self, data):
+        # 画像は画像ストアにあるので、ここではハッシュ付きのテーマをそのまま書き出す
+        data_to_save = data.copy()
+        if "theme_history" in data_to_save:
+            data_to_save["theme_history"] = [theme.to_dict() for theme in data_to_save["theme_history"]]
+        return json.dumps(data_to_save, indent=4, ensure_ascii=False)
+
+    def write_text(self, text):
+        atomic_write_text(self.file_path, text)
+        print(f"Profile saved to {self.file_path}")
+
+    def save_all(self, data):
+        self.write_text(self.dumps(data))
+
+    def close(self):
+        pass
+
+    def needs_compaction(self):
+        return False
+
+    # JSON は部分書き込みができないので、すべて全体保存になる
+    def save_fields(self, data, keys):
+        self.save_all(data)
+
+    def save_word_session(self, data, theme, word):
+        self.save_all(data)
+
+    def save_summary_card(self, data, theme, word):
+        self.save_all(data)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS profile (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS themes (
+    image_hash TEXT PRIMARY KEY,
+    position   INTEGER NOT NULL,
+    title      TEXT NOT NULL,
+    all_labels TEXT NOT NULL DEFAULT '[]'
+);
+CREATE TABLE IF NOT EXISTS word_sessions (
+    image_hash        TEXT NOT NULL,
+    word              TEXT NOT NULL,
+    position          INTEGER NOT NULL,
+    story             TEXT,
+    story_translation TEXT,
+    user_answers      TEXT NOT NULL DEFAULT '[]',
+    PRIMARY KEY (image_hash, word)
+);
+CREATE TABLE IF NOT EXISTS quizzes (
+    image_hash TEXT NOT NULL,
+    word       TEXT NOT NULL,
+    idx        INTEGER NOT NULL,
+    type       TEXT,
+    question   TEXT NOT NULL,
+    choices    TEXT NOT NULL DEFAULT '[]',
+    answer     TEXT NOT NULL,
+    PRIMARY KEY (image_hash, word, idx)
+);
+CREATE TABLE IF NOT EXISTS summary_cards (
+    image_hash TEXT NOT NULL,
+    word       TEXT NOT NULL,
+    field1     TEXT, field2 TEXT, field3 TEXT, field4 TEXT,
+    PRIMARY KEY (image_hash, word)
+);
+"""
+
+
+class SQLiteProfileStore:
+    incremental = True
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # 読み込みは起動時にメインスレッドで、書き込みは ProfileWriter のスレッドで行う
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def needs_compaction(self):
+        return False
+
+    def is_empty(self):
+        row = self.conn.execute("SELECT (SELECT COUNT(*) FROM profile) + (SELECT COUNT(*) FROM themes)").fetchone()
+        return row[0] == 0
+
+    # --- 読み込み ---
+    def load(self):
+        if self.is_empty():
+            return None
+        data = {}
+        for key, value in self.conn.execute("SELECT key, value FROM profile"):
+            data[key] = json.loads(value)
+
+        themes = {}
+        data["theme_history"] = []
+        for image_hash, title, all_labels in self.conn.execute(
+                "SELECT image_hash, title, all_labels FROM themes ORDER BY position"):
+            theme = Theme(title, image_hash, json.loads(all_labels))
+            themes[image_hash] = theme
+            data["theme_history"].append(theme)
+
+        for image_hash, word, story, story_translation, user_answers in self.conn.execute(
+                "SELECT image_hash, word, story, story_translation, user_answers "
+                "FROM word_sessions ORDER BY image_hash, position"):
+            if image_hash in themes:
+                themes[image_hash].word_sessions[word] = WordSession(story, story_translation,
+                                                                    user_answers=json.loads(user_answers))
+
+        def find_session(image_hash, word):
+            theme = themes.get(image_hash)
+            return theme.word_sessions.get(word) if theme else None
+
+        for image_hash, word, q_type, question, choices, answer in self.conn.execute(
+                "SELECT image_hash, word, type, question, choices, answer FROM quizzes ORDER BY image_hash, word, idx"):
+            session = find_session(image_hash, word)
+            if session is not None:
+                session.quizzes.append({"q": question, "c": json.loads(choices), "a": answer, "type": q_type})
+
+        for image_hash, word, f1, f2, f3, f4 in self.conn.execute(
+                "SELECT image_hash, word, field1, field2, field3, field4 FROM summary_cards"):
+            session = find_session(image_hash, word)
+            if session is not None:
+                session.summary_card = {"field1": f1, "field2": f2, "field3": f3, "field4": f4}
+
+        print(f"Profile loaded from {self.db_path}")
+        return data
+
+    # --- 行単位の書き込み ---
+    def _write_fields(self, data, keys):
+        self.conn.executemany(
+            "INSERT INTO profile (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            [(key, json.dumps(data.get(key), ensure_ascii=False)) for key in keys])
+
+    def _write_theme(self, theme):
+        self.conn.execute(
+            "INSERT INTO themes (image_hash, position, title, all_labels) "
+            "VALUES (?, (SELECT COALESCE(MAX(position) + 1, 0) FROM themes), ?, ?) "
+            "ON CONFLICT(image_hash) DO UPDATE SET title = excluded.title, all_labels = excluded.all_labels",
+            (theme.image_hash, theme.title or "", json.dumps(theme.all_labels, ensure_ascii=False)))
+
+    def _write_session(self, image_hash, word, session):
+        self.conn.execute(
+            "INSERT INTO word_sessions (image_hash, word, position, story, story_translation, user_answers) "
+            "VALUES (?, ?, (SELECT COALESCE(MAX(position) + 1, 0) FROM word_sessions WHERE image_hash = ?), ?, ?, ?) "
+            "ON CONFLICT(image_hash, word) DO UPDATE SET story = excluded.story, "
+            "story_translation = excluded.story_translation, user_answers = excluded.user_answers",
+            (image_hash, word, image_hash, session.story, session.story_translation,
+             json.dumps(session.user_answers, ensure_ascii=False)))
+
+        self.conn.execute("DELETE FROM quizzes WHERE image_hash = ? AND word = ?", (image_hash, word))
+        self.conn.executemany(
+            "INSERT INTO quizzes (image_hash, word, idx, type, question, choices, answer) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(image_hash, word, i, q.get("type"), q.get("q", ""), json.dumps(q.get("c", []), ensure_ascii=False), q.get("a", ""))
+             for i, q in enumerate(session.quizzes)])
+
+        if session.summary_card is not None:
+            self._write_summary_card(image_hash, word, session.summary_card)
+
+    def _write_summary_card(self, image_hash, word, card):
+        card = card or {}
+        self.conn.execute(
+            "INSERT INTO summary_cards (image_hash, word, field1, field2, field3, field4) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(image_hash, word) DO UPDATE SET field1 = excluded.field1, field2 = excluded.field2, "
+            "field3 = excluded.field3, field4 = excluded.field4",
+            (image_hash, word, card.get("field1"), card.get("field2"), card.get("field3"), card.get("field4")))
+
+    def save_all(self, data):
+        with self.conn:
+            self._write_fields(data, [k for k in data if k != "theme_history"])
+            for theme in data.get("theme_history", []):
+                if not theme.image_hash:
+                    print(f"Theme '{theme.title}' has no image_hash. Skipped.")
+                    continue
+                self._write_theme(theme)
+                for word, session in theme.word_sessions.items():
+                    self._write_session(theme.image_hash, word, session)
+        print(f"Profile saved to {self.db_path}")
+
+    def save_fields(self, data, keys):
+        with self.conn:
+            self._write_fields(data, keys)
+
+    def save_word_session(self, data, theme, word):
+        with self.conn:
+            self._write_theme(theme)
+            self._write_session(theme.image_hash, word, theme.word_sessions[word])
+
+    def save_summary_card(self, data, theme, word):
+        with self.conn:
+            self._write_summary_card(theme.image_hash, word, theme.word_sessions[word].summary_card)
+
+
+class JournalProfileStore(JSONProfileStore):
+    """
+    スナップショット (profile.json) + 追記専用ジャーナル (JSONL)。
+
+    ジャーナルの1行は型つきの変更イベント:
+      {"type": "fields", "values": {"coins": 120}}
+      {"type": "word_session", "image_hash": ..., "title": ..., "all_labels": [...], "word": ..., "session": {...}}
+      {"type": "summary_card", "image_hash": ..., "word": ..., "card": {...}}
+    値は差分ではなく変更後の値を書くので、同じイベントを二度適用しても結果は変わらない
+    (圧縮の途中で落ちてジャーナルが残っても、そのまま再生すればよい)。
+    """
+    incremental = True
+
+    def __init__(self, file_path, images, journal_path, max_journal_bytes=256 * 1024):
+        super().__init__(file_path, images)
+        self.journal_path = journal_path
+        self.max_journal_bytes = max_journal_bytes
+        self.journal_bytes = os.path.getsize(journal_path) if os.path.exists(journal_path) else 0
+
+    def load(self):
+        data = super().load()
+        if not os.path.exists(self.journal_path):
+            return data
+        if data is None:
+            data = {"theme_history": []}
+
+        themes = {theme.image_hash: theme for theme in data.setdefault("theme_history", [])}
+        replayed = 0
+        with open(self.journal_path, "r", encoding="utf-8") as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    # 追記の途中で落ちた最後の行など
+                    print(f"Skipping broken journal line {line_no} in {self.journal_path}")
+                    continue
+                self._apply(data, themes, event)
+                replayed += 1
+        print(f"Replayed {replayed} journal events from {self.journal_path}")
+        return data
+
+    def _apply(self, data, themes, event):
+        event_type = event.get("type")
+        if event_type == "fields":
+            data.update(event["values"])
+        elif event_type == "word_session":
+            theme = themes.get(event["image_hash"])
+            if theme is None:
+                theme = Theme(event.get("title", ""), event["image_hash"], event.get("all_labels"))
+                themes[theme.image_hash] = theme
+                data["theme_history"].append(theme)
+            else:
+                theme.title = event.get("title", theme.title)
+                theme.all_labels = event.get("all_labels", theme.all_labels)
+            theme.word_sessions[event["word"]] = WordSession.from_dict(event["session"])
+        elif event_type == "summary_card":
+            theme = themes.get(event["image_hash"])
+            session = theme.word_sessions.get(event["word"]) if theme else None
+            if session is not None:
+                session.summary_card = event["card"]
+        else:
+            print(f"Unknown journal event: {event_type}")
+
+    def _append(self, event):
+        line = json.dumps(event, ensure_ascii=False) + "\n"
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_bytes += len(line.encode("utf-8"))
+
+    def needs_compaction(self):
+        return self.journal_bytes > self.max_journal_bytes
+
+    def write_text(self, text):
+        # スナップショットを置き換えてからジャーナルを空にする (= 圧縮)
+        super().write_text(text)
+        with open(self.journal_path, "w", encoding="utf-8"):
+            pass
+        self.journal_bytes = 0
+
+    def save_fields(self, data, keys):
+        self._append({"type": "fields", "values": {key: data.get(key) for key in keys}})
+
+    def save_word_session(self, data, theme, word):
+        self._append({"type": "word_session", "image_hash": theme.image_hash, "title": theme.title,
+                      "all_labels": theme.all_labels, "word": word,
+                      "session": theme.word_sessions[word].to_dict()})
+
+    def save_summary_card(self, data, theme, word):
+        self._append({"type": "summary_card", "image_hash": theme.image_hash, "word": word,
+                      "card": theme.word_sessions[word].summary_card})
+
+
+def import_json_profile(json_path, db_path, images):
+    """既存の profile.json を SQLite に一度だけ取り込む。"""
+    data = JSONProfileStore(json_path, images).load()
+    store = SQLiteProfileStore(db_path)
+    if data is not None:
+        store.save_all(data)
+        print(f"Imported {len(data.get('theme_history', []))} themes from {json_path} into {db_path}")
+    return store
+
+
+def create_profile_store(backend, json_path, db_path, images, journal_path=None, max_journal_bytes=256 * 1024):
+    if backend == "json":
+        return JSONProfileStore(json_path, images)
+    if backend == "journal":
+        journal_path = journal_path or os.path.splitext(json_path)[0] + ".journal.jsonl"
+        return JournalProfileStore(json_path, images, journal_path, max_journal_bytes)
+    if backend == "sqlite":
+        if not os.path.exists(db_path) and os.path.exists(json_path):
+            return import_json_profile(json_path, db_path, images)
+        return SQLiteProfileStore(db_path)
+    raise ValueError(f"Unknown profile backend: {backend}")
+
+
+if __name__ == "__main__":
+    from config import IMAGE_STORE_DIR, PROFILE_FILE, PROFILE_DB_FILE
+    from image_store import ImageStore
+
+    json_path = sys.argv[1] if len(sys.argv) > 1 else PROFILE_FILE
+    db_path = sys.argv[2] if len(sys.argv) > 2 else PROFILE_DB_FILE
+    if os.path.exists(db_path):
+        print(f"{db_path} already exists. Nothing to import.")
+        sys.exit(1)
+    import_json_profile(json_path, db_path, ImageStore(IMAGE_STORE_DIR)).close()
@@ -0,0 +1,112 @@
+# prompt_templates.py
+"""
+prompt_*.txt のテンプレートを一度だけ読み込んで解析し、キャッシュしておく。
+
+  - 読み込み時に string.Formatter でプレースホルダーを取り出し、(文字列, 項目名) の並びにしておく
+  - 使うたびに os.stat で更新時刻とサイズを確認し、変わっていれば読み直す (起動中でもプロンプトを編集できる)
+  - コード側が渡す項目 (expected) と比べて、テンプレートにしかない項目は読み込み時に警告する
+  - 値が渡されなかった項目は "{name}" のまま送らず空文字にする (項目ごとに一度だけ警告)
+"""
+import os, glob, string, threading
+
+
+def read_text(path):
+    for enc in ("utf-8", "utf-8-sig", "cp932"):
+        try:
+            with open(path, "r", encoding=enc) as f:
+                return f.read()
+        except UnicodeDecodeError:
+            continue
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        return f.read()
+
+
+class PromptTemplate:
+    __slots__ = ("filename", "text", "segments", "fields", "stamp", "_warned")
+
+    def __init__(self, filename, text, stamp):
+        self.filename = filename
+        self.text = text
+        self.stamp = stamp
+        self._warned = set()
+        try:
+            parsed = list(string.Formatter().parse(text))
+        except ValueError as e:
+            # 閉じていない { } など。書式化せずにそのまま使う
+            print(f"Prompt template '{filename}' has invalid braces ({e}); using it as plain text.")
+            parsed = [(text, None, None, None)]
+        self.segments = [(literal, field, spec or "", conv) for literal, field, spec, conv in parsed]
+        self.fields = {field for _, field, _, _ in self.segments if field}
+
+    def render(self, **kwargs):
+        out = []
+        for literal, field, spec, conv in self.segments:
+            out.append(literal)
+            if field is None:
+                continue
+            if field not in kwargs:
+                if field not in self._warned:
+                    self._warned.add(field)
+                    print(f"Prompt template '{self.filename}': no value for {{{field}}}; rendering it empty.")
+                continue
+            value = kwargs[field]
+            if conv == "r":
+                value = repr(value)
+            elif conv == "s":
+                value = str(value)
+            elif conv == "a":
+                value = ascii(value)
+            out.append(format(value, spec))
+        return "".join(out)
+
+
+class TemplateRegistry:
+    def __init__(self, base_dir, expected=None):
+        self.base_dir = base_dir
+        self.expected = expected or {}  # filename -> コード側が渡す項目名の集合
+        self._templates = {}
+        self._lock = threading.Lock()
+        self.loads = 0  # 実際にファイルを読んだ回数 (確認用)
+
+    def _stamp(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _load(self, filename, path, stamp):
+        template = PromptTemplate(filename, read_text(path), stamp)
+        self.loads += 1
+        expected = self.expected.get(filename)
+        if expected is not None:
+            unknown = template.fields - expected
+            if unknown:
+                print(f"Prompt template '{filename}': unknown placeholder(s) {sorted(unknown)} "
+                      f"(the app only provides {sorted(expected)})")
+        return template
+
+    def get(self, filename):
+        """コンパイル済みテンプレートを返す。ファイルがなければ None。"""
+        path = os.path.join(self.base_dir, filename)
+        stamp = self._stamp(path)
+        with self._lock:
+            if stamp is None:
+                self._templates.pop(filename, None)
+                return None
+            template = self._templates.get(filename)
+            if template is None or template.stamp != stamp:
+                template = self._load(filename, path, stamp)
+                self._templates[filename] = template
+            return template
+
+    def render(self, filename, **kwargs):
+        template = self.get(filename)
+        if template is None or not template.text:
+            return ""
+        return template.render(**kwargs)
+
+    def preload(self, pattern="prompt_*.txt"):
+        """起動時に読み込んでおき、プレースホルダーの食い違いをここで報告する。"""
+        for path in sorted(glob.glob(os.path.join(self.base_dir, pattern))):
+            self.get(os.path.basename(path))
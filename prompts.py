@@ -0,0 +1,200 @@
+# prompts.py
+"""
+プロンプトの組み立てと、Gemini の応答の読み取り (画面にも API にも依存しない部分)。
+InquiryApp (Tk) と SessionEngine の両方から使う。
+"""
+import re, json
+
+from config import BASE_DIR
+from prompt_templates import TemplateRegistry
+
+# [MOD] プロンプトファイルは一度だけ読み込んで解析し、更新時刻が変わった時だけ読み直す
+# 各テンプレートにコード側が渡す項目 (これ以外のプレースホルダーは読み込み時に警告する)
+PROMPT_PLACEHOLDERS = {
+    "prompt_master.txt": {"grade", "guide_level", "initial_context", "vision_context"},
+    "prompt_content.txt": {"english_for_prompt", "grade", "guide_level"},
+    "prompt_tag.txt": {"english_for_prompt", "grade", "guide_level"},
+    "prompt_mission.txt": {"english_for_prompt", "grade", "guide_level"},
+    "prompt_quiz.txt": {"english_for_prompt", "grade", "student_level", "total_quizzes", "previous_quiz_questions"},
+}
+prompt_registry = TemplateRegistry(BASE_DIR, expected=PROMPT_PLACEHOLDERS)
+prompt_registry.preload()
+
+def render_prompt(filename: str, **kwargs) -> str:
+    return prompt_registry.render(filename, **kwargs)
+
+def build_prompt_from_file(filename: str, fallback_text: str, **kwargs) -> str:
+    template = render_prompt(filename, **kwargs)
+    if template:
+        return f"{template}\n\n{fallback_text}"
+    return fallback_text
+
+
+STREAM_MARKERS = ("[TRANSLATION]", "CHOICES:")
+
+def visible_stream_text(text: str) -> str:
+    """ストリーミング途中のテキストのうち、表示してよい部分 (英文だけ) を返す。
+    [TRANSLATION] / CHOICES: 以降と、末尾で途中まで届いているマーカーは隠す。"""
+    cut = len(text)
+    upper = text.upper()
+    for marker in STREAM_MARKERS:
+        i = upper.find(marker)
+        if i != -1:
+            cut = min(cut, i)
+        for n in range(len(marker) - 1, 0, -1):
+            if upper.endswith(marker[:n]):
+                cut = min(cut, len(text) - n)
+                break
+    return text[:cut].rstrip()
+
+def parse_json_object(raw: str):
+    """JSON だけを返すよう頼んでも前後に文章やコードフェンスが付くことがあるので、{ ... } を取り出して読む。"""
+    raw = (raw or "").strip()
+    try:
+        return json.loads(raw)
+    except Exception:
+        start = raw.find("{"); end = raw.rfind("}")
+        if start != -1 and end != -1:
+            try:
+                return json.loads(raw[start:end+1])
+            except Exception:
+                return None
+    return None
+
+def quizzes_from_json(items, total_quizzes):
+    quizzes_out = []
+    for item in items or []:
+        q_type = (item.get("type") or "").strip()
+        question = (item.get("question") or "").strip()
+        choices = item.get("choices") or []
+        answer = (item.get("answer") or "").strip()
+        if q_type and question and choices and answer:
+            quizzes_out.append({"q": question, "c": choices, "a": answer, "type": q_type})
+    if len(quizzes_out) != total_quizzes:
+        raise ValueError(f"Expected {total_quizzes} quizzes but got {len(quizzes_out)}.")
+    return quizzes_out
+
+def partial_json_string(text: str, key: str) -> str:
+    """ストリーミング途中の JSON から "key": "..." の値を (閉じていなくても) 取り出す。"""
+    m = re.search(r'"' + re.escape(key) + r'"\s*:\s*"((?:[^"\\]|\\.)*)', text)
+    if not m:
+        return ""
+    value = m.group(1)
+    if value.endswith("\\") and not value.endswith("\\\\"):
+        value = value[:-1]  # エスケープの途中で切れている
+    try:
+        return json.loads(f'"{value}"')
+    except Exception:
+        return value.replace("\\n", "\n")
+
+def format_question_choices(question: str, choices) -> str:
+    """parse_question_choices() で読める "QUESTION: ... CHOICES: [..],[..]" 形式に戻す。"""
+    return f"QUESTION: {question}\nCHOICES: " + ",".join(f"[{c}]" for c in choices)
+
+def parse_question_choices(text: str):
+    if not text:
+        return "", []
+    m = re.search(r"QUESTION:\s*(.+?)\s*CHOICES:\s*(.+)", text, re.S | re.I)
+    if not m:
+        return "", []
+    question = m.group(1).strip()
+    choices_raw = m.group(2).strip()
+    m2 = re.search(r"\bANSWER\s*:", choices_raw, re.I)
+    if m2:
+        choices_raw = choices_raw[:m2.start()].strip()
+    choices = [c.strip() for c in re.findall(r"\[(.*?)\]", choices_raw)]
+    return question, choices
+
+
+# v21.0から変更なし
+def get_master_prompt(grade, student_level, context_image=None, context_keyword=None, vision_labels=None):
+    
+    if grade in ["小学生以下", "1-2年生"]:
+        choice_prompt = "You MUST provide 3 choices, like this: CHOICES: [[Choice 1],[Choice 2],[Choice 3]]"
+    else:
+        choice_prompt = "Do not provide choices."
+
+    if context_keyword:
+        master_prompt_text = f"""
+You are an AI guide for inquiry-based English learning.
+The student's grade is: {grade}.
+The student's estimated English level is: {student_level}.
+
+Your task is to ask **one single, open-ended question** to start a conversation based on the keyword: '{context_keyword}'.
+The question MUST be appropriate for the student's level ({student_level}).
+
+**CRITICAL RULES:**
+- **Use simple English**, appropriate for the student's level.
+- The question MUST connect the keyword to a wider topic, such as **environmental problems, social studies (how society works), or interesting trivia**.
+- **Example 1 (Keyword 'grass'):** Ask "How do plants like grass help our planet?" (Environmental)
+- **Example 2 (Keyword 'car'):** Ask "How do cars change the way people live in a city?" (Social Studies)
+
+{choice_prompt}
+
+After your English response, you MUST provide a Japanese translation.
+Format it EXACTLY like this (with the [TRANSLATION] tag):
+
+(Your English question...)
+{choice_prompt}
+
+[TRANSLATION]
+(ここに日本語訳...)
+"""
+    else:
+         master_prompt_text = f"You are a helpful assistant. Please talk in simple English. (Grade: {grade}) (Level: {student_level}) (No keyword provided)"
+    initial_context = f"Keyword: {context_keyword}" if context_keyword else "Keyword: (none)"
+    if vision_labels:
+        vision_context = f"Vision labels: {', '.join(vision_labels)}"
+    else:
+        vision_context = "Vision labels: (none)"
+
+    master_prompt_text = build_prompt_from_file(
+        "prompt_master.txt",
+        master_prompt_text,
+        grade=grade,
+        guide_level=student_level,
+        initial_context=initial_context,
+        vision_context=vision_context
+    )
+
+
+    if context_image is not None:
+        return [master_prompt_text, context_image]
+    return [master_prompt_text]
+
+
+def parse_choices(ai_response: str):
+    """応答から "CHOICES: [..]" を取り出す。(choices, CHOICES を除いた応答) を返す。"""
+    choices = []
+    choices_match = re.search(r"CHOICES: \[(.+?)\](?:\n|$)", ai_response, re.DOTALL | re.IGNORECASE)
+    if choices_match:
+        choices_str = choices_match.group(1).strip()
+        if re.search(r"\[.+?\]", choices_str):
+            choices = [c.strip() for c in re.findall(r"\[([^\]]+)\]", choices_str)]
+        else:
+            choices = [c.strip() for c in choices_str.split(',')]
+        if choices:
+            ai_response = re.sub(r"CHOICES: \[(.+?)\](?:\n|$)", "", ai_response, flags=re.DOTALL | re.IGNORECASE)
+    return choices, ai_response.strip()
+
+
+def parse_translation(ai_response_cleaned: str):
+    if "[TRANSLATION]" in ai_response_cleaned:
+        parts = ai_response_cleaned.split("[TRANSLATION]", 1)
+        return parts[0].strip(), parts[1].strip()
+    return ai_response_cleaned.strip(), None
+
+
+def words_from_labels(labels, limit=10):
+    seen = set(); words = []
+    for lab in labels or []:
+        w = str(lab).replace("_"," ").split(",")[0].strip().lower()
+        if 2 <= len(w) <= 30 and w not in seen:
+            seen.add(w); words.append(w)
+        if len(words) >= limit: break
+    if len(words) < 3:
+        for w in ["animal","object","place","person","food","plant","color","shape","material","action"]:
+            if w not in seen:
+                words.append(w); seen.add(w)
+            if len(words) >= limit: break
+    return words
@@ -0,0 +1,146 @@
+# rate_limit.py
+"""
+API 呼び出しのクライアント側レート制限とリトライ。
+
+  - TokenBucket : 1分あたりの上限 (rate_per_min) と同時に出せる数 (burst) で呼び出しを待たせる。
+                  上限を超えた分はエラーにせず、トークンがたまるまで待ってから送る。
+                  サーバーから待ち時間を指定されたら pause() でバケツ全体を止める。
+                  イベントループの中からは acquire_async() (スレッドを止めずに待つ) を使う。
+                  background=True の呼び出しは reserve 個のトークンを残して待つ (残りは生徒が待つ呼び出し用)。
+  - RetryPolicy : 一時的なエラー (429 / 503 など) を指数バックオフ + ジッターで再試行する。
+                  サーバー指定の待ち時間 (retry_delay / Retry-After) があればそれ以上待つ。
+                  一時的かどうかは例外の型 → ステータスコード → メッセージの順に見る。
+                  再試行はアプリ全体で共有する予算 (1分あたりの回数) の範囲内だけ行う。
+"""
+import re, time, random, asyncio, threading
+
+from google.api_core import exceptions as api_exceptions
+
+_RETRYABLE_TYPES = (api_exceptions.ResourceExhausted, api_exceptions.TooManyRequests,
+                    api_exceptions.ServiceUnavailable, api_exceptions.InternalServerError,
+                    api_exceptions.DeadlineExceeded, TimeoutError, ConnectionError)
+_RETRYABLE_CODES = {429, 500, 503, 504}
+# コードを持たない例外はメッセージで判断する (数字は単語として現れたときだけ。"id 15030" などに反応しない)
+_RETRYABLE_STATUS = re.compile(r"\b(429|500|503)\b")
+_RETRYABLE_MARKERS = ("quota", "rate limit", "resource exhausted", "resourceexhausted", "unavailable",
+                      "deadline exceeded", "timed out")
+
+
+class TokenBucket:
+    def __init__(self, rate_per_min, burst=1, reserve=0):
+        self.rate = rate_per_min / 60.0  # 1秒あたりに増えるトークン
+        self.capacity = max(1, burst)
+        self.reserve = max(0, min(reserve, self.capacity - 1))  # BACKGROUND が取らずに残す数
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        if now > self._updated:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def _wait_time(self, now, background=False):
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._refill(now)
+        need = 1 + (self.reserve if background else 0)
+        if self._tokens >= need:
+            return 0.0
+        return (need - self._tokens) / self.rate
+
+    def try_acquire(self, background=False):
+        with self._lock:
+            if self._wait_time(time.monotonic(), background) > 0:
+                return False
+            self._tokens -= 1
+            return True
+
+    def acquire(self, background=False):
+        """トークンが取れるまで待つ。待った秒数を返す。"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                wait_s = self._wait_time(time.monotonic(), background)
+                if wait_s <= 0:
+                    self._tokens -= 1
+                    return waited
+            time.sleep(wait_s)
+            waited += wait_s
+
+    async def acquire_async(self, background=False):
+        """acquire() のコルーチン版。待つ間はイベントループのほかの処理が進む。"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                wait_s = self._wait_time(time.monotonic(), background)
+                if wait_s <= 0:
+                    self._tokens -= 1
+                    return waited
+            await asyncio.sleep(wait_s)
+            waited += wait_s
+
+    def pause(self, seconds):
+        """サーバーに待てと言われたら、その間は誰にもトークンを渡さない。"""
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._tokens = min(self._tokens, 1.0)  # 再開直後に送れるのは1件だけ
+            self._updated = max(self._updated, self._paused_until)
+
+
+def _status_code(error):
+    """例外の HTTP ステータスコード (api_core の .code、requests / aiohttp の .status_code / .status)。なければ None。"""
+    for attr in ("code", "status_code", "status"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int) and not isinstance(value, bool) and 100 <= value < 600:
+            return value
+    return None
+
+
+def is_retryable(error):
+    if isinstance(error, _RETRYABLE_TYPES):
+        return True
+    code = _status_code(error)
+    if code is not None:
+        return code in _RETRYABLE_CODES
+    text = str(error).lower()
+    return bool(_RETRYABLE_STATUS.search(text)) or any(marker in text for marker in _RETRYABLE_MARKERS)
+
+
+def server_retry_delay(error):
+    """エラーに含まれるサーバー指定の待ち時間 (秒) を返す。なければ None。"""
+    text = str(error)
+    m = re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)", text)
+    if m:
+        return float(m.group(1))
+    m = re.search(r"retry[- ]after[\"':\s]+(\d+(?:\.\d+)?)", text, re.IGNORECASE)
+    if m:
+        return float(m.group(1))
+    m = re.search(r"retry in (\d+(?:\.\d+)?)\s*s", text, re.IGNORECASE)
+    if m:
+        return float(m.group(1))
+    return None
+
+
+class RetryPolicy:
+    def __init__(self, max_retries=4, base_delay=1.0, max_delay=30.0, budget_per_min=10):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = TokenBucket(budget_per_min, burst=budget_per_min)  # アプリ全体の再試行予算
+
+    def next_delay(self, error, attempt):
+        """attempt 回目の失敗のあとに待つ秒数。再試行しない場合は None。"""
+        if attempt >= self.max_retries or not is_retryable(error):
+            return None
+        if not self.budget.try_acquire():
+            print("[DEBUG] Retry budget exhausted; giving up.")
+            return None
+        # full jitter: 0 〜 base * 2^attempt (上限 max_delay) の間でばらけさせる
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        server_delay = server_retry_delay(error)
+        if server_delay is not None:
+            return max(server_delay, backoff)
+        return backoff
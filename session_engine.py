@@ -0,0 +1,831 @@
+# session_engine.py
+"""
+1人の生徒の学習セッション (会話 → ストーリー → クイズ → テーマ保存 → レベル判定) を
+画面なしで進めるエンジン。InquiryApp (Tk) はこの上の表示だけを受け持つ。
+
+  - api     : APIClients (または同じメソッドを持つもの)。genai / Tk はここでは import しない
+  - profile : UserProfile。テーマ・コイン・レベルの保存先
+
+api_* に当たるメソッド (start_inquiry / continue_conversation / generate_*) はブロックするので、
+呼ぶ側がワーカースレッドで実行する。それ以外は状態を変えるだけですぐに戻る。
+aapi (AsyncAPIClients) を渡すと、会話の流れのメソッドには *_async のコルーチン版も使える
+(プロンプトの組み立てと結果の反映は同期版と共通)。
+状態の変化は on(event, callback) で受け取れる (コールバックは呼び出し元のスレッドで呼ばれる):
+  coins_changed(coins) / level_changed(old, new) / settings_changed() / theme_saved(theme, word)
+"""
+import io, re
+
+import PIL.Image
+
+from config import HISTORY_KEEP_TURNS, HISTORY_TOKEN_BUDGET, HISTORY_SUMMARY_MAX_CHARS
+from conversation_history import HistoryManager, compact_inquiry_turn
+from image_store import image_digest
+from profile_model import Theme, WordSession
+from prompts import (render_prompt, build_prompt_from_file, get_master_prompt, parse_json_object,
+                     quizzes_from_json, partial_json_string, format_question_choices,
+                     parse_question_choices, words_from_labels)
+
+LEVELS = ["CEFR Pre-A1", "CEFR A1", "CEFR A2"]
+HOME_CHOICE = "ホームに戻る"
+
+
+class SessionEngine:
+    def __init__(self, api, profile, total_quizzes=6, aapi=None):
+        self.api = api
+        self.aapi = aapi  # AsyncAPIClients (*_async メソッドを使う場合だけ)
+        self.profile = profile
+        self._listeners = {}
+
+        self.grade = profile.get("grade")
+        self.student_level = profile.get("current_level")
+        self.coins = profile.get("coins")
+        # [MOD] v21.1 (R2) プロファイルからテーマ履歴をロード
+        self.theme_history = profile.get("theme_history")
+        self.total_quizzes_to_generate = total_quizzes
+
+        # Gemini に送る履歴は直近のターン + 古いターンの要約にする (写真は1ターン目だけ)
+        self.history_manager = HistoryManager(keep_turns=HISTORY_KEEP_TURNS, token_budget=HISTORY_TOKEN_BUDGET,
+                                              summary_max_chars=HISTORY_SUMMARY_MAX_CHARS,
+                                              compact=compact_inquiry_turn, pin_first_turn=True)
+        self.clear_photo()
+
+    # --- イベント ---
+    def on(self, event, callback):
+        self._listeners.setdefault(event, []).append(callback)
+
+    def emit(self, event, *args):
+        for callback in self._listeners.get(event, []):
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"Session event '{event}' handler failed: {e}")
+
+    # --- 設定・コイン ---
+    def set_grade(self, grade):
+        self.grade = grade
+        self.profile.set("grade", grade)
+        self.emit("settings_changed")
+
+    def set_level(self, level):
+        self.student_level = level
+        self.profile.set("current_level", level)
+        self.emit("settings_changed")
+
+    def add_coins(self, amount):
+        self.coins = self.profile.add_coins(amount)
+        print(f"Added {amount} coins. Total: {self.coins}")
+        self.emit("coins_changed", self.coins)
+
+    # --- セッションの状態 ---
+    def reset_session(self):
+        """同じ写真で新しいキーワードを始めるときに、会話・ストーリー・クイズだけを消す。"""
+        self.conversation_phase = "conversation"
+        self.conversation_history = []
+        self.chat_session = None
+        self.story_chat_history = []
+        self.current_story_text = ""
+        self.current_story_translation = ""
+        self.story_quizzes = None  # ストーリーと一緒に作ったクイズ (COMBINED_STORY_QUIZ)
+        self.quiz_data = []
+        self.current_quiz_index = 0
+        self.current_quiz_results = []
+
+    def clear_photo(self):
+        self.reset_session()
+        self.image_data = None; self.initial_image_data = None; self.initial_image_path = ""
+        self.initial_image_hash = None
+        self.initial_image_labels = []; self.current_vision_labels = []
+        self.selected_word = None
+        self.used_words_in_current_theme = set()
+        self.current_theme_title = ""
+
+    def set_photo(self, image_data, path=""):
+        self.image_data = image_data
+        self.initial_image_data = image_data; self.initial_image_path = path
+        self.initial_image_hash = image_digest(image_data)
+
+    def set_labels(self, labels):
+        self.initial_image_labels = labels or []; self.current_vision_labels = labels or []
+
+    def known_labels(self):
+        """保存済みテーマ、または以前に解析した写真ならそのラベル (Vision API は呼ばない)。なければ None。"""
+        known_theme = self.profile.find_theme(self.initial_image_hash)
+        if known_theme and known_theme.all_labels:
+            return known_theme.all_labels
+        return self.api.cached_labels(self.image_data)
+
+    def word_choices(self, labels, limit=10):
+        words = words_from_labels(labels, limit=limit)
+        return [w for w in words if w not in self.used_words_in_current_theme][:limit]
+
+    def select_word(self, word):
+        """写真から選んだキーワードでセッションを始める。"""
+        self.selected_word = word
+        self.used_words_in_current_theme.add(word)
+        if not self.current_theme_title:
+            self.current_theme_title = word
+
+    def load_theme(self, theme, word):
+        """保存済みテーマの写真で、新しいキーワードのセッションを始める。"""
+        self.reset_session()
+        self.initial_image_hash = theme.image_hash
+        self.initial_image_data = self.profile.images.get(self.initial_image_hash)
+        self.initial_image_labels = theme.all_labels
+        self.current_theme_title = theme.title
+        self.used_words_in_current_theme = set(theme.word_sessions.keys())
+        self.selected_word = word
+        self.used_words_in_current_theme.add(word)
+
+    def continue_with_word(self, word):
+        """次のステップで選んだキーワードで、同じ写真のセッションを始め直す。"""
+        self.reset_session()
+        self.selected_word = word
+        self.used_words_in_current_theme = self.profile.used_words(self.initial_image_hash)
+        self.used_words_in_current_theme.add(word)
+
+    def inquiry_args(self):
+        return (self.initial_image_data, self.selected_word, self.initial_image_labels)
+
+    # --- API を呼ぶ処理 (ブロックする) ---
+    def get_image_labels(self, image_data):
+        try:
+           labels = self.api.label_detection(image_data)
+           print(f"[DEBUG] Vision API Labels: {labels}")
+           return labels
+        except Exception as e:
+            print(f"Vision API Error: {e}")
+            return []
+
+    def get_local_labels(self, image_data):
+        """ローカルのラベラー (ネットワークなし) のラベル。使えなければ []。"""
+        try:
+            labels = self.api.local_labels(image_data)
+            print(f"[DEBUG] Local Labels: {labels}")
+            return labels
+        except Exception as e:
+            print(f"Local labeler Error: {e}")
+            return []
+
+    def _inquiry_prompt(self, image_data=None, keyword=None, vision_labels=None):
+        """1ターン目のプロンプトと画像ハッシュ (状態は変えないので、先読みにもそのまま使える)。"""
+        image_hash = None
+        if image_data:
+            img = PIL.Image.open(io.BytesIO(image_data))
+            image_hash = image_digest(image_data)
+            prompt_parts = get_master_prompt(self.grade, self.student_level, context_image=img, context_keyword=keyword, vision_labels=vision_labels)
+        elif keyword:
+            prompt_parts = get_master_prompt(self.grade, self.student_level, context_keyword=keyword, vision_labels=vision_labels)
+        else:
+            raise ValueError("image_data or keyword is required.")
+        return prompt_parts, image_hash
+
+    def _set_topic(self, keyword, vision_labels, image_hash=None):
+        # 2ターン目以降は写真を送らず、キーワードとラベルで参照する
+        labels_text = ", ".join(vision_labels) if vision_labels else "(none)"
+        self.history_manager.context = f"Topic keyword: {keyword or '(none)'}. Photo labels: {labels_text}."
+        self.history_manager.image_hash = image_hash
+
+    def start_inquiry(self, image_data=None, keyword=None, vision_labels=None, on_chunk=None):
+        prompt_parts, image_hash = self._inquiry_prompt(image_data, keyword, vision_labels)
+        self._set_topic(keyword, vision_labels, image_hash)
+        # 1ターン目は学年・レベル・キーワード・画像だけで決まるのでキャッシュできる
+        self.chat_session, text = self.api.start_chat_cached(prompt_parts, image_hash=image_hash, on_chunk=on_chunk)
+        self.conversation_history = self.chat_session.history
+        return text
+
+    # [MOD] パイプライン開始: キーワードを選ぶ前に、Gemini のキーワード候補と1ターン目を先に作っておく
+    def _shortlist_prompt(self, image_data, limit):
+        img = PIL.Image.open(io.BytesIO(image_data))
+        prompt = f"""
+Look at the photo. List up to {limit} English keywords (single common nouns) for things in it
+that a {self.grade} student at {self.student_level} level could explore in an inquiry conversation.
+Put the most interesting, most clearly visible thing first.
+Return JSON ONLY (no prose/markdown/code fences): {{"keywords": ["...", "..."]}}
+"""
+        return [prompt, img], image_digest(image_data)
+
+    def _parse_shortlist(self, text, limit):
+        keywords = (parse_json_object(text) or {}).get("keywords")
+        if not isinstance(keywords, list):
+            return []
+        words = []
+        for k in keywords:
+            w = str(k).strip().lower()
+            if 2 <= len(w) <= 30 and w not in words:
+                words.append(w)
+        return words[:limit]
+
+    def _cached_shortlist(self, cache_key, limit):
+        text = self.api.response_cache.get(cache_key)
+        words = self._parse_shortlist(text, limit) if text is not None else []
+        if words:
+            print(f"[DEBUG] Keyword shortlist from cache: {cache_key[:12]}")
+        return words
+
+    def _store_shortlist(self, cache_key, text, limit):
+        # 読めた応答だけをキャッシュに入れる (壊れた応答を同じ写真で何日も返さないように)
+        words = self._parse_shortlist(text, limit)
+        if words:
+            self.api.response_cache.put(cache_key, text)
+        return words
+
+    def generate_keyword_shortlist(self, image_data, limit=5):
+        prompt_parts, image_hash = self._shortlist_prompt(image_data, limit)
+        # 同じ写真・学年・レベルならキャッシュから返る
+        cache_key = self.api.response_key(prompt_parts, image_hash)
+        words = self._cached_shortlist(cache_key, limit)
+        if words:
+            return words
+        text = self.api.send(self.api.start_chat(history=[]), prompt_parts).text
+        return self._store_shortlist(cache_key, text, limit)
+
+    def likeliest_word(self, labels, shortlist=None):
+        """先読みするキーワード。Vision のラベルと Gemini の候補の両方に出た語を優先する。"""
+        words = self.word_choices(labels)
+        for w in shortlist or []:
+            if w in words:
+                return w
+        return words[0] if words else None
+
+    def pipelined_word_choices(self, labels, shortlist=None, limit=10):
+        """Vision のラベルから作った選択肢に、Gemini の候補にしかない語を足す。"""
+        words = self.word_choices(labels, limit=limit)
+        extra = [w for w in shortlist or [] if w not in words and w not in self.used_words_in_current_theme]
+        return words + extra[:max(0, limit - len(words))]
+
+    def prefetch_first_turn(self, keyword, vision_labels):
+        """選ばれる前に1ターン目を作り、応答キャッシュに入れておく (エンジンの状態は変えない)。
+        選ばれたら start_inquiry() がキャッシュから返すので、選ばれなければ何も片付けなくてよい。"""
+        prompt_parts, image_hash = self._inquiry_prompt(self.initial_image_data, keyword, vision_labels)
+        return self.api.start_chat_cached(prompt_parts, image_hash=image_hash)[1]
+
+    def start_windowed_chat(self):
+        """全履歴ではなく、HistoryManager が作った窓を履歴にしてチャットを始める。"""
+        window = self.history_manager.window(self.conversation_history)
+        return self.api.start_chat(history=window), window
+
+    def record_turn(self, chat, window, prompt):
+        # 全履歴は手元に残し (要約の材料)、今回のターンだけを後ろに足す
+        self.conversation_history = list(self.conversation_history) + list(chat.history[len(window):])
+        print(f"[DEBUG] Request size: ~{HistoryManager.request_tokens(window, prompt)} tokens "
+              f"({len(window)} history entries, full history {len(self.conversation_history)})")
+
+    def _continue_prompt(self, user_reply):
+        if self.grade in ["小学生以下", "1-2年生"]:
+            choice_prompt = "You MUST provide 3 new choices for this question, like this: CHOICES: [[Choice 1],[Choice 2],[Choice 3]]"
+        else:
+            choice_prompt = "Do not provide choices."
+
+        inquiry_prompt = f"""
+The user's last reply was: "{user_reply}"
+The student's level is: {self.student_level}.
+
+Continue the inquiry-based conversation.
+1. Briefly acknowledge their reply.
+2. Ask **one new, open-ended, inquiry-based question** to deepen their thinking (about **environment, social studies, or trivia**).
+3. Keep the conversation flowing and use **simple English, appropriate for {self.student_level}**.
+- **Example (Social):** User: "Cars are fast." AI: "That's true! But what happens to a town when many cars are used?"
+- **Example (Env):** User: "I like trees." AI: "Trees are great! How do trees help keep the air clean?"
+
+{choice_prompt}
+
+CRITICAL: After your English response, you MUST provide a Japanese translation.
+Format it EXACTLY like this (with the [TRANSLATION] tag):
+
+(Your English response...)
+{choice_prompt}
+
+[TRANSLATION]
+(ここに日本語訳...)
+
+"""
+        return inquiry_prompt
+
+    def continue_conversation(self, user_reply, on_chunk=None):
+        inquiry_prompt = self._continue_prompt(user_reply)
+        self.chat_session, window = self.start_windowed_chat()
+        resp = self.api.send(self.chat_session, inquiry_prompt, on_chunk=on_chunk)
+        self.record_turn(self.chat_session, window, inquiry_prompt)
+        return resp.text
+
+    def _quiz_prompt(self, total_quizzes, previous_quiz_questions):
+        prompt = f"""
+You are creating exactly {total_quizzes} short quizzes about the story in our chat history.
+Rules:
+- Allowed types: "True/False" or "Fill-in-the-blank".
+- Avoid duplicate or near-duplicate questions. Do NOT repeat these questions: {previous_quiz_questions}
+- Difficulty must match a {self.student_level} student.
+- True/False: choices must be ["True","False"], answer is "True" or "False".
+- Fill-in-the-blank: include a blank like "___" and 3-4 concise choices; answer must exactly match one choice.
+- Return JSON ONLY (no prose/markdown/code fences).
+- JSON schema (exact keys):
+{{"quizzes":[{{"type":"True/False","question":"...","choices":["True","False"],"answer":"True"}},{{"type":"Fill-in-the-blank","question":"... ___ ...","choices":["choice1","choice2","choice3"],"answer":"choice1"}}]}}
+- quizzes list length must be exactly {total_quizzes}.
+"""
+        prompt = build_prompt_from_file(
+            "prompt_quiz.txt",
+            prompt,
+            grade=self.grade,
+            english_for_prompt=self.current_story_text or "(no story)",
+            student_level=self.student_level,
+            total_quizzes=total_quizzes,
+            previous_quiz_questions=previous_quiz_questions
+        )
+        return prompt
+
+    def _parse_quizzes(self, text, total_quizzes):
+        parsed = parse_json_object(text)
+        if not parsed or "quizzes" not in parsed:
+            raise ValueError("Failed to parse quiz JSON from Gemini response.")
+
+        quizzes_out = quizzes_from_json(parsed.get("quizzes"), total_quizzes)
+        print(f"[DEBUG] Bulk quiz generation: received {len(quizzes_out)} quizzes in one call.")
+        return quizzes_out
+
+    def generate_quizzes(self, story_chat_history, total_quizzes, previous_quiz_questions):
+        chat = self.api.start_chat(history=story_chat_history)
+        resp = self.api.send(chat, self._quiz_prompt(total_quizzes, previous_quiz_questions))
+        return self._parse_quizzes(resp.text, total_quizzes)
+
+    def generate_tag_choices(self):
+        fallback_prompt = f"""
+Based on the story below, create a single question and 3-5 keyword choices.
+QUESTION: ...
+CHOICES: [Choice1],[Choice2],[Choice3]
+
+STORY:
+{self.current_story_text}
+"""
+        prompt = build_prompt_from_file(
+            "prompt_tag.txt",
+            fallback_prompt,
+            english_for_prompt=self.current_story_text,
+            grade=self.grade,
+            guide_level=self.student_level
+        )
+        return self.api.generate_text(prompt)
+
+    def generate_mission_choices(self):
+        fallback_prompt = f"""
+Based on the story below, ask which keyword the student wants to photograph next.
+Use keywords from the story and include [ホームに戻る].
+QUESTION: ...
+CHOICES: [Choice1],[Choice2],[ホームに戻る]
+
+STORY:
+{self.current_story_text}
+"""
+        prompt = build_prompt_from_file(
+            "prompt_mission.txt",
+            fallback_prompt,
+            english_for_prompt=self.current_story_text,
+            grade=self.grade,
+            guide_level=self.student_level
+        )
+        return self.api.generate_text(prompt)
+
+    # [MOD] タグの選択肢と次のミッションを1回の呼び出しで作る (ストーリーは1回だけ送る)
+    def generate_next_steps(self):
+        story_ref = "(see STORY at the end)"
+        tag_rules = render_prompt("prompt_tag.txt", english_for_prompt=story_ref, grade=self.grade,
+                                  guide_level=self.student_level) or \
+            "Create a single question and 3-5 keyword choices that describe the theme of this inquiry."
+        mission_rules = render_prompt("prompt_mission.txt", english_for_prompt=story_ref, grade=self.grade,
+                                      guide_level=self.student_level) or \
+            "Ask which keyword the student wants to photograph next. Use keywords from the story and include [ホームに戻る]."
+        prompt = f"""
+Do BOTH of the following tasks for the same story.
+
+### TASK "tag"
+{tag_rules}
+
+### TASK "mission"
+{mission_rules}
+
+**OUTPUT FORMAT (this overrides the QUESTION/CHOICES format above):**
+Return JSON ONLY (no prose/markdown/code fences) with exactly these keys:
+{{"tag": {{"question": "...", "choices": ["...", "..."]}}, "mission": {{"question": "...", "choices": ["...", "ホームに戻る"]}}}}
+Choices are plain strings without brackets.
+
+STORY:
+{self.current_story_text}
+"""
+        # 読めた応答だけをキャッシュに入れる (壊れた JSON を次回も返さないように)
+        cache_key = self.api.response_key(prompt)
+        cached = self.api.response_cache.get(cache_key)
+        steps = self._parse_next_steps(cached) if cached is not None else None
+        if steps is not None:
+            print(f"[DEBUG] Next steps from cache: {cache_key[:12]}")
+            return steps
+        text = self.api.send(self.api.start_chat(history=[]), prompt).text
+        steps = self._parse_next_steps(text)
+        if steps is not None:
+            self.api.response_cache.put(cache_key, text)
+        return steps
+
+    def _parse_next_steps(self, text):
+        parsed = parse_json_object(text)
+        steps = {}
+        for key in ("tag", "mission"):
+            item = (parsed or {}).get(key)
+            if not isinstance(item, dict):
+                return None
+            question = str(item.get("question") or "").strip()
+            choices = [str(c).strip().strip("[]") for c in item.get("choices") or [] if str(c).strip()]
+            if not question or not choices:
+                return None
+            steps[key] = format_question_choices(question, choices)
+        return steps
+
+    def _build_story_prompt(self):
+        # >>> INSERT: CEFR-based story control (ここから)
+        level_rules = {
+            "CEFR Pre-A1": "Write 3–4 sentences, 4–7 words each. Use only very simple words (dog, tree, book, happy, play). No conjunctions. One idea per sentence.",
+            "CEFR A1":     "Write 5–6 sentences, 6–10 words each. Use simple present/past and allow 'and' or 'but'. Keep vocabulary at A1.",
+            "CEFR A2":     "Write 6–8 sentences, 8–12 words each. Include at least one sentence with 'because' or 'so', and one comparative adjective (bigger/stronger/healthier). A2-level vocabulary only."
+        }
+        level_rule = level_rules.get(self.student_level, "")
+        # >>> INSERT: CEFR-based story control (ここまで)
+
+        story_prompt = f"""
+[CEFR rule] {level_rule}
+
+Based on the **ideas and themes** from our conversation (e.g., environment, social studies), create an educational **5 to 6 sentence** English story.
+The story must be written at a {self.student_level} level.
+The story should be creative but **provide a learning point**.
+
+**CRITICAL RULE:** After the English story, you MUST provide a Japanese translation.
+Format it EXACTLY like this (with the [TRANSLATION] tag):
+
+(English Story...)
+
+[TRANSLATION]
+(ここに日本語訳...)
+"""
+        story_prompt = build_prompt_from_file(
+            "prompt_content.txt",
+            story_prompt,
+            english_for_prompt="(use chat history)",
+            grade=self.grade,
+            guide_level=self.student_level
+        )
+        return story_prompt
+
+    def generate_story(self, on_chunk=None):
+        story_prompt = self._build_story_prompt()
+        chat, window = self.start_windowed_chat()
+        resp = self.api.send(chat, story_prompt, on_chunk=on_chunk)
+        self.record_turn(chat, window, story_prompt)
+        return resp.text, chat.history  # クイズ生成にもこの (短い) 履歴を使う
+
+    # [MOD] ストーリー・訳・クイズを1回の呼び出しで作る。読めなければ従来の2回呼び出しに戻る
+    def _story_quiz_prompt(self):
+        total = self.total_quizzes_to_generate
+        return self._build_story_prompt() + f"""
+
+**OUTPUT FORMAT (this overrides the format above):**
+Return JSON ONLY (no prose/markdown/code fences) with exactly these keys:
+{{"story": "(English story; keep the <word> markup)", "translation": "(Japanese translation)", "quizzes": [...]}}
+"quizzes" must contain exactly {total} short quizzes about the story:
+- Allowed types: "True/False" or "Fill-in-the-blank".
+- Difficulty must match a {self.student_level} student. Questions must be based only on facts in the story.
+- True/False: choices must be ["True","False"], answer is "True" or "False".
+- Fill-in-the-blank: include a blank like "___" and 3-4 concise choices; answer must exactly match one choice.
+- Each item: {{"type":"...","question":"...","choices":[...],"answer":"..."}}
+"""
+
+    def _story_chunks(self, on_chunk):
+        if on_chunk:
+            return lambda text: on_chunk(partial_json_string(text, "story"))
+        return None
+
+    def _finish_story_with_quizzes(self, chat, window, prompt, text):
+        """1回の呼び出しの応答を (story_full, 履歴, quizzes) にする。ストーリーが読めなければ None。"""
+        total = self.total_quizzes_to_generate
+        parsed = parse_json_object(text)
+        story = (parsed or {}).get("story")
+        if not isinstance(story, str) or not story.strip():
+            print("[DEBUG] Combined story+quiz JSON could not be parsed; falling back to story-only call.")
+            return None
+
+        self.record_turn(chat, window, prompt)
+        story_full = f"{story.strip()}\n\n[TRANSLATION]\n{(parsed.get('translation') or '').strip()}"
+        try:
+            quizzes = quizzes_from_json(parsed.get("quizzes"), total)
+            print(f"[DEBUG] Combined generation: story + {len(quizzes)} quizzes in one call.")
+        except Exception as e:
+            print(f"[DEBUG] Combined quizzes unusable ({e}); quizzes will be generated separately.")
+            quizzes = None
+        return story_full, chat.history, quizzes
+
+    def generate_story_with_quizzes(self, on_chunk=None):
+        prompt = self._story_quiz_prompt()
+        chat, window = self.start_windowed_chat()
+        resp = self.api.send(chat, prompt, on_chunk=self._story_chunks(on_chunk))
+        result = self._finish_story_with_quizzes(chat, window, prompt, resp.text)
+        return result or self.generate_story(on_chunk=on_chunk)
+
+    # --- 非同期版 (aapi のイベントループの中で呼ぶ) ---
+    async def get_image_labels_async(self, image_data):
+        try:
+            labels = await self.aapi.label_detection(image_data)
+            print(f"[DEBUG] Vision API Labels: {labels}")
+            return labels
+        except Exception as e:
+            print(f"Vision API Error: {e}")
+            return []
+
+    async def get_local_labels_async(self, image_data):
+        try:
+            labels = await self.aapi.local_labels(image_data)
+            print(f"[DEBUG] Local Labels: {labels}")
+            return labels
+        except Exception as e:
+            print(f"Local labeler Error: {e}")
+            return []
+
+    async def start_inquiry_async(self, image_data=None, keyword=None, vision_labels=None, on_chunk=None):
+        prompt_parts, image_hash = self._inquiry_prompt(image_data, keyword, vision_labels)
+        self._set_topic(keyword, vision_labels, image_hash)
+        self.chat_session, text = await self.aapi.start_chat_cached(prompt_parts, image_hash=image_hash,
+                                                                    on_chunk=on_chunk)
+        self.conversation_history = self.chat_session.history
+        return text
+
+    async def generate_keyword_shortlist_async(self, image_data, limit=5):
+        prompt_parts, image_hash = self._shortlist_prompt(image_data, limit)
+        cache_key = self.api.response_key(prompt_parts, image_hash)
+        words = self._cached_shortlist(cache_key, limit)
+        if words:
+            return words
+        text = (await self.aapi.send_message(self.api.start_chat(history=[]), prompt_parts)).text
+        return self._store_shortlist(cache_key, text, limit)
+
+    async def prefetch_first_turn_async(self, keyword, vision_labels):
+        prompt_parts, image_hash = self._inquiry_prompt(self.initial_image_data, keyword, vision_labels)
+        return (await self.aapi.start_chat_cached(prompt_parts, image_hash=image_hash))[1]
+
+    async def continue_conversation_async(self, user_reply, on_chunk=None):
+        inquiry_prompt = self._continue_prompt(user_reply)
+        chat, window = self.start_windowed_chat()
+        resp = await self.aapi.send_message(chat, inquiry_prompt, on_chunk=on_chunk)
+        self.chat_session = chat
+        self.record_turn(chat, window, inquiry_prompt)
+        return resp.text
+
+    async def generate_story_async(self, on_chunk=None):
+        story_prompt = self._build_story_prompt()
+        chat, window = self.start_windowed_chat()
+        resp = await self.aapi.send_message(chat, story_prompt, on_chunk=on_chunk)
+        self.record_turn(chat, window, story_prompt)
+        return resp.text, chat.history
+
+    async def generate_story_with_quizzes_async(self, on_chunk=None):
+        prompt = self._story_quiz_prompt()
+        chat, window = self.start_windowed_chat()
+        resp = await self.aapi.send_message(chat, prompt, on_chunk=self._story_chunks(on_chunk))
+        result = self._finish_story_with_quizzes(chat, window, prompt, resp.text)
+        return result or await self.generate_story_async(on_chunk=on_chunk)
+
+    async def generate_quizzes_async(self, story_chat_history, total_quizzes, previous_quiz_questions):
+        chat = await self.aapi.start_chat(history=story_chat_history)
+        resp = await self.aapi.send_message(chat, self._quiz_prompt(total_quizzes, previous_quiz_questions))
+        return self._parse_quizzes(resp.text, total_quizzes)
+
+    def generate_summary_guidance(self, session_data):
+        story = session_data.story or "No story."
+        quiz_summary = []
+        for q in session_data.quizzes:
+            quiz_summary.append(f"- {q['q']} (Answer: {q['a']})")
+        quiz_text = "\n".join(quiz_summary)
+
+        guidance_prompt = f"""
+You are an AI assistant helping a student fill out their summary card.
+The student's grade is {self.grade}.
+Your task is to write a short, friendly message (in **simple Japanese**) to the student.
+Guide them by asking **one thinking question for each of the first 3 fields**.
+
+Here is the data from their learning session:
+---
+**STORY:**
+{story}
+
+**QUIZZES THEY TOOK:**
+{quiz_text}
+---
+
+**Example Output (Must be in Japanese):**
+"このトピックの学習、おつかれさま！
+カードを埋めるために、こんなことを考えてみよう：
+
+1.  **事実:** どんな「こと」（事実）を学んだかな？（ストーリーやクイズに出てきたことなど）
+2.  **気持ち/解決策:** この話でどんな「きもち」になったかな？ 私たちにできる小さな「かいけつさく」はあるかな？
+3.  **新しい視点:** この勉強で、なにか「あたらしいかんがえ」は生まれた？
+4.  **参考:** ばっちりだね！ ほかにも、どこでこれについて学べるかな？（としょかん、はくぶつかんなど）"
+"""
+        return self.api.generate_text(guidance_prompt)
+
+    # --- ストーリーとクイズ ---
+    def start_story(self):
+        self.conversation_phase = "quiz"
+        self.current_quiz_results = []
+        self.current_story_text = ""
+        self.current_story_translation = ""
+
+    def apply_story(self, ai_response):
+        """generate_story(_with_quizzes) の結果 (失敗なら None) をセッションに入れ、英文を返す。"""
+        self.story_quizzes = None
+        if not ai_response:
+            ai_story_full = "Error: No story generated."
+            self.story_chat_history = self.conversation_history
+        else:
+            ai_story_full, story_chat_history = ai_response[:2]
+            self.story_chat_history = story_chat_history
+            if len(ai_response) > 2:
+                self.story_quizzes = ai_response[2]  # 1回の呼び出しでクイズもできている
+
+        try:
+            if "[TRANSLATION]" in ai_story_full:
+                parts = ai_story_full.split("[TRANSLATION]", 1)
+                self.current_story_text = parts[0].strip()
+                self.current_story_translation = parts[1].strip()
+            else:
+                self.current_story_text = ai_story_full.strip()
+                self.current_story_translation = "(No translation provided by AI.)"
+        except Exception as e:
+            print(f"Error parsing story translation: {e}")
+            self.current_story_text = ai_story_full
+            self.current_story_translation = "(Error parsing translation.)"
+        return self.current_story_text
+
+    def quiz_request_kwargs(self):
+        return {
+            "story_chat_history": self.story_chat_history,
+            "total_quizzes": self.total_quizzes_to_generate,
+            "previous_quiz_questions": []
+        }
+
+    def take_story_quizzes(self):
+        quizzes, self.story_quizzes = self.story_quizzes, None
+        return quizzes
+
+    def set_quizzes(self, quizzes):
+        self.quiz_data = quizzes or []
+        self.current_quiz_index = 0
+
+    def current_quiz(self):
+        if self.current_quiz_index >= len(self.quiz_data):
+            return None
+        return self.quiz_data[self.current_quiz_index]
+
+    def quizzes_finished(self):
+        return self.current_quiz_index >= self.total_quizzes_to_generate
+
+    def check_answer(self, answer):
+        """回答を記録して採点する。(正規化した回答, 正解か, 正解) を返す。回答が空なら None。"""
+        selected_choice = answer.strip()
+        normalized = selected_choice.lower()
+        if normalized in ("t", "true"):
+            selected_choice = "True"
+        elif normalized in ("f", "false"):
+            selected_choice = "False"
+        quiz = self.current_quiz()
+        if not selected_choice or quiz is None:
+            return None
+
+        self.current_quiz_results.append(selected_choice)
+        correct_answer = quiz["a"]
+        correct = selected_choice.lower() == correct_answer.lower()
+        if correct:
+            self.add_coins(10)
+        self.current_quiz_index += 1
+        return selected_choice, correct, correct_answer
+
+    # --- テーマ・まとめカード ---
+    def save_theme(self):
+        if not self.initial_image_data or not self.current_theme_title:
+            print("Theme save skipped: No image data or title.")
+            return None
+        if not self.selected_word:
+            print("Theme save skipped: No word was selected for this session.")
+            return None
+
+        if not self.initial_image_hash:
+            self.initial_image_hash = image_digest(self.initial_image_data)
+
+        # 画像ハッシュの索引で同じ写真のテーマを探す
+        existing_theme = self.profile.find_theme(self.initial_image_hash)
+
+        # [MOD] v21.1 (R5) 会話履歴は保存しない
+        session_data = WordSession(
+            story=self.current_story_text,
+            story_translation=self.current_story_translation,
+            quizzes=self.quiz_data,
+            user_answers=self.current_quiz_results
+        )
+
+        if existing_theme:
+            previous_session = existing_theme.word_sessions.get(self.selected_word)
+            if previous_session is not None and previous_session.summary_card is not None:
+                session_data.summary_card = previous_session.summary_card
+
+            self.profile.set_word_session(existing_theme, self.selected_word, session_data)
+            target_theme = existing_theme
+            print(f"Theme '{existing_theme.title}' updated with session for '{self.selected_word}'.")
+        else:
+            new_theme = Theme(
+                title=self.current_theme_title,
+                image_hash=self.profile.images.put(self.initial_image_data), # 画像本体は画像ストアへ
+                all_labels=self.initial_image_labels
+            )
+            try:
+                # テーマ一覧用のサムネイルは保存時に一度だけ作る
+                self.profile.images.ensure_thumbnail(new_theme.image_hash, self.initial_image_data)
+            except Exception as e:
+                print(f"Error creating theme thumbnail: {e}")
+            self.profile.add_theme(new_theme)
+            self.profile.set_word_session(new_theme, self.selected_word, session_data)
+            target_theme = new_theme
+            print(f"New theme '{self.current_theme_title}' saved.")
+
+        # 変更のあったテーマとセッションだけを保存する
+        self.profile.save_word_session(target_theme, self.selected_word)
+        self.emit("theme_saved", target_theme, self.selected_word)
+        return target_theme
+
+    def tag_choices(self, ai_text):
+        """タグ選択肢の応答を (question, choices) にする。選択肢がなければ写真のラベルから作る。"""
+        question, choices = parse_question_choices(ai_text or "")
+        if not choices:
+            used = self.profile.used_words(self.initial_image_hash)
+            words = words_from_labels(self.initial_image_labels, limit=10)
+            choices = [w for w in words if w not in used][:10]
+        return question, choices
+
+    def mission_choices(self, ai_text):
+        """次のミッションの応答を (question, choices) にする。最後は必ず「ホームに戻る」。"""
+        question, choices = parse_question_choices(ai_text or "")
+        if not choices:
+            choices = re.findall(r"<([^>]+)>", self.current_story_text or "")
+            choices = [c.strip() for c in choices if c.strip()]
+            if not choices:
+                choices = words_from_labels(self.initial_image_labels, limit=3)
+
+        choices = list(dict.fromkeys(choices))
+        if HOME_CHOICE not in choices:
+            choices.append(HOME_CHOICE)
+        return question, choices
+
+    def save_summary_card(self, theme, word, summary_data):
+        self.profile.set_summary_card(theme, word, summary_data)
+
+        self.add_coins(50)
+        print("Summary card data saved. +50 Coins.")
+
+        # サマリーカードの行だけを保存 (コインは add_coins で保存済み)
+        self.profile.save_summary_card(theme, word)
+        return self.evaluate_session_and_adjust_level(theme.word_sessions[word])
+
+    def evaluate_session_and_adjust_level(self, session_data):
+        """クイズの正答率とまとめカードの記入数で次回のレベルを決める。変わったら (前, 後) を返す。"""
+        try:
+            # --- 1) 指標 ---
+            total = len(self.current_quiz_results)
+            correct = 0
+            for i, ans in enumerate(self.current_quiz_results):
+                if i < len(self.quiz_data):
+                    try:
+                        if isinstance(ans, str) and ans.lower() == self.quiz_data[i]['a'].lower():
+                            correct += 1
+                    except Exception:
+                        pass
+            accuracy = (correct / total) if total > 0 else 0.0
+
+            summary = session_data.summary_card or {}
+            filled_fields = sum(1 for f in ("field1","field2","field3","field4") if (summary.get(f) or "").strip())
+
+            # --- 2) レベル判定 ---
+            current = self.profile.get("current_level") or "CEFR A1"
+            if current not in LEVELS:
+                current = "CEFR A1"
+            idx = LEVELS.index(current)
+            new_level = current
+
+            if accuracy >= 0.8 and filled_fields >= 3 and idx < len(LEVELS) - 1:
+                new_level = LEVELS[idx + 1]
+            elif accuracy < 0.5 and idx > 0:
+                new_level = LEVELS[idx - 1]
+
+            # --- 3) 更新 ---
+            if new_level != current:
+                self.profile.set("current_level", new_level)
+                self.profile.save_fields("current_level")
+                self.student_level = new_level
+                self.emit("level_changed", current, new_level)
+                return current, new_level
+
+            print("Level unchanged — remains at", current)
+
+        except Exception as e:
+            print(f"Error during level evaluation: {e}")
+        return None
@@ -0,0 +1,163 @@
+# user_profile.py
+# ユーザープロファイルを管理するクラス (保存先は profile_store のバックエンドを使う)
+# 保存は ProfileWriter のスレッドで行うので、save_* は要求を積むだけですぐに戻る。
+# データを変更するメソッドは self.lock を取り、書き込みスレッドと同時に触らないようにする。
+# 書き込みスレッドはロック中に書き込む分のコピーだけを作り、ディスク I/O はロックを放してから行う。
+import copy, threading
+from config import (IMAGE_STORE_DIR, IMAGE_CACHE_SIZE, PROFILE_BACKEND, PROFILE_DB_FILE, PROFILE_WRITE_DELAY,
+                    PROFILE_JOURNAL_MAX_BYTES)
+from image_store import ImageStore
+from profile_model import Theme
+from profile_store import create_profile_store, ProfileWriter, JSONProfileStore
+
+
+class UserProfile:
+    def __init__(self, file_path, image_store_dir=IMAGE_STORE_DIR, backend=PROFILE_BACKEND, db_path=PROFILE_DB_FILE,
+                 write_delay=PROFILE_WRITE_DELAY):
+        self.file_path = file_path
+        self.lock = threading.RLock()
+        self.images = ImageStore(image_store_dir, cache_size=IMAGE_CACHE_SIZE)
+        self.store = create_profile_store(backend, file_path, db_path, self.images,
+                                          max_journal_bytes=PROFILE_JOURNAL_MAX_BYTES)
+        self.data = self.load()
+        self.rebuild_index()
+        self.writer = ProfileWriter(delay=write_delay)
+
+    def get_default_profile(self):
+        return {
+            "grade": "3-4年生",
+            "current_level": "CEFR A1",
+            "coins": 0,
+            "theme_history": [] # v21.1: テーマ履歴を保存
+        }
+
+    def load(self):
+        try:
+            data = self.store.load()
+        except Exception as e:
+            print(f"Error loading profile: {e}. Loading defaults.")
+            return self.get_default_profile()
+        if data is None:
+            print("No profile found. Creating new one.")
+            return self.get_default_profile()
+
+        defaults = self.get_default_profile()
+        for key, value in defaults.items():
+            if key not in data:
+                data[key] = value
+        return data
+
+    # --- 保存 (書き込みスレッドへ要求を積む) ---
+    def _submit(self, key, write):
+        if not self.store.incremental:
+            key, write = "all", self._write_all  # JSON は何を変えても全体保存なので1つにまとめる
+        self.writer.submit(key, write)
+
+    def _write_all(self):
+        if isinstance(self.store, JSONProfileStore):  # JSON / ジャーナルのスナップショット
+            with self.lock:
+                text = self.store.dumps(self.data)  # メモリ上のコピーだけロック中に作る
+            self.store.write_text(text)
+        else:
+            with self.lock:
+                data = copy.deepcopy(self.data)
+            self.store.save_all(data)
+
+    def _write_fields(self, keys):
+        with self.lock:
+            values = {key: copy.deepcopy(self.data.get(key)) for key in keys}
+        self.store.save_fields(values, keys)
+        self._compact_if_needed()
+
+    def _write_session(self, func, theme, word):
+        # 書き込むのはこのテーマの1セッションだけなので、それだけをコピーする
+        with self.lock:
+            snapshot = Theme(theme.title, theme.image_hash, list(theme.all_labels),
+                             {word: copy.deepcopy(theme.word_sessions[word])})
+        func(None, snapshot, word)
+        self._compact_if_needed()
+
+    def _compact_if_needed(self):
+        if self.store.needs_compaction():
+            # ジャーナルが大きくなったらスナップショットを書き直す (書き込みスレッドで後から実行)
+            self.writer.submit("all", self._write_all)
+
+    def save(self):
+        self._submit("all", self._write_all)
+
+    # --- 部分保存 (SQLite では変更のあった行だけを書き込む) ---
+    def save_fields(self, *keys):
+        for key in keys:
+            self._submit(("field", key), lambda k=key: self._write_fields([k]))
+
+    def save_word_session(self, theme, word):
+        self._submit(("session", theme.image_hash, word),
+                     lambda: self._write_session(self.store.save_word_session, theme, word))
+
+    def save_summary_card(self, theme, word):
+        self._submit(("summary_card", theme.image_hash, word),
+                     lambda: self._write_session(self.store.save_summary_card, theme, word))
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+        self.store.close()
+
+    # --- テーマ索引 (画像ハッシュ -> テーマ, 単語 -> セッション) ---
+    def rebuild_index(self):
+        self.themes_by_hash = {}
+        self.sessions_by_word = {}
+        for theme in self.data.get("theme_history", []):
+            self._index_theme(theme)
+
+    def _index_theme(self, theme):
+        if theme.image_hash:
+            self.themes_by_hash[theme.image_hash] = theme
+        for word in theme.word_sessions:
+            self._index_session(theme, word)
+
+    def _index_session(self, theme, word):
+        self.sessions_by_word.setdefault(word, {})[theme.image_hash] = theme
+
+    def find_theme(self, image_hash):
+        return self.themes_by_hash.get(image_hash) if image_hash else None
+
+    def used_words(self, image_hash):
+        theme = self.find_theme(image_hash)
+        return set(theme.word_sessions.keys()) if theme else set()
+
+    def sessions_for_word(self, word):
+        return [(theme, theme.word_sessions[word]) for theme in self.sessions_by_word.get(word, {}).values()]
+
+    def add_theme(self, theme):
+        with self.lock:
+            self.data.setdefault("theme_history", []).append(theme)
+            self._index_theme(theme)
+        return theme
+
+    def set_word_session(self, theme, word, session):
+        with self.lock:
+            theme.word_sessions[word] = session
+            self._index_session(theme, word)
+
+    def set_summary_card(self, theme, word, summary_card):
+        with self.lock:
+            theme.word_sessions[word].summary_card = summary_card
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+
+    def add_coins(self, amount):
+        with self.lock:
+            if "coins" not in self.data:
+                self.data["coins"] = 0
+            self.data["coins"] += amount
+            coins = self.data["coins"]
+        self.save_fields("coins")
+        return coins
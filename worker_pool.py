@@ -0,0 +1,191 @@
+# worker_pool.py
+"""
+API 呼び出し用の、スレッド数が決まった優先度つきワーカープール。
+
+  - INTERACTIVE : 会話のターン・ストーリー・クイズなど、生徒が画面の前で待っているもの
+  - BACKGROUND  : タグ / ミッションの選択肢、先読み、まとめカードのガイドなど
+
+同じ優先度の中では投入順 (FIFO)。BACKGROUND が同時に使えるスレッドは max_background 本までなので、
+残りのスレッドは常に INTERACTIVE 用に空いている (生徒のターンがバックグラウンド生成の後ろに並ばない)。
+submit_later() は delay 秒後にキューへ入れる (再試行の待ち)。待っている間はスレッドを使わず、
+shutdown() で待ち中の仕事は取り消す。submit() に key を付けておくと、待っている間に reprioritize() で優先度を変えられる
+(先読みの結果を生徒が待つことになったときなど)。metrics() でキューの深さと待ち時間を確認できる。
+"""
+import time, heapq, itertools, threading
+
+INTERACTIVE = 0
+BACKGROUND = 10
+
+_current = threading.local()
+
+
+def current_priority():
+    """このスレッドで実行中の仕事の優先度 (プールの外から呼ばれたら INTERACTIVE)。レート制限が使う。"""
+    return getattr(_current, "priority", INTERACTIVE)
+
+
+class PriorityWorkerPool:
+    def __init__(self, workers=4, max_background=None, name="api-worker"):
+        if workers < 2:
+            raise ValueError("PriorityWorkerPool needs at least 2 workers (one is always kept for INTERACTIVE jobs).")
+        self.workers = workers
+        if max_background is None:
+            max_background = self.workers - 1
+        self.max_background = max(1, min(max_background, self.workers - 1))
+        self._heap = []  # (priority, seq, enqueued_at, func, key)
+        self._delayed = []  # (ready_at, seq, priority, func, key)  submit_later() の待ち
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._background_active = 0
+        self._active = 0
+        self._closed = False
+        # metrics
+        self._submitted = {INTERACTIVE: 0, BACKGROUND: 0}
+        self._completed = 0
+        self._max_depth = 0
+        self._wait_total = {INTERACTIVE: 0.0, BACKGROUND: 0.0}
+        self._wait_max = {INTERACTIVE: 0.0, BACKGROUND: 0.0}
+        self._started = {INTERACTIVE: 0, BACKGROUND: 0}
+        self._promoted = 0
+        self._dropped_delayed = 0
+        self._threads = [threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True)
+                         for i in range(self.workers)]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, func, priority=INTERACTIVE, key=None):
+        priority = INTERACTIVE if priority <= INTERACTIVE else BACKGROUND
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("worker pool is shut down")
+            heapq.heappush(self._heap, (priority, next(self._seq), time.monotonic(), func, key))
+            self._submitted[priority] += 1
+            self._max_depth = max(self._max_depth, len(self._heap))
+            self._cond.notify_all()
+
+    def submit_later(self, func, delay, priority=INTERACTIVE, key=None):
+        """delay 秒たったら submit() と同じようにキューに入れる (待ち時間は時間が来てから数える)。"""
+        priority = INTERACTIVE if priority <= INTERACTIVE else BACKGROUND
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("worker pool is shut down")
+            heapq.heappush(self._delayed, (time.monotonic() + max(0.0, delay), next(self._seq), priority, func, key))
+            self._submitted[priority] += 1
+            self._cond.notify_all()  # 待っているワーカーに次に起きる時刻を計算し直させる
+
+    def reprioritize(self, key, priority=INTERACTIVE):
+        """key で投入してまだ始まっていない仕事の優先度を変える。変えた数を返す (実行中の仕事はそのまま)。"""
+        priority = INTERACTIVE if priority <= INTERACTIVE else BACKGROUND
+        with self._cond:
+            changed = 0
+            for i, job in enumerate(self._heap):
+                if job[4] == key and job[0] != priority:
+                    # 投入順 (seq) と待ち始めた時刻はそのまま
+                    self._heap[i] = (priority,) + job[1:]
+                    changed += 1
+            for i, job in enumerate(self._delayed):
+                if job[4] == key and job[2] != priority:
+                    self._delayed[i] = job[:2] + (priority,) + job[3:]
+                    changed += 1
+            if changed:
+                heapq.heapify(self._heap)
+                self._promoted += changed
+                self._cond.notify_all()
+            return changed
+
+    def _release_delayed(self):
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            ready_at, seq, priority, func, key = heapq.heappop(self._delayed)
+            heapq.heappush(self._heap, (priority, seq, ready_at, func, key))
+            self._max_depth = max(self._max_depth, len(self._heap))
+
+    def _next_wakeup(self):
+        """次の submit_later() の仕事が入るまでの秒数。なければ None (通知が来るまで待つ)。"""
+        if not self._delayed:
+            return None
+        return max(0.0, self._delayed[0][0] - time.monotonic())
+
+    def _take(self):
+        """実行できる一番優先度の高い仕事を取り出す。なければ None。"""
+        self._release_delayed()
+        if not self._heap:
+            return None
+        priority = self._heap[0][0]
+        if priority == BACKGROUND and self._background_active >= self.max_background:
+            return None  # 残りのスレッドは INTERACTIVE のために空けておく
+        return heapq.heappop(self._heap)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                job = self._take()
+                while job is None:
+                    if self._closed and not self._heap:
+                        return
+                    self._cond.wait(self._next_wakeup())
+                    job = self._take()
+                priority, _, enqueued_at, func, _ = job
+                waited = time.monotonic() - enqueued_at
+                self._wait_total[priority] += waited
+                self._wait_max[priority] = max(self._wait_max[priority], waited)
+                self._started[priority] += 1
+                self._active += 1
+                if priority == BACKGROUND:
+                    self._background_active += 1
+            _current.priority = priority
+            try:
+                func()
+            except Exception as e:
+                print(f"Worker job failed: {e}")
+            finally:
+                _current.priority = INTERACTIVE
+                with self._cond:
+                    self._active -= 1
+                    if priority == BACKGROUND:
+                        self._background_active -= 1
+                    self._completed += 1
+                    self._cond.notify_all()
+
+    def queue_depth(self, priority=None):
+        with self._cond:
+            if priority is None:
+                return len(self._heap)
+            return sum(1 for job in self._heap if job[0] == priority)
+
+    def metrics(self):
+        with self._cond:
+            depth = {INTERACTIVE: 0, BACKGROUND: 0}
+            for job in self._heap:
+                depth[job[0]] += 1
+            return {
+                "workers": self.workers,
+                "active": self._active,
+                "background_active": self._background_active,
+                "queue_depth": len(self._heap),
+                "queue_depth_interactive": depth[INTERACTIVE],
+                "queue_depth_background": depth[BACKGROUND],
+                "max_queue_depth": self._max_depth,
+                "submitted_interactive": self._submitted[INTERACTIVE],
+                "submitted_background": self._submitted[BACKGROUND],
+                "completed": self._completed,
+                "reprioritized": self._promoted,
+                "delayed": len(self._delayed),
+                "dropped_delayed": self._dropped_delayed,
+                "avg_wait_interactive_s": round(self._wait_total[INTERACTIVE] / max(1, self._started[INTERACTIVE]), 3),
+                "avg_wait_background_s": round(self._wait_total[BACKGROUND] / max(1, self._started[BACKGROUND]), 3),
+                "max_wait_interactive_s": round(self._wait_max[INTERACTIVE], 3),
+                "max_wait_background_s": round(self._wait_max[BACKGROUND], 3),
+            }
+
+    def shutdown(self, wait=False):
+        """新しい仕事を受け付けないようにする。キューに残った仕事は実行してから終わる
+        (submit_later() で待っている仕事は取り消す)。"""
+        with self._cond:
+            self._closed = True
+            self._dropped_delayed += len(self._delayed)
+            self._delayed.clear()
+            self._cond.notify_all()
+        if wait:
+            for t in self._threads:
+                t.join()